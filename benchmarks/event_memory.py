@@ -0,0 +1,94 @@
+# This software is released under the terms of the GNU GENERAL PUBLIC LICENSE.
+# See LICENSE.txt for full details.
+# Copyright 2023 Telemarq Ltd
+
+"""
+Measure the memory used per event and per contact by a synthetic device.
+
+Run from the repository root:
+
+    python -m benchmarks.event_memory [number of messages]
+"""
+import datetime
+import sys
+import tracemalloc
+from types import SimpleNamespace
+
+from rime.contact import Contact, Name
+from rime.event import MessageEvent, MessageSession
+
+MESSAGES = 1_000_000
+CONTACTS = 10_000
+SESSIONS = 5_000
+
+
+def make_contacts(provider):
+    return [
+        Contact(
+            local_id=str(i),
+            device_id='benchmark',
+            name=Name(first=f'First{i}', last=f'Last{i}'),
+            providerName=provider.NAME,
+            phone=f'+4479460{i:05d}',
+        )
+        for i in range(CONTACTS)
+    ]
+
+
+def make_sessions(provider, contacts):
+    return [
+        MessageSession(
+            local_id=str(i),
+            provider=provider,
+            name=f'Session {i}',
+            participants=(contacts[i % CONTACTS], contacts[(i * 7 + 1) % CONTACTS]),
+        )
+        for i in range(SESSIONS)
+    ]
+
+
+def make_events(provider, sessions, count):
+    start = datetime.datetime(2023, 1, 1)
+    events = []
+    for i in range(count):
+        session = sessions[i % SESSIONS]
+        event = MessageEvent(
+            id_=str(i),
+            session_id=session.local_id,
+            session=session,
+            from_me=bool(i % 2),
+            timestamp=start + datetime.timedelta(seconds=i),
+            provider=provider,
+            sender=session.participants[i % 2],
+            text=f'Message number {i}',
+        )
+        # As the GraphQL layer does.
+        event.device_id = 'benchmark'
+        events.append(event)
+
+    return events
+
+
+def measure(fn, *args):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = fn(*args)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, after - before
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else MESSAGES
+    provider = SimpleNamespace(NAME='benchmark')
+
+    contacts, contacts_bytes = measure(make_contacts, provider)
+    sessions = make_sessions(provider, contacts)
+    events, events_bytes = measure(make_events, provider, sessions, count)
+
+    print(f'{contacts_bytes / len(contacts):.0f} bytes per contact ({len(contacts)} contacts)')
+    print(f'{events_bytes / len(events):.0f} bytes per message event ({len(events)} events)')
+
+
+if __name__ == '__main__':
+    main()
@@ -8,7 +8,7 @@ import threading
 import urllib.parse
 import sys
 
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
 from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.requests import Request
@@ -22,6 +22,20 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from rime import Rime
 from rime.graphql import schema, QueryContext
 from rime.config import Config
+from rime.thumbnails import ORIGINAL, SIZES as THUMBNAIL_SIZES
+
+
+MEDIA_CHUNK_SIZE = 256 * 1024
+
+
+def _read_chunks(handle):
+    """
+    Yield the contents of 'handle' in fixed-size chunks and close it, so that media is streamed without splitting it
+    into lines or reading it all at once.
+    """
+    with handle:
+        while chunk := handle.read(MEDIA_CHUNK_SIZE):
+            yield chunk
 
 
 class NullBGCall:
@@ -89,8 +103,9 @@ class RimeSingleton:
     def get_context_value(self, request, data):
         return QueryContext(self._rime)
 
-    async def get_media(self, media_id):
-        return self._rime.get_media(media_id)
+    async def get_media(self, media_id, size):
+        # Scaling media can take a while, so it is done off the event loop.
+        return await asyncio.get_running_loop().run_in_executor(None, self._rime.get_media, media_id, size)
 
     async def startup(self):
         await self._rime.start_background_tasks_async()
@@ -136,11 +151,14 @@ def create_app():
         await rime.shutdown()
 
     @app.get("/media/{media_id:path}")
-    async def handle_media(media_id: str):
+    async def handle_media(media_id: str, size: str = ORIGINAL):
+        if size != ORIGINAL and size not in THUMBNAIL_SIZES:
+            raise HTTPException(status_code=400, detail=f"Unknown media size: {size}")
+
         media_id = urllib.parse.unquote(media_id)
-        media_data = await rime.get_media(media_id)
+        media_data = await rime.get_media(media_id, size)
 
-        response = StreamingResponse(media_data.handle, media_type=media_data.mime_type)
+        response = StreamingResponse(_read_chunks(media_data.handle), media_type=media_data.mime_type)
         response.headers['Content-Length'] = str(media_data.length)
         return response
 
@@ -74,8 +74,15 @@ export const searchResult = computed(() => {
 		result['providers'] = rawEventsSearchResult.value.events.providers;
 		result['messageSessions'] = rawEventsSearchResult.value.events.messageSessions;
 
+		/* Senders and participants are listed once, and referred to by ID. */
+		let contactsById = {};
+		for(let contact of rawEventsSearchResult.value.events.contacts) {
+			contactsById[contact.id] = contact;
+		}
+
 		for(let session of rawEventsSearchResult.value.events.messageSessions) {
-			chatSessions.value[session.sessionId] = new ChatSession(session.sessionId, session.name, session.participants, session.providerFriendlyName);
+			const participants = session.participantIds.map((id) => contactsById[id]);
+			chatSessions.value[session.sessionId] = new ChatSession(session.sessionId, session.name, participants, session.providerFriendlyName);
 		}
 
 		for(let event of rawEventsSearchResult.value.events.events) {
@@ -93,6 +100,8 @@ export const searchResult = computed(() => {
 			}
 
 			if(newEvent.__typename == "MessageEvent") {
+				newEvent.sender = contactsById[event.senderId] ?? null;
+
 				/* Create the chat session if it doesn't exist */
 				if(newEvent.sessionId == lastSessionKeyForDevice[event.deviceId]) {
 					/* We've seen this session, so don't store it again. The GUI uses this to determine
@@ -106,11 +106,7 @@ export const { result: rawEventsSearchResult, refetch: eventsRefetch } = useQuer
                         text
                         fromMe
                         sessionId
-                        sender {
-                            id
-                            name { first last display }
-                            phone
-                        }
+                        senderId
                         media {
                             mime_type
                             url
@@ -125,9 +121,11 @@ export const { result: rawEventsSearchResult, refetch: eventsRefetch } = useQuer
                 sessionId
                 name
                 providerFriendlyName
-                participants {
-                    name { first last display } phone email
-                }
+                participantIds
+            }
+            contacts {
+                id
+                name { first last display } phone email
             }
     }
 }
@@ -6,7 +6,7 @@ from dataclasses import dataclass
 from typing import Any
 
 
-@dataclass
+@dataclass(slots=True)
 class Name:
     first: str | None = None
     last: str | None = None
@@ -25,35 +25,43 @@ class Name:
         return ''
 
 
-# TODO: a Contact may have more than one phone or email
-@dataclass
+@dataclass(slots=True)
 class Contact:
     local_id: str  # Unique to the provider only. The GraphQL layer combines this with providerName for the UI.
     device_id: str
     name: Name | None = None
     providerName: str | None = None
     providerFriendlyName: str | None = None
-    phone: str | None = None
-    email: str | None = None
+    phone: str | None = None  # the primary phone number
+    email: str | None = None  # the primary email address
+    # Every phone number and email address, including the primary ones, for providers which record more than one:
+    phones: tuple[str, ...] = ()
+    emails: tuple[str, ...] = ()
     # Provider-specific data to allow the contact to be recreated during subsetting:
     provider_data: Any = None
 
-    def __setattr__(self, key, value):
+    def set_field(self, key, value):
         """
-        Helper to let you set name.field directly.
+        Set the field 'key', which may name a field of the contact's name as 'name.field'.
         """
         if '.' in key:
             assert key.count('.') == 1
             key, subkey = key.split('.')
             setattr(getattr(self, key), subkey, value)
         else:
-            super().__setattr__(key, value)
+            setattr(self, key, value)
+
+    def all_phones(self) -> tuple[str, ...]:
+        return self.phones or ((self.phone,) if self.phone else ())
+
+    def all_emails(self) -> tuple[str, ...]:
+        return self.emails or ((self.email,) if self.email else ())
 
     def __hash__(self):
         return hash((self.device_id, self.local_id))
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class GlobalContactId:
     """
     Uniquely identifies a contact.
@@ -1,19 +1,74 @@
+import os
+import threading
+import traceback
+
 from .filesystem.devicefilesystem import DeviceFilesystem, EncryptedDeviceFilesystem
 from .filesystem.exceptions import WrongPassphraseError
 from .session import Session
 from .provider import find_providers
+from .resultcache import ResultCache
 from .errors import NotEncryptedDeviceType
 from .contact import Contact, Name
 from .providers.providernames import FRIENDLY_NAMES
+from .metadata import FsMetadata
+from .textindex import TextIndex
+
+
+_shared_lock = threading.Lock()
+_shared = {}  # (device ID, cache path) -> [TextIndex, FsMetadata, number of Devices using them]
+
+
+def _acquire_derived_data(device_id, cache_path):
+    """
+    Return the TextIndex and FsMetadata of 'device_id', shared by every Device for it, such as those created by the
+    foreground and background Rime objects, so that each database is built and updated by one object.
+    """
+    key = (device_id, cache_path)
+    with _shared_lock:
+        entry = _shared.get(key)
+        if entry is None:
+            entry = _shared[key] = [
+                TextIndex(os.path.join(cache_path, 'text_index.db') if cache_path else None),
+                FsMetadata(os.path.join(cache_path, 'metadata.db') if cache_path else None),
+                0,
+            ]
+
+        entry[2] += 1
+        return entry[0], entry[1]
+
+
+def _release_derived_data(device_id, cache_path):
+    """
+    Give up a reference obtained from _acquire_derived_data(), closing the databases when there are none left.
+    """
+    key = (device_id, cache_path)
+    with _shared_lock:
+        entry = _shared[key]
+        entry[2] -= 1
+        if entry[2] > 0:
+            return
+
+        del _shared[key]
+
+    text_index, metadata, _ = entry
+    text_index.close()
+    metadata.close()
 
 
 class Device:
-    def __init__(self, device_id: str, fs: DeviceFilesystem, session: Session):
+    def __init__(self, device_id: str, fs: DeviceFilesystem, session: Session, provider_caches: ResultCache,
+                 cache_path: str | None = None):
         self.id_ = device_id
         self.fs = fs
-        self.providers = find_providers(self.fs)
+        self.provider_caches = provider_caches
+        self.providers = find_providers(self.fs, provider_caches)
         self.session = session
 
+        # Derived data such as indexes is kept under cache_path, if supplied, and in memory otherwise.
+        self.cache_path = cache_path
+        self.text_index, self.metadata = _acquire_derived_data(device_id, cache_path)
+        self._derived_data_released = False
+
         # Special contacts:
 
         # ... the device operator
@@ -43,7 +98,40 @@ class Device:
         return self._provider_contacts[provider_name]
 
     def reload_providers(self):
-        self.providers = find_providers(self.fs)
+        for provider in self.providers.values():
+            provider.release_caches()
+
+        self.providers = find_providers(self.fs, self.provider_caches)
+
+    def release_caches(self):
+        """
+        Discard cached data for this device. Called when the device is removed.
+        """
+        for provider in self.providers.values():
+            provider.release_caches()
+
+        # A deleted device is released again when the device list is next rescanned.
+        if not self._derived_data_released:
+            self._derived_data_released = True
+            _release_derived_data(self.id_, self.cache_path)
+
+    def warm_caches(self):
+        """
+        Fill the providers' caches and the text index. This may take some time, so is normally run in the background.
+        """
+        for provider in list(self.providers.values()):
+            try:
+                provider.warm_cache(self)
+            except Exception:
+                print(f'Error warming cache for {provider.NAME} on {self.id_}:')
+                traceback.print_exc()
+
+        # Searches fall back to matching the text of each event until the text index is complete.
+        try:
+            self.text_index.warm(self)
+        except Exception:
+            print(f'Error building the text index for {self.id_}:')
+            traceback.print_exc()
 
     @property
     def country_code(self) -> str:
@@ -5,6 +5,8 @@
 """
 An Event is something that occurs at a particular time in the dataset
 of a Provider.
+
+Events are created in large numbers, so these classes use slots rather than a per-instance __dict__.
 """
 
 from dataclasses import dataclass
@@ -15,13 +17,13 @@ from .contact import Contact
 from .provider import Provider
 
 
-@dataclass
+@dataclass(slots=True)
 class GenericEventInfo:
     category: str
     is_user_generated: bool = False
 
 
-@dataclass
+@dataclass(slots=True)
 class Event:
     id_: str
     timestamp: datetime
@@ -32,7 +34,7 @@ class Event:
     provider_data: Any = None
 
 
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, slots=True)
 class MessageSession:
     local_id: str
     provider: Provider
@@ -46,7 +48,7 @@ class MessageSession:
         return hash(key)
 
 
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, slots=True)
 class Media:
     """
     Represents either standalone media or media associated with a MessageEvent.
@@ -55,7 +57,7 @@ class Media:
     local_id: str  # A provider-specific reference to the media.
 
 
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, slots=True)
 class MessageEvent(Event):
     session_id: str
     text: str
@@ -64,7 +66,11 @@ class MessageEvent(Event):
     media: Media | None = None
 
 
-@dataclass(kw_only=True)
-class MediaEvent(Media, Event):
-    # Nothing required.
-    pass
+@dataclass(kw_only=True, slots=True)
+class MediaEvent(Event):
+    """
+    Standalone media. This has the fields of Media, but does not inherit from it as slotted classes cannot have
+    more than one base with fields.
+    """
+    mime_type: str
+    local_id: str  # A provider-specific reference to the media.
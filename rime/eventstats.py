@@ -0,0 +1,65 @@
+# This software is released under the terms of the GNU GENERAL PUBLIC LICENSE.
+# See LICENSE.txt for full details.
+# Copyright 2023 Telemarq Ltd
+
+"""
+Counting events, grouped by time, provider, sender or session.
+
+Counts are keyed by a tuple with one string (or None) per grouping in the requested order. Providers which can count
+in their databases use make_key() to produce the same keys as counting events one at a time.
+"""
+from collections import Counter
+
+from .contact import GlobalContactId
+from .event import MessageEvent
+
+DAY = 'DAY'
+HOUR = 'HOUR'
+PROVIDER = 'PROVIDER'
+SENDER = 'SENDER'
+SESSION = 'SESSION'
+
+GROUP_BY_TIME = {DAY, HOUR}
+
+# Providers counting in SQL group timestamps into buckets of this many seconds, and take the start of each bucket as
+# the time of all of its events. Every time zone's offset from UTC is a multiple of this, so no bucket spans the
+# start of a local day or hour.
+BUCKET_SECONDS = 15 * 60
+
+
+def make_key(group_by, device, provider, timestamp=None, sender=None, session_local_id=None):
+    """
+    Return the key for an event on 'device' from 'provider' with the given properties.
+
+    Only the properties needed by 'group_by' need be supplied.
+    """
+    key = []
+    for group in group_by:
+        if group == DAY:
+            key.append(timestamp.strftime('%Y-%m-%d'))
+        elif group == HOUR:
+            key.append(timestamp.strftime('%Y-%m-%dT%H'))
+        elif group == PROVIDER:
+            key.append(provider.NAME)
+        elif group == SENDER:
+            key.append(GlobalContactId.make_global_id_str(sender) if sender else None)
+        elif group == SESSION:
+            # This matches the session IDs returned by the events query.
+            key.append(f'{device.id_}:{provider.NAME}:{session_local_id}' if session_local_id is not None else None)
+        else:
+            raise ValueError(f'Unknown grouping {group}')
+
+    return tuple(key)
+
+
+def count_events(group_by, device, provider, events):
+    """
+    Return a Counter of 'events', which are from 'provider' on 'device', keyed by make_key().
+    """
+    counts = Counter()
+    for event in events:
+        session = event.session if isinstance(event, MessageEvent) else None
+        counts[make_key(group_by, device, provider, timestamp=event.timestamp, sender=event.sender,
+                        session_local_id=session.local_id if session else None)] += 1
+
+    return counts
@@ -11,6 +11,11 @@ import fs.osfs
 from .devicefilesystem import DeviceFilesystem, DirEntry
 from .devicesettings import DeviceSettings
 from .fslibfilesystem import FSLibFilesystem
+from . import zipaccess
+from ..sql import sqlite3_connect_filename as sqlite3_connect_with_regex_support
+
+
+SETTINGS_FILENAME = '_rime_settings.db'
 
 
 class AndroidDeviceFilesystem(DeviceFilesystem):
@@ -89,26 +94,30 @@ class AndroidZippedDeviceFilesystem(DeviceFilesystem):
                 |- data
                     |- ...
 
-    The contents of the .zip file are extracted in a temporary directory
-    and then the (only) directory from within the temporary directory
-    (the `main_dir`) is used to instantiate a filesystem. All queries
-    refer to the data in the temporary directory.
+    Nothing is extracted up front. Directory listings and sizes come from the archive's central directory and files
+    are read from the archive as they are consumed. Only SQLite databases, which need a real file, are extracted, once,
+    into a cache shared by every filesystem for the same archive (see zipaccess).
     """
 
     def __init__(self, id_: str, root: str):
         self.id_ = id_
+        self._zip = zipaccess.acquire(root)
 
-        # extract the files from the zipfile in a temporary directory
-        self.temp_root = tempfile.TemporaryDirectory()
+        # Settings changes are kept in a temporary copy rather than written back to the archive.
+        if self._zip.exists(SETTINGS_FILENAME):
+            self.temp_settings = self._zip.copy(SETTINGS_FILENAME)
+        else:
+            self.temp_settings = tempfile.NamedTemporaryFile(mode='w+b')
 
-        with zipfile.ZipFile(root) as zp:
-            zp.extractall(path=self.temp_root.name)
-            main_dir, = zipfile.Path(zp).iterdir()
+        settings_dir, settings_file = os.path.split(self.temp_settings.name)
+        self._settings = DeviceSettings(settings_dir, settings_file)
 
-        # instantiate a filesystem from the temporary directory
-        self._fs = fs.osfs.OSFS(os.path.join(self.temp_root.name, main_dir.name))
-        self._settings = DeviceSettings(os.path.join(self.temp_root.name, main_dir.name))
-        self._fsaccess = FSLibFilesystem(self._fs)
+        # Keep references to the private copies behind writable connections, which are deleted when closed.
+        self._writable_copies = []
+
+    def __del__(self):
+        if zip_access := getattr(self, '_zip', None):
+            zip_access.release()
 
     @classmethod
     def is_device_filesystem(cls, path):
@@ -128,25 +137,42 @@ class AndroidZippedDeviceFilesystem(DeviceFilesystem):
         return self._settings.is_subset_fs()
 
     def path_to_direntry(self, path, name=None) -> DirEntry:
-        return self._fsaccess.path_to_direntry(path, name)
+        if name is None:
+            name = os.path.basename(path)
+
+        return DirEntry(name, path, self._zip.stat(path.strip('/')))
 
     def scandir(self, path):
-        return self._fsaccess.scandir(path)
+        return [
+            self.path_to_direntry(os.path.join(path, os.path.basename(child)))
+            for child in self._zip.listdir(path.strip('/'))
+        ]
 
     def exists(self, path):
-        return self._fs.exists(path)
+        return self._zip.exists(path.strip('/'))
 
     def getsize(self, path):
-        return self._fs.getsize(path)
+        return self._zip.getsize(path.strip('/'))
+
+    def fingerprint(self, path):
+        info = self._zip.getinfo(path.strip('/'))
+        return f'{info.CRC:08x}:{info.file_size}'
 
     def open(self, path):
-        return self._fs.open(path, 'rb')
+        return self._zip.open(path.strip('/'))
 
     def create_file(self, path):
         raise NotImplementedError
 
     def sqlite3_connect(self, path, read_only=True):
-        return self._fsaccess.sqlite3_connect(path, read_only)
+        if read_only:
+            # Read-only connections share one extracted copy of the database.
+            return sqlite3_connect_with_regex_support(self._zip.extract(path.strip('/')), read_only=True)
+
+        # Writes go to a private copy, kept for the life of the filesystem.
+        tmp_copy = self._zip.copy(path.strip('/'))
+        self._writable_copies.append(tmp_copy)
+        return sqlite3_connect_with_regex_support(tmp_copy.name, read_only=False)
 
     def sqlite3_create(self, path):
         raise NotImplementedError
@@ -158,4 +184,8 @@ class AndroidZippedDeviceFilesystem(DeviceFilesystem):
         return self._settings.is_locked()
 
     def dirname(self, pathname):
-        return self._fsaccess.dirname(pathname)
+        # As FSLibFilesystem.dirname().
+        if '/' not in pathname:
+            return '/'
+
+        return pathname[:pathname.rindex('/')]
@@ -9,6 +9,9 @@ from .base import DirEntry
 
 
 class DeviceFilesystem(ABC):
+    # Directory for data derived from the filesystem, or None if there is none. Set by the registry.
+    cache_path: str | None = None
+
     @classmethod
     @abstractmethod
     def is_device_filesystem(cls, path) -> bool:
@@ -71,6 +74,9 @@ class DeviceFilesystem(ABC):
     def sqlite3_connect(self, path, read_only=True):
         """
         Return an opened sqlite3 connection to the database at 'path'.
+
+        Filesystems which can't write to their databases in place, such as zipped filesystems, give each connection
+        which isn't 'read_only' a private copy of the database.
         """
         return None
 
@@ -95,6 +101,13 @@ class DeviceFilesystem(ABC):
         """
         return False
 
+    def fingerprint(self, path) -> str:
+        """
+        Return a string which changes when the file at 'path' does, such as its size and modification time.
+        """
+        path_stat = self.path_to_direntry(path).stat()
+        return f'{path_stat.st_size}:{path_stat.st_mtime}'
+
     def walk(self, path):
         for entry in self.scandir(path):
             if entry.is_dir():
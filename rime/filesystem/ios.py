@@ -2,13 +2,19 @@
 # See LICENSE.txt for full details.
 # Copyright 2023 Telemarq Ltd
 from abc import ABC, abstractmethod
+import bisect
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
 import os
 import plistlib
 import hashlib
+import itertools
 from logging import getLogger
 import shutil
 import sqlite3
-import tempfile
+import stat
+import threading
 from typing import Optional
 import zipfile
 
@@ -18,16 +24,53 @@ from .devicefilesystem import DeviceFilesystem, EncryptedDeviceFilesystem, DirEn
 from .devicesettings import DeviceSettings
 from .exceptions import NoPassphraseError, NotDecryptedError, WrongPassphraseError
 from .ensuredir import ensuredir
-from ..sql import Table, Query, get_field_indices, sqlite3_connect_filename as sqlite3_connect_with_regex_support
+from . import zipaccess
+from ..sql import Table, Query, sqlite3_connect, sqlite3_connect_filename as sqlite3_connect_with_regex_support
 
 log = getLogger(__name__)
 
+SHA1_LENGTH = 20
+SHA1_HEX_LENGTH = SHA1_LENGTH * 2
+
+# Modes of manifest rows with no 'file' plist, by the row's flags.
+MANIFEST_FLAG_MODES = {
+    1: stat.S_IFREG | 0o644,
+    2: stat.S_IFDIR | 0o755,
+    4: stat.S_IFLNK | 0o755,
+}
+DIRECTORY_STAT = (MANIFEST_FLAG_MODES[2], 0, 0, 0, 0, 0, 0, 0, 0, 0)
+
+# Manifests with at least this many rows have their plists decoded by a pool of processes, in chunks of this size.
+MANIFEST_PARALLEL_DECODE_ROWS = 50_000
+MANIFEST_DECODE_CHUNK_ROWS = 10_000
+
+# The decoded tree is kept in this database in the filesystem's cache directory.
+MANIFEST_TREE_DB = 'manifest_tree.db'
+# Increment when the stored tree changes. The database is a cache, so trees from other versions are decoded again.
+MANIFEST_TREE_VERSION = 1
+
 
 class _IosManifest:
-    def __init__(self, manifest_conn):
+    """
+    Maps paths of the form domain/relativePath to the names of the files which hold them in an iOS backup.
+
+    The manifest has no index on domain and relativePath, so the paths it lists are read once, into a sorted list
+    which supports lookups and prefix listing.
+
+    tree_cache_fn() returns the pathname of a database in which to keep the decoded directory tree and a key which
+    changes when the manifest does, or None if the tree isn't to be kept.
+    """
+    def __init__(self, manifest_conn, tree_cache_fn=lambda: None):
         self.manifest_conn = manifest_conn
+        self._tree_cache_fn = tree_cache_fn
         self.file_table = Table('Files')
-        self._scandir_cache = {}
+        self._tree_lock = threading.Lock()
+        self._directories = None  # directory path -> {name: stat tuple}
+        self._index_lock = threading.Lock()
+        self._paths = None  # sorted paths in the manifest
+        self._file_ids = None  # the fileID of each path in _paths, as consecutive SHA-1 digests
+        self._other_file_ids = {}  # path -> fileID, for fileIDs which aren't SHA-1 hex digests
+        self._added_file_ids = {}  # path -> fileID, for files added by add_file()
 
     @staticmethod
     def _get_ios_hash(domain, relative_path):
@@ -39,6 +82,64 @@ class _IosManifest:
 
         return hashlib.sha1(hashable_path.encode()).hexdigest()
 
+    def _index(self):
+        with self._index_lock:
+            if self._paths is None:
+                try:
+                    rows = self.manifest_conn.execute(
+                        "SELECT domain || '/' || relativePath, fileID FROM Files"
+                        " WHERE domain IS NOT NULL AND relativePath IS NOT NULL").fetchall()
+                except sqlite3.OperationalError:
+                    rows = []
+
+                rows.sort()
+                file_ids = None
+                if all(isinstance(file_id, str) and len(file_id) == SHA1_HEX_LENGTH for _path, file_id in rows):
+                    try:
+                        file_ids = bytes.fromhex(''.join(file_id for _path, file_id in rows))
+                    except ValueError:
+                        pass
+
+                if file_ids is None:
+                    file_ids = self._pack_file_ids(rows)
+
+                self._file_ids = file_ids
+                self._paths = [path for path, _file_id in rows]
+
+            return self._paths, self._file_ids
+
+    def _pack_file_ids(self, rows):
+        """
+        Return the fileIDs of 'rows' as consecutive SHA-1 digests, keeping any which aren't in _other_file_ids.
+        """
+        file_ids = bytearray()
+        for path, file_id in rows:
+            if isinstance(file_id, str) and len(file_id) == SHA1_HEX_LENGTH:
+                try:
+                    file_ids += bytes.fromhex(file_id)
+                    continue
+                except ValueError:
+                    pass
+
+            file_ids += bytes(SHA1_LENGTH)
+            self._other_file_ids[path] = file_id
+
+        return bytes(file_ids)
+
+    def _get_file_id(self, path):
+        """
+        Return the fileID of 'path' in the manifest, or None if it isn't there.
+        """
+        if file_id := self._added_file_ids.get(path):
+            return file_id
+
+        paths, file_ids = self._index()
+        i = bisect.bisect_left(paths, path)
+        if i == len(paths) or paths[i] != path:
+            return None
+
+        return self._other_file_ids.get(path) or file_ids[i * SHA1_LENGTH:(i + 1) * SHA1_LENGTH].hex()
+
     def get_hashed_pathname(self, path):
         """
         Return the pathname inside an iOS backup of path 'path'. Used by providers when accessing iOS files.
@@ -49,25 +150,26 @@ class _IosManifest:
         referenced by the path HomeDomain/Library/SMS/sms.db.
         """
         # TODO: some files are stored in blobs in the manifest. Need to deal with that.
-        domain, relative_path = path.split('/', 1)
-
-        # First, attempt to look up the file in the manifest.
-        query = Query.from_(self.file_table).select('fileID')\
-            .where(self.file_table.domain == domain)\
-            .where(self.file_table.relativePath == relative_path)
-
-        try:
-            result = self.manifest_conn.execute(str(query)).fetchone()
-        except sqlite3.OperationalError:
-            result = None
+        file_id = self._get_file_id(path)
 
-        if result:
-            file_id = result[0]
-        else:
+        if file_id is None:
+            domain, relative_path = path.split('/', 1)
             file_id = self._get_ios_hash(domain, relative_path)
 
         return os.path.join(file_id[:2], file_id)
 
+    def paths_under(self, path):
+        """
+        Return the paths in the manifest which are under directory 'path', in sorted order.
+        """
+        paths, _file_ids = self._index()
+        prefix = path.rstrip('/') + '/'
+        start = bisect.bisect_left(paths, prefix)
+        end = bisect.bisect_left(paths, prefix[:-1] + chr(ord('/') + 1), lo=start)
+
+        added = [added_path for added_path in self._added_file_ids if added_path.startswith(prefix)]
+        return sorted(set(paths[start:end]).union(added)) if added else paths[start:end]
+
     def add_file(self, path):
         """
         Add a file to Manifest.db. It's okay to add the same file twice (only one entry will be created).
@@ -91,65 +193,233 @@ class _IosManifest:
             self.manifest_conn.execute(str(query))
 
             self.manifest_conn.commit()
+            self._added_file_ids[path] = ios_hash
+            with self._tree_lock:
+                self._directories = None
         elif not (result[0] == relative_path and result[1] == domain):
             # File hash in database, but for a different file.
             raise FileExistsError(path)
 
         # If we get here, the hash and matching path are already in the database, which is fine.
 
-    def scandir(self, path):
-        # TODO: Currently broken for subsets.
-        return []
+    def _tree(self):
+        """
+        Return the directory tree of the manifest: a mapping of directory path to a mapping of the names of its
+        entries to their stat tuples. The tree is decoded on first use, or loaded if it was kept by an earlier run.
+        """
+        with self._tree_lock:
+            if self._directories is None:
+                tree_cache = self._tree_cache_fn()
+                if tree_cache:
+                    self._directories = _load_tree(*tree_cache)
 
-        # Retrieving the contents of a directory from an iOS backup is hard, because the file stat info
-        # is stored in a binary plist in the manifest, so cache the result.
-        if path in self._scandir_cache:
-            return self._scandir_cache[path]
+                if self._directories is None:
+                    self._directories = _decode_tree(self.manifest_conn)
+                    if tree_cache:
+                        _store_tree(*tree_cache, self._directories)
 
-        domain, relative_path = path.split('/', 1)
+            return self._directories
 
-        query = Query.from_(self.file_table).select('fileID', 'relativePath', 'file')
-        query = query.where(self.file_table.domain == domain)
-        fields = get_field_indices(query)
+    def scandir(self, path):
+        path = path.rstrip('/')
+        entries = self._tree().get(path)
+        if entries is None:
+            raise FileNotFoundError(path)
+
+        return [
+            DirEntry(name=name, path=f'{path}/{name}' if path else name, stat_val=os.stat_result(stat_tuple))
+            for name, stat_tuple in entries.items()
+        ]
+
+    def path_to_direntry(self, path):
+        path = path.rstrip('/')
+        parent, name = _split_path(path)
+        stat_tuple = self._tree().get(parent, {}).get(name)
+        if stat_tuple is None:
+            raise FileNotFoundError(path)
 
-        entries = []
-        for row in self.manifest_conn.execute(str(query)):
-            name = row[fields['relativePath']]
+        return DirEntry(name=name, path=path, stat_val=os.stat_result(stat_tuple))
 
-            if not name.startswith(relative_path):
-                # Ignore files in directories above this one.
-                continue
 
-            if name[len(relative_path) + 1:].count('/') > 1:  # skip leading '/'
-                # Ignore files in directories below this one.
-                continue
+def _split_path(path):
+    """
+    Return the parent directory and name of 'path'. Domains are the directories at the root, whose path is ''.
+    """
+    parent, _slash, name = path.rpartition('/')
+    return parent, name
 
-            blob = row[fields['file']]
-            blob_plist = plistlib.loads(blob)
 
-            file_metadata = blob_plist['$objects'][1]
+def _decode_stat(flags, blob):
+    """
+    Return an os.stat_result-compatible tuple for a manifest row from its flags and its 'file' plist, if it has one.
+    """
+    if blob:
+        try:
+            plist = plistlib.loads(blob)
+            objects = plist['$objects']
+            metadata = objects[plist['$top']['root'].data]
 
-            stat_info = os.stat_result([
-                file_metadata['Mode'],
-                file_metadata['InodeNumber'],
+            return (
+                metadata['Mode'],
+                metadata['InodeNumber'],
                 0,  # st_dev
                 0,  # st_nlink
-                file_metadata['UserID'],
-                file_metadata['GroupID'],
-                file_metadata['Size'],
+                metadata['UserID'],
+                metadata['GroupID'],
+                metadata['Size'],
                 0,  # st_atime
-                file_metadata['LastModified'],  # st_mtime
-                file_metadata['Birth'],  # st_ctime
-            ])
+                metadata['LastModified'],  # st_mtime
+                metadata['Birth'],  # st_ctime
+            )
+        except (plistlib.InvalidFileException, KeyError, IndexError, TypeError, AttributeError, ValueError):
+            pass
 
-            entries.append(DirEntry(
-                name=name,
-                path=f'{path}/{name}',
-                stat_val=stat_info
-            ))
+    # Rows without a plist, such as those in subsets, have only their flags.
+    return (MANIFEST_FLAG_MODES.get(flags, stat.S_IFREG | 0o644), 0, 0, 0, 0, 0, 0, 0, 0, 0)
 
-        self._scandir_cache[path] = entries
-        return entries
+
+def _decode_stats(rows):
+    return [_decode_stat(flags, blob) for flags, blob in rows]
+
+
+def _decode_tree(manifest_conn):
+    """
+    Decode the 'file' plist of every row of the manifest, in parallel if there are many, and return the directory
+    tree described by _IosManifest._tree().
+    """
+    try:
+        rows = manifest_conn.execute("""
+            SELECT domain, relativePath, flags, file FROM Files WHERE domain IS NOT NULL AND relativePath IS NOT NULL
+        """).fetchall()
+    except sqlite3.OperationalError:
+        rows = []
+
+    flags_and_blobs = [(flags, blob) for _domain, _relative_path, flags, blob in rows]
+    if len(rows) >= MANIFEST_PARALLEL_DECODE_ROWS:
+        chunks = [
+            flags_and_blobs[i:i + MANIFEST_DECODE_CHUNK_ROWS]
+            for i in range(0, len(flags_and_blobs), MANIFEST_DECODE_CHUNK_ROWS)
+        ]
+        try:
+            # Forking a process which is running other threads can deadlock the child, so the workers are spawned.
+            with ProcessPoolExecutor(mp_context=multiprocessing.get_context('spawn')) as executor:
+                stats = [
+                    stat_tuple for chunk_stats in executor.map(_decode_stats, chunks) for stat_tuple in chunk_stats
+                ]
+        except BrokenProcessPool as e:
+            log.warning(f"Could not decode the manifest in parallel: {e}")
+            stats = _decode_stats(flags_and_blobs)
+    else:
+        stats = _decode_stats(flags_and_blobs)
+
+    directories = {'': {}}
+
+    def add_directory(path):
+        if path not in directories:
+            directories[path] = {}
+            parent, name = _split_path(path)
+            add_directory(parent)
+            # Directories without rows of their own are given a default mode.
+            directories[parent].setdefault(name, DIRECTORY_STAT)
+
+    for (domain, relative_path, _flags, _blob), stat_tuple in zip(rows, stats):
+        path = f'{domain}/{relative_path}' if relative_path else domain
+        parent, name = _split_path(path)
+        add_directory(parent)
+        directories[parent][name] = stat_tuple
+        if stat.S_ISDIR(stat_tuple[0]):
+            add_directory(path)
+
+    return directories
+
+
+def _connect_tree_db(db_path):
+    conn = sqlite3_connect(db_path)
+    with conn:
+        if conn.execute("PRAGMA user_version").fetchone()[0] != MANIFEST_TREE_VERSION:
+            conn.execute("DROP TABLE IF EXISTS source")
+            conn.execute("DROP TABLE IF EXISTS entries")
+            conn.execute(f"PRAGMA user_version = {MANIFEST_TREE_VERSION}")
+
+        conn.execute("CREATE TABLE IF NOT EXISTS source (key TEXT)")
+        # Each directory has a row with a NULL name, so that empty directories are kept.
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                parent TEXT, name TEXT, mode INTEGER, ino INTEGER, dev INTEGER, nlink INTEGER, uid INTEGER,
+                gid INTEGER, size INTEGER, atime REAL, mtime REAL, ctime REAL
+            )
+        """)
+
+    return conn
+
+
+def _load_tree(db_path, source_key):
+    """
+    Return the tree stored in 'db_path' for the manifest identified by 'source_key', or None if there is none.
+    """
+    if not os.path.exists(db_path):
+        return None
+
+    try:
+        conn = _connect_tree_db(db_path)
+        try:
+            if conn.execute("SELECT key FROM source").fetchone() != (source_key,):
+                return None
+
+            directories = {}
+            for parent, name, *stat_tuple in conn.execute("SELECT * FROM entries"):
+                entries = directories.setdefault(parent, {})
+                if name is not None:
+                    entries[name] = tuple(stat_tuple)
+
+            return directories
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        log.warning(f"Could not load the manifest tree from {db_path}: {e}")
+        return None
+
+
+def _store_tree(db_path, source_key, directories):
+    """
+    Store the tree 'directories' of the manifest identified by 'source_key' in 'db_path'.
+    """
+    empty_stat = (None,) * len(DIRECTORY_STAT)
+    rows = (
+        row
+        for parent, entries in directories.items()
+        for row in itertools.chain(
+            [(parent, None, *empty_stat)],
+            ((parent, name, *stat_tuple) for name, stat_tuple in entries.items())
+        )
+    )
+
+    try:
+        ensuredir(db_path)
+        conn = _connect_tree_db(db_path)
+        try:
+            with conn:
+                conn.execute("DELETE FROM source")
+                conn.execute("DELETE FROM entries")
+                conn.executemany("INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                conn.execute("INSERT INTO source (key) VALUES (?)", (source_key,))
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        # The tree is only a cache, so carry on without it.
+        log.warning(f"Could not store the manifest tree in {db_path}: {e}")
+
+
+def _manifest_tree_cache(fs, manifest_path):
+    """
+    Return the tree_cache_fn() result for the manifest at 'manifest_path' on 'fs', keyed by its size and
+    modification time.
+    """
+    if not fs.cache_path:
+        return None
+
+    manifest_stat = os.stat(manifest_path)
+    return os.path.join(fs.cache_path, MANIFEST_TREE_DB), f'{manifest_stat.st_size}:{manifest_stat.st_mtime_ns}'
 
 
 def _ios_filesystem_is_encrypted(path):
@@ -179,7 +449,8 @@ class IosDeviceFilesystem(DeviceFilesystem, IosDeviceFilesystemBase):
         )
         self.file_table = Table('Files')
         self._settings = DeviceSettings(root)
-        self._converter = _IosManifest(self.manifest)
+        self._converter = _IosManifest(
+            self.manifest, lambda: _manifest_tree_cache(self, os.path.join(self.root, 'Manifest.db')))
 
     @classmethod
     def is_device_filesystem(cls, path):
@@ -245,6 +516,10 @@ class IosDeviceFilesystem(DeviceFilesystem, IosDeviceFilesystemBase):
     def getsize(self, path):
         return os.path.getsize(os.path.join(self.root, self._converter.get_hashed_pathname(path)))
 
+    def fingerprint(self, path):
+        path_stat = os.stat(os.path.join(self.root, self._converter.get_hashed_pathname(path)))
+        return f'{path_stat.st_size}:{path_stat.st_mtime_ns}'
+
     def ios_open_raw(self, path, mode):
         return open(os.path.join(self.root, path), mode)
 
@@ -278,10 +553,10 @@ class IosDeviceFilesystem(DeviceFilesystem, IosDeviceFilesystemBase):
         return self._settings.is_locked()
 
     def dirname(self, path):
-        raise NotImplementedError
+        return _split_path(path)[0]
 
     def path_to_direntry(self, path):
-        raise NotImplementedError
+        return self._converter.path_to_direntry(path)
 
 
 class IosZippedDeviceFilesystem(DeviceFilesystem, IosDeviceFilesystemBase):
@@ -318,26 +593,33 @@ class IosZippedDeviceFilesystem(DeviceFilesystem, IosDeviceFilesystemBase):
         # to be able to open the zipfile
         self.root = root
 
-        # keep a reference to the tempfile in the object
-        self.temp_manifest = tempfile.NamedTemporaryFile(mode='w+b')
-        self.temp_settings = tempfile.NamedTemporaryFile(mode='w+b')
+        # The archive stays open, with its directory read, for the life of the filesystem.
+        self._zip = zipaccess.acquire(root)
 
-        with zipfile.ZipFile(self.root) as zp:
-            # get the main directory contained in the .zip container file
-            main_dir = self.get_main_dir(zp)
-
-            with zp.open(os.path.join(main_dir.name, 'Manifest.db')) as zf:
-                self.temp_manifest.write(zf.read())
+        # keep a reference to the tempfile in the object
+        self.temp_settings = self._zip.copy('_rime_settings.db')
 
-            with zp.open(os.path.join(main_dir.name, '_rime_settings.db')) as zf:
-                self.temp_settings.write(zf.read())
+        # Likewise for the private copies behind writable connections.
+        self._writable_copies = []
 
-        self.manifest = sqlite3_connect_with_regex_support(self.temp_manifest.name, read_only=True)
+        self.manifest = sqlite3_connect_with_regex_support(self._zip.extract('Manifest.db'), read_only=True)
         self.file_table = Table('Files')
 
         settings_dir, settings_file = os.path.split(self.temp_settings.name)
         self._settings = DeviceSettings(settings_dir, settings_file)
-        self._converter = _IosManifest(self.manifest)
+        self._converter = _IosManifest(self.manifest, self._manifest_tree_cache)
+
+    def _manifest_tree_cache(self):
+        if not self.cache_path:
+            return None
+
+        # The manifest is extracted afresh for each run, so it is identified by its checksum in the archive.
+        info = self._zip.getinfo('Manifest.db')
+        return os.path.join(self.cache_path, MANIFEST_TREE_DB), f'{info.CRC:08x}:{info.file_size}'
+
+    def __del__(self):
+        if zip_access := getattr(self, '_zip', None):
+            zip_access.release()
 
     @classmethod
     def is_device_filesystem(cls, path) -> bool:
@@ -360,35 +642,22 @@ class IosZippedDeviceFilesystem(DeviceFilesystem, IosDeviceFilesystemBase):
     def is_subset_filesystem(self) -> bool:
         return self._settings.is_subset_fs()
 
-    def scandir(self, path) -> list[str]:
+    def scandir(self, path) -> list[DirEntry]:
         return self._converter.scandir(path)
 
     def exists(self, path) -> bool:
-
-        real_path = self._converter.get_hashed_pathname(path)
-
-        # open the zipfile stored in `self.root` and find out if it
-        # contains the `real_path
-        with zipfile.ZipFile(self.root) as zp:
-            # get the main directory contained in the .zip container file
-            main_dir = self.get_main_dir(zp)
-            return zipfile.Path(zp, os.path.join(main_dir.name, real_path)).exists()
+        return self._zip.exists(self._converter.get_hashed_pathname(path))
 
     def getsize(self, path) -> int:
-        with zipfile.ZipFile(self.root) as zp:
-            # get the main directory contained in the .zip container file
-            main_dir = self.get_main_dir(zp)
-            return zp.getinfo(os.path.join(main_dir, self._converter.get_hashed_pathname(path))).file_size
+        return self._zip.getsize(self._converter.get_hashed_pathname(path))
+
+    def fingerprint(self, path):
+        info = self._zip.getinfo(self._converter.get_hashed_pathname(path))
+        return f'{info.CRC:08x}:{info.file_size}'
 
     def ios_open_raw(self, path, mode):
         # TODO: mode
-        tmp_copy = tempfile.NamedTemporaryFile(mode='w+b')
-        with zipfile.ZipFile(self.root) as zp:
-            # get the main directory contained in the .zip container file
-            main_dir = self.get_main_dir(zp)
-            with zp.open(os.path.join(main_dir.name, path)) as zf:
-                tmp_copy.write(zf.read())
-        return tmp_copy
+        return self._zip.open(path)
 
     def open(self, path):
         return self.ios_open_raw(self._converter.get_hashed_pathname(path), 'rb')
@@ -397,16 +666,19 @@ class IosZippedDeviceFilesystem(DeviceFilesystem, IosDeviceFilesystemBase):
         raise NotImplementedError
 
     def sqlite3_connect(self, path, read_only=True):
-        tmp_copy = tempfile.NamedTemporaryFile(mode='w+b')
+        hashed_pathname = self._converter.get_hashed_pathname(path)
 
-        with zipfile.ZipFile(self.root) as zp:
-            # get the main directory contained in the .zip container file
-            main_dir = self.get_main_dir(zp)
-            with zp.open(os.path.join(main_dir.name, self._converter.get_hashed_pathname(path))) as zf:
-                tmp_copy.write(zf.read())
+        if read_only:
+            # Read-only connections share one extracted copy of the database.
+            db_filename = self._zip.extract(hashed_pathname)
+        else:
+            # Writes go to a private copy, kept for the life of the filesystem.
+            tmp_copy = self._zip.copy(hashed_pathname)
+            self._writable_copies.append(tmp_copy)
+            db_filename = tmp_copy.name
 
-        log.debug(f"iOS connecting to {tmp_copy.name}")
-        return sqlite3_connect_with_regex_support(tmp_copy.name, read_only=read_only)
+        log.debug(f"iOS connecting to {db_filename}")
+        return sqlite3_connect_with_regex_support(db_filename, read_only=read_only)
 
     def sqlite3_create(self, path):
         raise NotImplementedError
@@ -426,10 +698,10 @@ class IosZippedDeviceFilesystem(DeviceFilesystem, IosDeviceFilesystemBase):
         return self._settings.is_locked()
 
     def dirname(self, path):
-        raise NotImplementedError
+        return _split_path(path)[0]
 
     def path_to_direntry(self, path):
-        raise NotImplementedError
+        return self._converter.path_to_direntry(path)
 
 
 class IosEncryptedDeviceFilesystem(EncryptedDeviceFilesystem):
@@ -450,7 +722,7 @@ class IosEncryptedDeviceFilesystem(EncryptedDeviceFilesystem):
                 os.path.join(self.root,
                              self.decrypted_manifest_filename)
             )
-            self._converter = _IosManifest(self.manifest)
+            self._converter = _IosManifest(self.manifest, self._manifest_tree_cache)
         else:
             self._settings.set_encrypted(True)
             self.manifest = None
@@ -475,17 +747,22 @@ class IosEncryptedDeviceFilesystem(EncryptedDeviceFilesystem):
     def is_subset_filesystem(self) -> bool:
         return self._settings.is_subset_fs()
 
-    def scandir(self, path) -> list[str]:
-        return []
+    def scandir(self, path) -> list[DirEntry]:
+        if self._converter is None:
+            raise NotDecryptedError()
+
+        return self._converter.scandir(path)
 
     def listdir(self, path) -> list[str]:
         if self.manifest is None:
             raise NotDecryptedError()
 
-        query = Query.from_(self.file_table).select('fileID', 'relativePath')
-        query = query.where(self.file_table.relativePath == os.path.join(self.root, path))
-        fields = get_field_indices(query)
-        return [row[fields['relativePath']] for row in self.manifest.execute(str(query))]
+        # The manifest lists directories as well as files, so the direct children are the paths with no more slashes.
+        prefix_length = len(path.rstrip('/')) + 1
+        return [
+            name for name in (path_under[prefix_length:] for path_under in self._converter.paths_under(path))
+            if '/' not in name
+        ]
 
     def exists(self, path) -> bool:
         # If there is no _converter then there is no "Manifest-decrypted.db"
@@ -502,6 +779,13 @@ class IosEncryptedDeviceFilesystem(EncryptedDeviceFilesystem):
 
         return os.path.getsize(os.path.join(self.root, self._converter.get_hashed_pathname(path)))
 
+    def fingerprint(self, path):
+        if self._converter is None:
+            raise NotDecryptedError()
+
+        path_stat = os.stat(os.path.join(self.root, self._converter.get_hashed_pathname(path)))
+        return f'{path_stat.st_size}:{path_stat.st_mtime_ns}'
+
     def open(self, path):
         # TODO: Should cope with blobs in the manifest too
         if self._converter is None:
@@ -625,12 +909,18 @@ class IosEncryptedDeviceFilesystem(EncryptedDeviceFilesystem):
             self._decrypt_backup()
 
         self.manifest = sqlite3_connect_with_regex_support(decrypted_manifest_path)
-        self._converter = _IosManifest(self.manifest)
+        self._converter = _IosManifest(self.manifest, self._manifest_tree_cache)
 
         return True
 
+    def _manifest_tree_cache(self):
+        return _manifest_tree_cache(self, os.path.join(self.root, self.decrypted_manifest_filename))
+
     def dirname(self, path):
-        raise NotImplementedError
+        return _split_path(path)[0]
 
     def path_to_direntry(self, path):
-        raise NotImplementedError
+        if self._converter is None:
+            raise NotDecryptedError()
+
+        return self._converter.path_to_direntry(path)
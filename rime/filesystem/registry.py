@@ -2,6 +2,7 @@ import os
 import re
 from logging import getLogger
 import shutil
+import stat
 
 from .android import AndroidDeviceFilesystem, AndroidZippedDeviceFilesystem
 from .devicefilesystem import DeviceFilesystem
@@ -27,43 +28,118 @@ class FilesystemRegistry:
     Maintains a registry of filesystems at 'base_path'.
 
     Filesystems are distinguished by a key, which is the name of the directory they're in under base_path.
+
+    Data derived from a filesystem, such as search indexes, may be kept in a directory named after its key under
+    cache_path.
+
+    rescan() probes only the entries under base_path which are new or have changed since they were last probed, and
+    keeps the filesystem objects of the others. The cache directory of an entry which has changed is emptied.
     """
-    def __init__(self, base_path, passphrases):
+    def __init__(self, base_path, passphrases, cache_path=None):
         self.base_path = base_path
         self.passphrases = passphrases
-        self.filesystems = self._find_available_filesystems()  # maps key to FS object.
+        self.cache_path = cache_path
+        self.filesystems = {}  # maps key to FS object.
+        self._entry_stats = {}  # maps the name of each entry under base_path to its stat when it was last probed.
+        self.filesystems = self._find_available_filesystems()
 
     def __getitem__(self, key):
         return self.filesystems[key]
 
     def rescan(self):
+        old_keys = set(self.filesystems)
         self.filesystems = self._find_available_filesystems()
 
+        # Derived data for filesystems which have gone is now stale.
+        for key in old_keys - set(self.filesystems):
+            self._delete_cache(key)
+
+    def cache_path_for(self, key):
+        """
+        Return the directory for data derived from filesystem 'key', or None if there is no cache directory.
+        """
+        return os.path.join(self.cache_path, key) if self.cache_path else None
+
+    def _delete_cache(self, key):
+        cache_path = self.cache_path_for(key)
+        if cache_path:
+            shutil.rmtree(cache_path, ignore_errors=True)
+
+    def _is_unchanged(self, filename, entry_stat):
+        """
+        Is the entry 'filename' under base_path the same as when it was last probed?
+        """
+        previous = self._entry_stats.get(filename)
+        if previous is None:
+            return False
+
+        if stat.S_ISDIR(entry_stat.st_mode) and filename in self.filesystems:
+            # Writes inside a device's directory, such as to its settings, change the directory's modification time
+            # without changing the device.
+            return (previous.st_dev, previous.st_ino) == (entry_stat.st_dev, entry_stat.st_ino)
+
+        return (
+            (previous.st_dev, previous.st_ino, previous.st_mtime_ns, previous.st_size)
+            == (entry_stat.st_dev, entry_stat.st_ino, entry_stat.st_mtime_ns, entry_stat.st_size)
+        )
+
+    def _probe(self, filename, path):
+        """
+        Return a filesystem for the entry 'filename' at 'path', or None if it isn't a filesystem RIME can manage.
+        """
+        for fs_cls in FILESYSTEM_TYPES:
+            if fs_cls.is_device_filesystem(path):
+                fs = fs_cls(filename, path)
+                fs.cache_path = self.cache_path_for(filename)
+
+                # If the FileSystem is encrypted and there is
+                # a passphrase provided as part of the YAML configuration
+                # (probably in `rime_settings.yaml`) then decrypt it
+                if (('Encrypted' in fs_cls.__name__)
+                        and self.passphrases
+                        and (filename in self.passphrases)):
+                    fs.decrypt(self.passphrases[filename])
+
+                return fs
+
+        return None
+
     def _find_available_filesystems(self):
         """
-        Return a mapping of key -> filesystem type for each valid filesystem under base_path.
+        Return a mapping of key -> filesystem type for each valid filesystem under base_path, probing only entries
+        which are new or have changed.
         """
         filesystems = {}
+        entry_stats = {}
 
         try:
             for filename in os.listdir(self.base_path):
                 path = os.path.join(self.base_path, filename)
 
-                for fs_cls in FILESYSTEM_TYPES:
-                    if fs_cls.is_device_filesystem(path):
-                        filesystems[filename] = fs_cls(filename, path)
+                try:
+                    entry_stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+
+                if self._is_unchanged(filename, entry_stat):
+                    entry_stats[filename] = self._entry_stats[filename]
+                    if filename in self.filesystems:
+                        filesystems[filename] = self.filesystems[filename]
+                    continue
+
+                if filename in self._entry_stats:
+                    # The entry has changed, so data derived from what it held before is stale.
+                    self._delete_cache(filename)
 
-                        # If the FileSystem is encrypted and there is
-                        # a passphrase provided as part of the YAML configuration
-                        # (probably in `rime_settings.yaml`) then decrypt it
-                        if (('Encrypted' in fs_cls.__name__)
-                                and self.passphrases
-                                and (filename in self.passphrases)):
-                            filesystems[filename].decrypt(self.passphrases[filename])
+                entry_stats[filename] = entry_stat
+                fs = self._probe(filename, path)
+                if fs is not None:
+                    filesystems[filename] = fs
 
         except FileNotFoundError:
             log.warning(f"Could not find filesystem directory: {self.base_path}")
 
+        self._entry_stats = entry_stats
         return filesystems
 
     def create_empty_subset_of(self, fs: DeviceFilesystem, key: str, locked: bool = False) -> DeviceFilesystem:
@@ -79,7 +155,9 @@ class FilesystemRegistry:
             raise ValueError(f"Invalid device ID: {key}")
 
         self.filesystems[key] = fs.__class__.create(key, path, template=fs)
+        self.filesystems[key].cache_path = self.cache_path_for(key)
         self.filesystems[key].lock(locked)
+        self._entry_stats[key] = os.stat(path)
 
         return self[key]
 
@@ -92,3 +170,5 @@ class FilesystemRegistry:
 
         shutil.rmtree(os.path.join(self.base_path, key))
         del self.filesystems[key]
+        self._entry_stats.pop(key, None)
+        self._delete_cache(key)
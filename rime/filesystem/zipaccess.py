@@ -0,0 +1,288 @@
+# This software is released under the terms of the GNU GENERAL PUBLIC LICENSE.
+# See LICENSE.txt for full details.
+# Copyright 2023 Telemarq Ltd
+
+"""
+Read access to the members of a zip archive which is kept open for the life of a filesystem.
+
+The central directory is read once. Members stored without compression are read directly from the archive, and can
+be seeked in; compressed members are decompressed as they are read. SQLite needs a real file, so databases are
+extracted once into a temporary directory and shared by every connection to them.
+
+acquire() shares one ZipAccess, and so one set of extracted databases, between every filesystem using the same
+unchanged archive, such as the filesystems created for it by successive registry rescans.
+"""
+import io
+import os
+import shutil
+import stat
+import struct
+import tempfile
+import threading
+import time
+import zipfile
+
+from .ensuredir import ensuredir
+
+
+LOCAL_FILE_HEADER_SIGNATURE = b'PK\x03\x04'
+LOCAL_FILE_HEADER_LENGTH = 30
+
+READ_BUFFER_SIZE = 256 * 1024
+
+SQLITE_JOURNAL_SUFFIXES = ('-wal', '-journal')
+
+DIRECTORY_MODE = stat.S_IFDIR | 0o755
+FILE_MODE = stat.S_IFREG | 0o644
+
+_shared_lock = threading.Lock()
+_shared = {}  # (archive path, size, mtime, main_dir) -> ZipAccess
+
+
+def acquire(archive_path, main_dir=True) -> 'ZipAccess':
+    """
+    Return the ZipAccess for 'archive_path', sharing it with other users of the same archive. Call release() on it
+    when it is no longer needed.
+    """
+    archive_path = os.path.realpath(archive_path)
+    archive_stat = os.stat(archive_path)
+    key = (archive_path, archive_stat.st_size, archive_stat.st_mtime, main_dir)
+
+    with _shared_lock:
+        zip_access = _shared.get(key)
+        if zip_access is None:
+            zip_access = _shared[key] = ZipAccess(archive_path, main_dir)
+            zip_access._shared_key = key
+
+        zip_access._references += 1
+        return zip_access
+
+
+class _StoredMemberReader(io.RawIOBase):
+    """
+    Reads a member stored without compression directly from the archive, through its own file handle.
+    """
+    def __init__(self, archive_path, offset, length):
+        super().__init__()
+        self._file = open(archive_path, 'rb')
+        self._offset = offset
+        self._length = length
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self._length - self._position)
+        if size <= 0:
+            return 0
+
+        self._file.seek(self._offset + self._position)
+        read = self._file.readinto(memoryview(buffer)[:size])
+        self._position += read
+        return read
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._length
+
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+
+        self._position = offset
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+class ZipAccess:
+    """
+    A zip archive at 'archive_path', open for reading.
+
+    Names are relative to the archive's single top-level directory if 'main_dir' is true, and to the root of the
+    archive otherwise.
+    """
+    def __init__(self, archive_path, main_dir=True):
+        self.archive_path = archive_path
+        self._zip = zipfile.ZipFile(archive_path)
+        self._lock = threading.Lock()
+        self._extract_dir = None
+        self._extracted = {}  # (CRC, size, name) -> pathname of the extracted member
+        self._extracting = {}  # (CRC, size, name) -> lock held while the member is extracted
+        self._shared_key = None
+        self._references = 0
+
+        infos = self._zip.infolist()
+        self.main_dir = ''
+        if main_dir:
+            self.main_dir, = {info.filename.split('/', 1)[0] for info in infos}
+
+        prefix = f'{self.main_dir}/' if self.main_dir else ''
+        self._infos = {}  # name -> ZipInfo
+        self._directories = {'': None}  # name -> ZipInfo, or None if the archive doesn't list the directory
+        for info in infos:
+            if not info.filename.startswith(prefix):
+                continue
+
+            name = info.filename[len(prefix):].rstrip('/')
+            if not name:
+                continue
+
+            if info.is_dir():
+                self._directories[name] = info
+            else:
+                self._infos[name] = info
+
+            # Archives need not list directories, so add the parents of every member.
+            while '/' in name:
+                name = name.rsplit('/', 1)[0]
+                self._directories.setdefault(name, None)
+
+        self._children = {name: [] for name in self._directories}  # directory name -> names of its entries
+        for name in (*self._infos, *self._directories):
+            if name:
+                self._children[_dirname(name)].append(name)
+
+    def getinfo(self, name) -> zipfile.ZipInfo:
+        """
+        Return the ZipInfo of the member 'name', raising FileNotFoundError if there is none.
+        """
+        info = self._infos.get(name)
+        if info is None:
+            raise FileNotFoundError(name)
+
+        return info
+
+    def exists(self, name) -> bool:
+        return name in self._infos or name.rstrip('/') in self._directories
+
+    def listdir(self, name) -> list[str]:
+        """
+        Return the names, relative to the archive, of the entries of directory 'name'.
+        """
+        children = self._children.get(name.strip('/'))
+        if children is None:
+            raise FileNotFoundError(name)
+
+        return children
+
+    def stat(self, name) -> os.stat_result:
+        name = name.strip('/')
+        if name in self._directories:
+            info = self._directories[name]
+            mode, size = DIRECTORY_MODE, 0
+        else:
+            info = self.getinfo(name)
+            # Archives created on Unix keep the mode in the high bits of the external attributes, though not always
+            # with the file type.
+            mode, size = (info.external_attr >> 16) or FILE_MODE, info.file_size
+            if not stat.S_IFMT(mode):
+                mode |= stat.S_IFREG
+
+        mtime = time.mktime(info.date_time + (0, 0, -1)) if info else 0
+        return os.stat_result((mode, 0, 0, 0, 0, 0, size, mtime, mtime, mtime))
+
+    def getsize(self, name) -> int:
+        return self.getinfo(name).file_size
+
+    def _data_offset(self, info):
+        with open(self.archive_path, 'rb') as f:
+            f.seek(info.header_offset)
+            header = f.read(LOCAL_FILE_HEADER_LENGTH)
+
+        if header[:4] != LOCAL_FILE_HEADER_SIGNATURE:
+            raise zipfile.BadZipFile(f"Bad local file header for {info.filename}")
+
+        # The local header's name and extra field lengths may differ from those in the central directory.
+        name_length, extra_length = struct.unpack('<HH', header[26:30])
+        return info.header_offset + LOCAL_FILE_HEADER_LENGTH + name_length + extra_length
+
+    def open(self, name):
+        """
+        Return a binary file-like object which reads the member 'name' as it is consumed.
+        """
+        info = self.getinfo(name)
+
+        # Bit 0 of the flags marks an encrypted member.
+        if info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 0x1:
+            return io.BufferedReader(_StoredMemberReader(self.archive_path, self._data_offset(info), info.file_size),
+                                     READ_BUFFER_SIZE)
+
+        # ZipFile serialises reads from members of the same archive, so one handle serves every thread.
+        return self._zip.open(info)
+
+    def extract(self, name) -> str:
+        """
+        Return the pathname of a copy of the member 'name' on disk. Each member is extracted once, and the copy is
+        kept, keyed by the member's CRC, until the archive is closed.
+
+        Any SQLite journal stored alongside the member is extracted alongside the copy.
+        """
+        info = self.getinfo(name)
+        key = (info.CRC, info.file_size, name)
+
+        with self._lock:
+            if self._extract_dir is None:
+                self._extract_dir = tempfile.TemporaryDirectory(prefix='rime-zip-')
+
+            extract_lock = self._extracting.setdefault(key, threading.Lock())
+
+        with extract_lock:
+            if key not in self._extracted:
+                pathname = os.path.join(self._extract_dir.name, f'{info.CRC:08x}-{info.file_size}', name)
+                ensuredir(pathname)
+                for suffix in ('', *SQLITE_JOURNAL_SUFFIXES):
+                    if suffix and name + suffix not in self._infos:
+                        continue
+
+                    with self.open(name + suffix) as src, open(pathname + suffix, 'wb') as dst:
+                        shutil.copyfileobj(src, dst, READ_BUFFER_SIZE)
+
+                self._extracted[key] = pathname
+
+            return self._extracted[key]
+
+    def copy(self, name):
+        """
+        Return a named temporary file holding a private, writable copy of the member 'name'.
+        """
+        tmp_copy = tempfile.NamedTemporaryFile(mode='w+b')
+        with self.open(name) as src:
+            shutil.copyfileobj(src, tmp_copy, READ_BUFFER_SIZE)
+
+        tmp_copy.flush()
+        tmp_copy.seek(0)
+        return tmp_copy
+
+    def release(self):
+        """
+        Give up a reference obtained from acquire(), closing the archive when there are none left.
+        """
+        with _shared_lock:
+            self._references -= 1
+            if self._references > 0:
+                return
+
+            if _shared.get(self._shared_key) is self:
+                del _shared[self._shared_key]
+
+        self.close()
+
+    def close(self):
+        self._zip.close()
+        if self._extract_dir is not None:
+            self._extract_dir.cleanup()
+
+
+def _dirname(name):
+    return name.rsplit('/', 1)[0] if '/' in name else ''
@@ -38,26 +38,100 @@ class EventsFilter:
     type_names: set[str] | None = None
     provider_names: set[str] | None = None
     generic_event_category_regex: Pattern | _AlwaysMatchesPattern = TheAlwaysMatchesPattern
+    text_query: str | None = None
+    # The result of looking up text_query in the text index: maps (device ID, provider name) to the IDs (as strings)
+    # of the only events of that provider which can match, or to None if the provider hasn't been indexed yet. None if
+    # there is no text query.
+    event_ids: dict[tuple[str, str], set[str] | None] | None = None
+    # Matches the text of events for providers which haven't been indexed yet. None if there is no text query.
+    text_regex: Pattern | None = None
 
     def accepts_type(self, type_name):
         return self.type_names is None or type_name in self.type_names
 
+    def accepts_provider(self, provider_name):
+        return self.provider_names is None or provider_name in self.provider_names
+
+    def participant_local_ids(self, device_id, provider_name):
+        """
+        Return the local IDs of the contacts of ``provider_name`` on ``device_id`` of which an event must involve
+        at least one, or None if participants don't restrict that provider's events.
+
+        Providers use this to restrict their queries. An empty set means that no event of the provider can match.
+        The result is None if the filter names one of the device's special contacts (such as the device operator),
+        as those can't be expressed in terms of a provider's own contacts.
+        """
+        if not self.participant_ids:
+            return None
+
+        local_ids = set()
+        for participant_id in self.participant_ids:
+            if participant_id.device_id != device_id:
+                continue
+
+            if participant_id.provider_name == 'device':
+                return None
+
+            if participant_id.provider_name == provider_name:
+                local_ids.add(participant_id.local_id)
+
+        return local_ids
+
+    def event_local_ids(self, device_id, provider_name):
+        """
+        Return the IDs (as strings) of the only events of ``provider_name`` on ``device_id`` which can match, or None
+        if the events are not restricted by ID.
+
+        If there is a text query but the provider hasn't been indexed, the result is None and the text of its events
+        must match ``text_regex``.
+        """
+        if self.event_ids is None:
+            return None
+
+        return self.event_ids.get((device_id, provider_name), set())
+
     @classmethod
     def empty(cls):
         return cls()
 
-    def apply(self, events):
-        return list(filter(self.matches, events))
-
-    def matches(self, event):
+    def cache_key(self):
+        """
+        Return a hashable value which is equal for filters which select the same events.
+        """
+        return (
+            tuple(sorted(f'{p.device_id}:{p.provider_name}:{p.local_id}' for p in self.participant_ids or ())),
+            self.timestamp_start,
+            self.timestamp_end,
+            tuple(sorted(self.type_names)) if self.type_names is not None else None,
+            tuple(sorted(self.provider_names)) if self.provider_names is not None else None,
+            getattr(self.generic_event_category_regex, 'pattern', None),
+            self.text_query,
+        )
+
+    def apply(self, device_id, events):
+        return [event for event in events if self.matches(device_id, event)]
+
+    def matches(self, device_id, event):
+        """
+        Return whether 'event', from the device with ID 'device_id', matches the filter.
+        """
         assert event.id_
+        assert self.text_query is None or self.event_ids is not None, "text_query has not been looked up"
 
-        if self.provider_names is not None and event.provider.NAME not in self.provider_names:
+        if not self.accepts_provider(event.provider.NAME):
             return False
 
         if not self.accepts_type(event.__class__.__name__):
             return False
 
+        if self.event_ids is not None:
+            event_local_ids = self.event_local_ids(device_id, event.provider.NAME)
+            if event_local_ids is None:
+                if not self.text_regex.search(getattr(event, 'text', None) or ''):
+                    return False
+            elif str(event.id_) not in event_local_ids:
+                return False
+
         if self.participant_ids:
             # Create global contact IDs for comparison and include group chat participants.
 
@@ -86,15 +160,59 @@ class EventsFilter:
 
 @dataclass
 class ContactsFilter:
+    """
+    Selects contacts whose name, phone number and email address match the corresponding regexes from their start,
+    as re.match() does. Any one of a contact's phone numbers or email addresses may match. A contact without a name,
+    phone number or email address does not match a regex for it.
+    """
     name_regex: Pattern | _AlwaysMatchesPattern
+    phone_regex: Pattern | _AlwaysMatchesPattern = TheAlwaysMatchesPattern
+    email_regex: Pattern | _AlwaysMatchesPattern = TheAlwaysMatchesPattern
 
     @classmethod
     def empty(cls):
         return cls(TheAlwaysMatchesPattern)
 
     def is_empty(self):
-        return not self.name_regex
+        return not self.regexes()
+
+    def regexes(self):
+        """
+        Return a dict mapping the Contact fields which are restricted ('name', 'phone' and 'email') to their regexes.
+        Providers use this to restrict their queries; apply() checks the results.
+        """
+        return {
+            field: regex
+            for field, regex in (('name', self.name_regex), ('phone', self.phone_regex), ('email', self.email_regex))
+            if regex is not TheAlwaysMatchesPattern
+        }
+
+    def cache_key(self):
+        """
+        Return a hashable value which is equal for filters which select the same contacts.
+        """
+        return tuple(
+            getattr(regex, 'pattern', None) for regex in (self.name_regex, self.phone_regex, self.email_regex)
+        )
 
     def apply(self, contacts):
-        # TODO
-        return contacts
+        regexes = self.regexes()
+        if not regexes:
+            return contacts
+
+        return [contact for contact in contacts if self._matches(regexes, contact)]
+
+    @staticmethod
+    def _matches(regexes, contact):
+        for field, regex in regexes.items():
+            if field == 'name':
+                values = (contact.name.full_name(),) if contact.name else ()
+            elif field == 'phone':
+                values = contact.all_phones()
+            else:
+                values = contact.all_emails()
+
+            if not any(value and regex.match(value) for value in values):
+                return False
+
+        return True
@@ -6,11 +6,17 @@
 Support for GraphQL querying in RIME.
 """
 import asyncio
+import base64
+import dataclasses
+import heapq
+import itertools
 import re
+import sys
 import traceback
+from collections import Counter
 from dataclasses import dataclass
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from pathlib import Path
 
 from ariadne import ObjectType, QueryType, InterfaceType, MutationType, \
@@ -19,8 +25,12 @@ from ariadne import ObjectType, QueryType, InterfaceType, MutationType, \
 
 from .filter import EventsFilter, ContactsFilter, ProvidersFilter, TheAlwaysMatchesPattern, GlobalContactId
 from .event import MessageEvent, MediaEvent
+from .loader import Loaders
 from .mergedcontact import merge_contacts
+from .resultcache import approximate_size
+from .textindex import text_regex
 from .anonymise import Anonymiser
+from . import eventstats
 from .subset import DeviceSubsetter, ProviderSubsetter, SubsetOptions, SubsetFillOption
 from .device import Device
 from .provider import Provider
@@ -31,6 +41,7 @@ from .event import Event, MessageSession
 class QueryContext:
     def __init__(self, rime):
         self.rime = rime
+        self.loaders = Loaders()
 
 
 # Convert DateTime objects to ISO strings. (ref https://ariadnegraphql.org/docs/scalars)
@@ -76,17 +87,22 @@ def _make_events_filter(events_filter):
             timestamp_end=events_filter.get('timestampEnd'),
             type_names=set(type_names) if type_names is not None else None,
             provider_names=set(provider_names) if provider_names is not None else None,
+            text_query=events_filter.get('textQuery') or None,
         )
 
     return EventsFilter.empty()
 
 
+def _compile_regex(regex_str):
+    return re.compile(regex_str) if regex_str else TheAlwaysMatchesPattern
+
+
 def _make_contacts_filter(contacts_filter):
     if contacts_filter:
-        name_regex_str = contacts_filter.get('nameRegex')
-
         return ContactsFilter(
-            name_regex=re.compile(name_regex_str) if name_regex_str else TheAlwaysMatchesPattern,
+            name_regex=_compile_regex(contacts_filter.get('nameRegex')),
+            phone_regex=_compile_regex(contacts_filter.get('phoneRegex')),
+            email_regex=_compile_regex(contacts_filter.get('emailRegex')),
         )
 
     return ContactsFilter.empty()
@@ -105,6 +121,77 @@ def _make_providers_filter(providers_filter):
     return ProvidersFilter.empty()
 
 
+def _look_up_text_query(filter_obj, devices):
+    """
+    Return ``filter_obj`` with the events matching its text query, if it has one, looked up in the text indexes of
+    ``devices``.
+    """
+    if filter_obj.text_query is None:
+        return filter_obj
+
+    event_ids = {}
+    for device in devices:
+        matches = device.text_index.search(device, filter_obj.text_query, filter_obj.provider_names)
+        for provider_name, provider_event_ids in matches.items():
+            event_ids[(device.id_, provider_name)] = provider_event_ids
+
+    return dataclasses.replace(filter_obj, event_ids=event_ids, text_regex=text_regex(filter_obj.text_query))
+
+
+def _iter_provider_events(device, provider, filter_obj, query_filter=None):
+    """
+    Yield the events of one provider on one device which match ``filter_obj``, in provider (timestamp) order.
+
+    ``query_filter``, if supplied, is passed to the provider instead of ``filter_obj``. It must be no narrower than
+    ``filter_obj``.
+    """
+    if not filter_obj.accepts_provider(provider.NAME) or filter_obj.event_local_ids(device.id_, provider.NAME) == set():
+        return
+
+    for event in provider.search_events(device, query_filter or filter_obj):
+        if not filter_obj.matches(device.id_, event):
+            continue
+
+        # Set session global IDs here as we go, and update the event session ID.
+        if isinstance(event, MessageEvent) and event.session is not None:
+            event.session.global_id = f'{device.id_}:{provider.NAME}:{event.session.local_id}'
+            event.session_id = event.session.global_id
+
+        # Decorate events with the device ID as resolvers below this one need it.
+        event.device_id = device.id_
+
+        yield event
+
+
+def _prefetch(executor, iterable, batch_size, first_batch_size=None):
+    """
+    Yield the items of ``iterable``, fetching them in batches on ``executor``.
+
+    The next batch is fetched while the caller consumes the current one. Batches start at ``first_batch_size`` items
+    and double up to ``batch_size``, so short reads don't pay for a full batch. Work is submitted one batch at a time,
+    so any number of streams can share an executor without one stream's worker waiting on another's consumer.
+    """
+    iterator = iter(iterable)
+    size = min(first_batch_size or batch_size, batch_size)
+
+    def next_batch(size):
+        return list(itertools.islice(iterator, size))
+
+    future = executor.submit(next_batch, size)
+    try:
+        while True:
+            batch = future.result()
+            if len(batch) < size:
+                yield from batch
+                return
+
+            size = min(size * 2, batch_size)
+            future = executor.submit(next_batch, size)
+            yield from batch
+    finally:
+        future.cancel()
+
+
 @dataclass
 class EventsByProvider:
     device: Device
@@ -113,48 +200,226 @@ class EventsByProvider:
     message_sessions: list[MessageSession]
 
     @classmethod
-    def for_devices(cls, devices, filter_obj):
-        for device in devices:
-            for provider in device.providers.values():
-                provider_events = filter_obj.apply(provider.search_events(device, filter_obj))
-                provider_message_sessions = []
+    def for_devices(cls, devices, filter_obj, executor=None):
+        """
+        Yield an EventsByProvider for each provider on each of ``devices``.
+
+        If ``executor`` is supplied, providers are searched on it in parallel.
+        """
+        def search(device_provider):
+            device, provider = device_provider
+            provider_events = list(_iter_provider_events(device, provider, filter_obj))
+            provider_message_sessions = [
+                event.session for event in provider_events
+                if isinstance(event, MessageEvent) and event.session is not None
+            ]
+
+            return cls(device, provider, provider_events, provider_message_sessions)
+
+        device_providers = [(device, provider) for device in devices for provider in device.providers.values()]
+
+        if executor is None:
+            yield from map(search, device_providers)
+        else:
+            yield from executor.map(search, device_providers)
+
+
+def _event_time(event):
+    # Order by POSIX time rather than by naive local time, which repeats when the clocks go back.
+    return event.timestamp.timestamp()
+
+
+def _event_order_key(event):
+    return (_event_time(event), event.device_id)
+
+
+@dataclass(frozen=True)
+class EventsCursor:
+    """
+    Position in a timestamp-ordered stream of events: the time of the last event returned, and the number of events
+    at exactly that time which have been returned so far.
+    """
+    time: float
+    offset: int
+
+    # Providers convert timestamps to and from their own representations, which may lose precision, so ask them for
+    # a little more than we need and discard the excess.
+    QUERY_SLACK = timedelta(seconds=1)
+
+    @classmethod
+    def decode(cls, cursor_str):
+        try:
+            time_str, offset_str = base64.urlsafe_b64decode(cursor_str.encode('ascii')).decode('ascii').split('|')
+            return cls(time=float(time_str), offset=int(offset_str))
+        except ValueError:
+            raise ValueError(f'Invalid cursor: {cursor_str}')
+
+    def encode(self):
+        return base64.urlsafe_b64encode(f'{self.time!r}|{self.offset}'.encode('ascii')).decode('ascii')
+
+    @classmethod
+    def after_page(cls, page, previous=None):
+        """
+        Return the cursor following ``page``, a non-empty list of events which was retrieved after ``previous``.
+        """
+        time = _event_time(page[-1])
+        offset = 0
+        for event in reversed(page):
+            if _event_time(event) != time:
+                break
+            offset += 1
+        else:
+            # Every event on this page has the same time, so include any at that time on previous pages.
+            if previous is not None and previous.time == time:
+                offset += previous.offset
+
+        return cls(time=time, offset=offset)
+
+    def narrow(self, filter_obj):
+        """
+        Return ``filter_obj`` restricted so that providers skip most events before this cursor.
+        """
+        start = datetime.fromtimestamp(self.time) - self.QUERY_SLACK
+        if filter_obj.timestamp_start is not None and filter_obj.timestamp_start > start:
+            return filter_obj
+
+        return dataclasses.replace(filter_obj, timestamp_start=start)
+
+    def skip(self, events):
+        """
+        Yield the events from the ordered iterable ``events`` which follow this cursor.
+        """
+        to_skip = self.offset
+        for event in events:
+            time = _event_time(event)
+            if time < self.time:
+                continue
+            elif time == self.time and to_skip > 0:
+                to_skip -= 1
+                continue
 
-                # Set session global IDs here as we add them, and update the event session ID.
-                for event in provider_events:
-                    if isinstance(event, MessageEvent) and event.session is not None:
-                        event.session.global_id = f'{device.id_}:{provider.NAME}:{event.session.local_id}'
-                        event.session_id = event.session.global_id
-                        provider_message_sessions.append(event.session)
+            yield event
 
-                # Decorate provider_events with the device ID as resolvers below this one need it.
-                for event in provider_events:
-                    event.device_id = device.id_
 
-                yield cls(device, provider, provider_events, provider_message_sessions)
+def _result_cache_key(name, devices, filter_obj, *args):
+    return (name, tuple(sorted(device.id_ for device in devices)), filter_obj.cache_key(), *args)
+
+
+def _text_index_state(devices, filter_obj):
+    """
+    Return a hashable value which changes when a provider searched by ``filter_obj``'s text query finishes being
+    indexed. Until then its events are matched against the query's regex instead, so results cached before that are
+    keyed by this to stop them being used afterwards.
+    """
+    if filter_obj.text_query is None:
+        return None
+
+    return tuple(
+        (device.id_, tuple(sorted(device.text_index.indexed_providers(device, filter_obj.provider_names))))
+        for device in sorted(devices, key=lambda device: device.id_)
+    )
 
 
 @query_resolver.field('events')
-def resolve_events(parent, info, deviceIds, filter=None):
+def resolve_events(parent, info, deviceIds, filter=None, first=None, after=None):
     rime = info.context.rime
-    filter_obj = _make_events_filter(filter)
     devices = rime.devices_for_ids(deviceIds)
+    filter_obj = _make_events_filter(filter)
+
+    result = rime.result_cache.get_or_compute(
+        _result_cache_key('events', devices, filter_obj, first, after, _text_index_state(devices, filter_obj)),
+        lambda: _events_page(rime, devices, filter_obj, first, after),
+        lambda result: approximate_size(result['events'])
+    )
+
+    return result
 
-    events = []
+
+def _events_page(rime, devices, filter_obj, first, after):
+    filter_obj = _look_up_text_query(filter_obj, devices)
+
+    cursor = EventsCursor.decode(after) if after else None
+    query_filter = cursor.narrow(filter_obj) if cursor else None
+
+    # Each provider returns its events in timestamp order, so merge them lazily rather than collecting and sorting
+    # everything. Providers are searched in parallel, each fetching a batch of events ahead of the merge.
     device_ids = set()
     providers = set()
-    message_sessions = set()
-    for ebp in EventsByProvider.for_devices(devices, filter_obj):
-        device_ids.add(ebp.device.id_)
-        providers.add(ebp.provider)
-        events.extend(ebp.events)
-        message_sessions.update(ebp.message_sessions)
+    provider_streams = []
+    for device in devices:
+        for provider in device.providers.values():
+            device_ids.add(device.id_)
+            providers.add(provider)
+            provider_streams.append(_prefetch(
+                rime.search_executor,
+                _iter_provider_events(device, provider, filter_obj, query_filter),
+                rime.search_batch_size,
+                first_batch_size=max(first, 0) + 1 if first is not None else None
+            ))
+
+    events = heapq.merge(*provider_streams, key=_event_order_key)
+    if cursor:
+        events = cursor.skip(events)
+
+    if first is None:
+        page = list(events)
+        has_next_page = False
+    else:
+        page = list(itertools.islice(events, max(first, 0)))
+        has_next_page = next(events, None) is not None
 
     device_ids = list(device_ids)
     device_ids.sort()
-    events.sort(key=lambda e: (e.timestamp, e.device_id))
 
-    return {'deviceIds': device_ids, 'providers': providers, 'events': events,
-            'messageSessions': message_sessions}
+    end_cursor = EventsCursor.after_page(page, cursor).encode() if page else after
+
+    return {'deviceIds': device_ids, 'providers': providers, 'events': page,
+            'pageInfo': {'endCursor': end_cursor, 'hasNextPage': has_next_page}}
+
+
+@query_resolver.field('eventStats')
+def resolve_event_stats(parent, info, deviceIds, groupBy, filter=None):
+    rime = info.context.rime
+    devices = rime.devices_for_ids(deviceIds)
+    filter_obj = _make_events_filter(filter)
+
+    return rime.result_cache.get_or_compute(
+        _result_cache_key('eventStats', devices, filter_obj, tuple(groupBy), _text_index_state(devices, filter_obj)),
+        lambda: _event_stats(rime, devices, filter_obj, groupBy),
+        lambda result: sum(sys.getsizeof(bucket) + sys.getsizeof(bucket['keys']) for bucket in result['buckets'])
+    )
+
+
+def _event_stats(rime, devices, filter_obj, groupBy):
+    filter_obj = _look_up_text_query(filter_obj, devices)
+
+    def count(device_provider):
+        device, provider = device_provider
+
+        if not filter_obj.accepts_provider(provider.NAME) \
+                or filter_obj.event_local_ids(device.id_, provider.NAME) == set():
+            return Counter()
+
+        counts = provider.count_events(device, filter_obj, groupBy)
+        if counts is None:
+            counts = eventstats.count_events(groupBy, device, provider,
+                                             _iter_provider_events(device, provider, filter_obj))
+
+        return counts
+
+    # Count each provider's events in parallel and combine the results.
+    device_providers = [(device, provider) for device in devices for provider in device.providers.values()]
+    totals = Counter()
+    for counts in rime.search_executor.map(count, device_providers):
+        totals.update(counts)
+
+    buckets = [
+        {'keys': list(keys), 'count': count}
+        for keys, count in sorted(totals.items(), key=lambda item: tuple(key or '' for key in item[0]))
+    ]
+
+    return {'deviceIds': sorted(device.id_ for device in devices), 'groupBy': groupBy, 'buckets': buckets,
+            'total': sum(totals.values())}
 
 
 events_result_resolver = ObjectType('EventsResult')
@@ -162,7 +427,12 @@ events_result_resolver = ObjectType('EventsResult')
 
 @events_result_resolver.field('messageSessions')
 def resolve_message_sessions(events_result, info):
-    return events_result['messageSessions']
+    return info.context.loaders.sessions(events_result['events'])
+
+
+@events_result_resolver.field('contacts')
+def resolve_events_result_contacts(events_result, info):
+    return info.context.loaders.contacts(events_result['events'])
 
 
 event_resolver = InterfaceType('Event')
@@ -237,6 +507,11 @@ def resolve_sender(event, info):
     return event.sender
 
 
+@message_event_resolver.field('senderId')
+def resolve_sender_id(event, info):
+    return info.context.loaders.global_id(event.sender) if event.sender is not None else None
+
+
 def _media_local_id_to_url(rime, device_id, provider_name, local_id):
     return f'{rime.media_prefix}{device_id}:{provider_name}:{local_id}'
 
@@ -263,6 +538,11 @@ def resolve_message_session_id(session, info):
     return session.global_id
 
 
+@message_session_resolver.field('participantIds')
+def resolve_message_session_participant_ids(session, info):
+    return [info.context.loaders.global_id(participant) for participant in session.participants]
+
+
 @message_session_resolver.field('providerName')
 def resolve_message_session_provider_name(session, info):
     return session.provider.NAME
@@ -368,6 +648,14 @@ def resolve_contacts(parent, info, deviceIds, filter=None):
     rime = info.context.rime
     devices = rime.devices_for_ids(deviceIds)
 
+    return rime.result_cache.get_or_compute(
+        _result_cache_key('contacts', devices, filter_obj),
+        lambda: _contacts_result(rime, devices, filter_obj),
+        lambda result: approximate_size(result.contacts) + approximate_size(result.mergedContacts)
+    )
+
+
+def _contacts_result(rime, devices, filter_obj):
     all_contacts = []
     for provider, contacts in _get_contacts_by_provider(rime, devices, filter_obj):
         all_contacts.extend(contacts)
@@ -380,7 +668,7 @@ def resolve_contacts(parent, info, deviceIds, filter=None):
 @contact_resolver.field('id')
 def resolve_contact_id(contact, info):
     # Convert the contact local ID into a device-global ID by prepending the provider name.
-    return GlobalContactId.make_global_id_str(contact)
+    return info.context.loaders.global_id(contact)
 
 
 @contact_resolver.field('deviceId')
@@ -413,6 +701,16 @@ def resolve_contact_phone(contact, info):
     return contact.phone
 
 
+@contact_resolver.field('emails')
+def resolve_contact_emails(contact, info):
+    return contact.all_emails()
+
+
+@contact_resolver.field('phones')
+def resolve_contact_phones(contact, info):
+    return contact.all_phones()
+
+
 merged_contact_resolver = ObjectType('MergedContact')
 
 
@@ -506,6 +804,7 @@ def _create_subset_populate_device(rime, opts: SubsetOptions, device, new_device
     May raise anything else if something goes wrong (e.g. while a particular provider is perfoming a subset).
     """
     device_subsetter = DeviceSubsetter(new_device.fs, opts)
+    events_filter_obj = _look_up_text_query(events_filter_obj, [device])
 
     # Find and remember the contacts subset.
     contacts_by_provider = {
@@ -516,7 +815,7 @@ def _create_subset_populate_device(rime, opts: SubsetOptions, device, new_device
 
     # Create the subset of events.
     unsubsetted_contact_providers = set(contacts_by_provider.keys())
-    for ebp in EventsByProvider.for_devices([device], events_filter_obj):
+    for ebp in EventsByProvider.for_devices([device], events_filter_obj, rime.search_executor):
         if ebp.provider.NAME in contacts_by_provider:
             unsubsetted_contact_providers.remove(ebp.provider.NAME)
             contacts_for_provider = contacts_by_provider[ebp.provider.NAME]
@@ -644,6 +943,9 @@ def resolve_set_device_properties(rime, info, deviceId, deviceProperties):
     if country_code := deviceProperties.get('countryCode'):
         device.country_code = country_code
 
+    # Results refer to devices by ID, and contacts are merged using the country code.
+    info.context.rime.result_cache.clear()
+
     return True
 
 
@@ -0,0 +1,62 @@
+# This software is released under the terms of the GNU GENERAL PUBLIC LICENSE.
+# See LICENSE.txt for full details.
+# Copyright 2023 Telemarq Ltd
+
+"""
+Per-request loaders for the GraphQL layer.
+
+A single response can refer to the same contact or session from thousands of events. EventsResult lists each
+distinct contact and session of a page once, and events and sessions refer to them by ID (senderId, sessionId and
+participantIds), so that a contact is serialised once per response rather than once per message.
+"""
+from .contact import Contact, GlobalContactId
+from .event import MessageEvent, MessageSession
+
+
+class Loaders:
+    """
+    Collects the distinct contacts and sessions of pages of events, for one request.
+    """
+    def __init__(self):
+        self._global_ids = {}  # id(contact) -> (contact, global ID). The contact is kept so its id() isn't reused.
+        self._pages = {}  # id(events) -> (events, sessions, contacts)
+
+    def global_id(self, contact: Contact) -> str:
+        entry = self._global_ids.get(id(contact))
+        if entry is None:
+            entry = self._global_ids[id(contact)] = (contact, GlobalContactId.make_global_id_str(contact))
+
+        return entry[1]
+
+    def _load_page(self, events):
+        entry = self._pages.get(id(events))
+        if entry is None:
+            sessions = {}
+            contacts = {}
+            for event in events:
+                if not isinstance(event, MessageEvent):
+                    continue
+
+                if event.sender is not None:
+                    contacts.setdefault(self.global_id(event.sender), event.sender)
+
+                if event.session is not None and event.session.global_id not in sessions:
+                    sessions[event.session.global_id] = event.session
+                    for participant in event.session.participants:
+                        contacts.setdefault(self.global_id(participant), participant)
+
+            entry = self._pages[id(events)] = (events, list(sessions.values()), list(contacts.values()))
+
+        return entry
+
+    def sessions(self, events) -> list[MessageSession]:
+        """
+        Return the distinct message sessions of 'events'.
+        """
+        return self._load_page(events)[1]
+
+    def contacts(self, events) -> list[Contact]:
+        """
+        Return the distinct senders and session participants of 'events'.
+        """
+        return self._load_page(events)[2]
@@ -2,7 +2,7 @@
 # See LICENSE.txt for full details.
 # Copyright 2023 Telemarq Ltd
 import hashlib
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 import phonenumbers
 
@@ -17,6 +17,8 @@ class MergedContact:
     name: Name | None = None
     phone: str | None = None
     email: str | None = None
+    phones: list[str] = field(default_factory=list)
+    emails: list[str] = field(default_factory=list)
 
 
 def _hash_contact_ids(contacts) -> str:
@@ -29,42 +31,90 @@ def _hash_contact_ids(contacts) -> str:
     return hasher.hexdigest()
 
 
+def _canonical_phone(phone, country_code):
+    """
+    Return 'phone' in E.164 format, or None if it can't be parsed.
+    """
+    try:
+        number = phonenumbers.parse(phone, country_code)
+    except phonenumbers.phonenumberutil.NumberParseException:
+        return None
+
+    return phonenumbers.format_number(number, phonenumbers.PhoneNumberFormat.E164)
+
+
+def _find(parents, index):
+    while parents[index] != index:
+        parents[index] = parents[parents[index]]
+        index = parents[index]
+
+    return index
+
+
+def _group_contacts(rime, contacts):
+    """
+    Return lists of (contact, canonical phone numbers, phone numbers which couldn't be canonicalised) of the contacts
+    which share any phone number or email address, directly or through other contacts, in order of their first contact.
+    """
+    canonical_phones = {}  # (phone, country code) -> E.164 phone number or None
+    first_index_by_key = {}  # phone number or email address -> index of the first contact having it
+    parents = list(range(len(contacts)))  # union-find forest of contact indices
+    contact_phones = []
+
+    for index, contact in enumerate(contacts):
+        country_code = rime.device_for_id(contact.device_id).country_code
+
+        numbers = []
+        unparsed = []
+        for phone in contact.all_phones():
+            if (phone, country_code) not in canonical_phones:
+                canonical_phones[(phone, country_code)] = _canonical_phone(phone, country_code)
+
+            number = canonical_phones[(phone, country_code)]
+            if number is None:
+                unparsed.append(phone)
+            elif number not in numbers:
+                numbers.append(number)
+
+        contact_phones.append((numbers, unparsed))
+
+        keys = [('phone', number) for number in numbers] + [('email', email.lower()) for email in contact.all_emails()]
+        for key in keys:
+            first_index = first_index_by_key.setdefault(key, index)
+            parents[_find(parents, index)] = _find(parents, first_index)
+
+    groups = {}  # root index -> list of (contact, numbers, unparsed)
+    for index, contact in enumerate(contacts):
+        groups.setdefault(_find(parents, index), []).append((contact, *contact_phones[index]))
+
+    return list(groups.values())
+
+
+def _unique(values, key=lambda value: value):
+    seen = set()
+    result = []
+    for value in values:
+        if value and key(value) not in seen:
+            seen.add(key(value))
+            result.append(value)
+
+    return result
+
+
 def merge_contacts(rime, contacts: list[Contact]) -> list[MergedContact]:
     """
-    Create a list of merged contacts by comparing phone numbers using the phonenumbers library.
+    Create a list of merged contacts by comparing all of their phone numbers, using the phonenumbers library, and
+    email addresses. Contacts are merged if they share any phone number or email address, directly or through other
+    contacts.
 
     Every contact in the input list will be accounted for, such that the list of all merged_contact.contact
     lists will be equal to the input list apart from ordering.
     """
-    # Find contacts having the same phone number.
-    unmergeable_contacts = []  # list of MergedContact
-    similar_contacts = {}  # phone number in E164 format to list of Contact objects
-    for contact in contacts:
-        try:
-            number = phonenumbers.parse(contact.phone, rime.device_for_id(contact.device_id).country_code)
-            number_str = phonenumbers.format_number(number, phonenumbers.PhoneNumberFormat.E164)
-        except phonenumbers.phonenumberutil.NumberParseException:
-            number_str = None
-
-        if number_str is not None:
-            # We could get a canonical phone number, so merging is possible.
-            if number_str not in similar_contacts:
-                similar_contacts[number_str] = []
-
-            similar_contacts[number_str].append(contact)
-        else:
-            # We couldn't canonicalise the phone number, so create a unique "merged" contact.
-            unmergeable_contacts.append(MergedContact(
-                local_id=_hash_contact_ids([contact]),
-                contacts=[contact],
-                name=contact.name,
-                phone=contact.phone,
-                email=contact.email,))
-
-    # Use the above to create MergedContact objects.
     merged_contacts = []
-    for number_str, similar_contacts in similar_contacts.items():
-        assert similar_contacts
+    unmergeable_contacts = []  # merged contacts without a canonical phone number
+    for group in _group_contacts(rime, list(contacts)):
+        similar_contacts = [contact for contact, _numbers, _unparsed in group]
+        numbers = _unique(number for _contact, contact_numbers, _unparsed in group for number in contact_numbers)
 
         local_id = _hash_contact_ids(similar_contacts)
 
@@ -74,16 +124,30 @@ def merge_contacts(rime, contacts: list[Contact]) -> list[MergedContact]:
         name = contact_names[0] if contact_names else None
 
         # Take the longest email available as the contact's email.
-        contact_emails = [contact.email for contact in similar_contacts if contact.email]
-        contact_emails.sort(key=lambda email: len(email) if email else 0, reverse=True)
-        email = contact_emails[0] if contact_emails else None
-
-        merged_contacts.append(MergedContact(
-            local_id=local_id,
-            contacts=similar_contacts,
-            name=name,
-            phone=number_str,
-            email=email,))
+        emails = _unique((email for contact in similar_contacts for email in contact.all_emails()), key=str.lower)
+        contact_emails = sorted(emails, key=len, reverse=True)
+
+        # Phone numbers which couldn't be canonicalised are kept as they are.
+        phones = numbers + _unique(phone for _contact, _numbers, unparsed in group for phone in unparsed)
+
+        if numbers:
+            merged_contacts.append(MergedContact(
+                local_id=local_id,
+                contacts=similar_contacts,
+                name=name,
+                phone=numbers[0],
+                email=contact_emails[0] if contact_emails else None,
+                phones=phones,
+                emails=emails,))
+        else:
+            unmergeable_contacts.append(MergedContact(
+                local_id=local_id,
+                contacts=similar_contacts,
+                name=name,
+                phone=similar_contacts[0].phone,
+                email=contact_emails[0] if contact_emails else similar_contacts[0].email,
+                phones=phones,
+                emails=emails,))
 
     merged_contacts.extend(unmergeable_contacts)
 
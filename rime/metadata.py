@@ -1,60 +1,263 @@
 """
 Maintain a per-filesystem metadata cache.
 
-Metadata includes the MIME type and the DirEntry only, currently. It's currently stored in-memory but may eventually
-move to a database.
+Metadata includes the MIME type, guessed from the first bytes of the file, and the size and times of the file. It is
+stored in an SQLite database keyed by path, and is re-read from a file whose size or modification time has changed.
+
+The modification time of each directory is stored too. A directory whose modification time has not changed has the
+same entries as when it was last scanned, so rescanning it only visits its subdirectories. Files modified in place
+without changing the modification time of their directory are found when the directory next changes.
 """
-from dataclasses import dataclass
+from collections import defaultdict
+from dataclasses import dataclass, field
+import threading
+
 from filetype import guess as filetype_guess
-from filetype.types.base import Type as FileTypeType
 
 from .filesystem.devicefilesystem import DirEntry
+from .filesystem.ensuredir import ensuredir
+from .sql import sqlite3_connect
 
 
 # Chosen by fair dice roll.
 # Just kidding, chosen by reference to https://github.com/h2non/filetype.py
 FILE_HEADER_GUESS_LENGTH = 261
 
+# Increment when the tables change. The database is a cache, so tables from other versions are dropped.
+SCHEMA_VERSION = 2
+
 
 @dataclass
 class Metadata:
     """
     Metadata about a file.
     """
-    dir_entry: DirEntry
-    filetype: FileTypeType
+    path: str
+    size: int
+    mtime: float
+    ctime: float
+    mime_type: str | None  # None if the file is empty or its type could not be guessed
 
     @classmethod
     def from_direntry(cls, fs, direntry):
         with fs.open(direntry.path) as f:
             first_bytes = f.read(FILE_HEADER_GUESS_LENGTH)
 
-        if not first_bytes:
-            raise ValueError(f'File {direntry.path} is empty')
+        filetype = filetype_guess(first_bytes) if first_bytes else None
+
+        stat = direntry.stat()
+        return cls(direntry.path, stat.st_size, stat.st_mtime, stat.st_ctime, filetype.mime if filetype else None)
+
+    def is_current(self, direntry):
+        stat = direntry.stat()
+        return self.size == stat.st_size and self.mtime == stat.st_mtime
 
-        filetype = filetype_guess(first_bytes)
 
-        return cls(direntry, filetype)
+@dataclass
+class _ScanChanges:
+    """
+    The changes found by a scan, to be written to the database when it is complete.
+    """
+    scanned_directories: set[str] = field(default_factory=set)
+    changed: list[Metadata] = field(default_factory=list)
+    removed_files: list[str] = field(default_factory=list)
+    directories: list[tuple[str, str, float]] = field(default_factory=list)  # (path, parent, mtime)
+
+
+def _prefix_range(path):
+    """
+    Return the (start, end) range of strings which begin with 'path' followed by a '/'.
+    """
+    prefix = path.rstrip('/') + '/'
+    return prefix, prefix[:-1] + chr(ord('/') + 1)
 
 
 class FsMetadata:
-    def __init__(self):
-        self._cache = {}  # maps direntry path to Metadata
+    """
+    Metadata for the files of one filesystem, stored in 'db_path', or in memory if that is None.
+
+    scan() brings a directory up to date, and files_under() lists it as of the last scan, scanning it only if it has
+    never been scanned, so the owner of the metadata should scan again when the filesystem may have changed. Scanning
+    reads only the directories which have changed, and the files in them which are new or have changed, since the
+    database was last updated, so a directory tree which hasn't changed costs one stat() per directory.
+    """
+    def __init__(self, db_path=None):
+        self.db_path = db_path
+        self._conn = None
+        self._lock = threading.Lock()  # held while the database is used
+        self._scan_lock = threading.Lock()  # held for the whole of a scan, which reads the filesystem without _lock
+
+    def _connect(self):
+        if self._conn is None:
+            if self.db_path:
+                ensuredir(self.db_path)
+                conn = sqlite3_connect(self.db_path)
+            else:
+                conn = sqlite3_connect(':memory:')
+
+            with conn:
+                if conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                    conn.execute("DROP TABLE IF EXISTS file_metadata")
+                    conn.execute("DROP TABLE IF EXISTS directory_metadata")
+                    conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+                # 'directory' is the directory containing the file.
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS file_metadata (
+                        path TEXT PRIMARY KEY, directory TEXT, size INTEGER, mtime REAL, ctime REAL, mime_type TEXT
+                    )
+                """)
+                conn.execute("CREATE INDEX IF NOT EXISTS file_metadata_ctime ON file_metadata (ctime, path)")
+                conn.execute("CREATE INDEX IF NOT EXISTS file_metadata_directory ON file_metadata (directory)")
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS directory_metadata (path TEXT PRIMARY KEY, parent TEXT, mtime REAL)
+                """)
+            self._conn = conn
+
+        return self._conn
+
+    def _load_directory(self, conn, directory):
+        return {
+            row[0]: Metadata(*row)
+            for row in conn.execute("""
+                SELECT path, size, mtime, ctime, mime_type FROM file_metadata WHERE directory = ?
+            """, (directory,))
+        }
+
+    def _store(self, conn, fs, metadatas):
+        conn.executemany("""
+            INSERT OR REPLACE INTO file_metadata (path, directory, size, mtime, ctime, mime_type)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, ((m.path, fs.dirname(m.path), m.size, m.mtime, m.ctime, m.mime_type) for m in metadatas))
+
+    def get(self, fs, direntry: DirEntry) -> Metadata:
+        with self._lock:
+            conn = self._connect()
+
+            row = conn.execute("""
+                SELECT path, size, mtime, ctime, mime_type FROM file_metadata WHERE path = ?
+            """, (direntry.path,)).fetchone()
+            metadata = Metadata(*row) if row else None
+
+            if metadata is None or not metadata.is_current(direntry):
+                metadata = Metadata.from_direntry(fs, direntry)
+                with conn:
+                    self._store(conn, fs, [metadata])
+
+        return metadata
+
+    def scan(self, fs, path):
+        """
+        Bring the metadata for the files under directory 'path' up to date.
+        """
+        with self._scan_lock:
+            self._scan(fs, path)
+
+    def _is_scanned(self, path):
+        with self._lock:
+            return self._connect().execute("""
+                SELECT 1 FROM directory_metadata WHERE path = ?
+            """, (path,)).fetchone() is not None
+
+    def _scan(self, fs, path):
+        with self._lock:
+            directory_rows = self._connect().execute("""
+                SELECT path, parent, mtime FROM directory_metadata WHERE path = ? OR (path >= ? AND path < ?)
+            """, (path, *_prefix_range(path))).fetchall()
+
+        directory_mtimes = {}
+        subdirectories = defaultdict(list)
+        for directory, parent, mtime in directory_rows:
+            directory_mtimes[directory] = mtime
+            subdirectories[parent].append(directory)
+
+        # The filesystem is walked without holding the lock, so that files_under() can return the metadata as it was
+        # before the scan, and the changes are written in one transaction at the end.
+        changes = _ScanChanges()
+        if fs.exists(path):
+            self._scan_directory(fs, fs.path_to_direntry(path), fs.dirname(path), directory_mtimes, subdirectories,
+                                 changes)
+
+        # Anything not scanned is no longer on the filesystem.
+        removed_directories = [(directory,) for directory in directory_mtimes.keys() - changes.scanned_directories]
+
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                self._store(conn, fs, changes.changed)
+                conn.executemany("DELETE FROM file_metadata WHERE path = ?", ((p,) for p in changes.removed_files))
+                conn.executemany("""
+                    INSERT OR REPLACE INTO directory_metadata (path, parent, mtime) VALUES (?, ?, ?)
+                """, changes.directories)
+                conn.executemany("DELETE FROM file_metadata WHERE directory = ?", removed_directories)
+                conn.executemany("DELETE FROM directory_metadata WHERE path = ?", removed_directories)
+
+    def _scan_directory(self, fs, direntry, parent, directory_mtimes, subdirectories, changes):
+        changes.scanned_directories.add(direntry.path)
+        mtime = direntry.stat().st_mtime
+
+        if directory_mtimes.get(direntry.path) == mtime:
+            # The directory's entries are unchanged, but its subdirectories may have changed.
+            for subdirectory in subdirectories[direntry.path]:
+                self._scan_directory(fs, fs.path_to_direntry(subdirectory), direntry.path, directory_mtimes,
+                                     subdirectories, changes)
+            return
+
+        with self._lock:
+            existing = self._load_directory(self._connect(), direntry.path)
+
+        for entry in fs.scandir(direntry.path):
+            if entry.is_dir():
+                self._scan_directory(fs, entry, direntry.path, directory_mtimes, subdirectories, changes)
+                continue
+
+            metadata = existing.pop(entry.path, None)
+            if metadata is None or not metadata.is_current(entry):
+                changes.changed.append(Metadata.from_direntry(fs, entry))
 
-    def get(self, fs, direntry: DirEntry):
-        if direntry not in self._cache:
-            try:
-                self._cache[direntry.path] = Metadata.from_direntry(fs, direntry)
-            except ValueError:
-                self._cache[direntry.path] = None
+        # Anything left in 'existing' is no longer in the directory.
+        changes.removed_files.extend(existing)
+        changes.directories.append((direntry.path, parent, mtime))
 
-        return self._cache[direntry.path]
+    def files_under(self, fs, path, mime_type_prefixes=None, timestamp_start=None, timestamp_end=None,
+                    directory_regex=None) -> list[Metadata]:
+        """
+        Return the metadata of the files under directory 'path', in order of ctime then path, as of the last scan.
+        The directory is scanned first only if it has never been scanned.
 
+        If 'mime_type_prefixes' is supplied, only files with a MIME type starting with one of them are returned.
+        If 'timestamp_start' or 'timestamp_end' are supplied, only files with a ctime (as a datetime) no earlier than
+        the start and earlier than the end are returned. If 'directory_regex' is supplied, only files in
+        directories containing a match for it are returned.
+        """
+        query = "SELECT path, size, mtime, ctime, mime_type FROM file_metadata WHERE path >= ? AND path < ?"
+        params = list(_prefix_range(path))
+        if mime_type_prefixes is not None:
+            query += " AND (" + " OR ".join("substr(mime_type, 1, ?) = ?" for _ in mime_type_prefixes) + ")"
+            for prefix in mime_type_prefixes:
+                params.extend((len(prefix), prefix))
+        if timestamp_start is not None:
+            query += " AND ctime >= ?"
+            params.append(timestamp_start.timestamp())
+        if timestamp_end is not None:
+            query += " AND ctime < ?"
+            params.append(timestamp_end.timestamp())
+        if directory_regex is not None:
+            query += " AND directory REGEXP ?"
+            params.append(directory_regex.pattern)
+        query += " ORDER BY ctime, path"
 
-_metadata_by_fs = {}  # FS ID to Metadata
+        if not self._is_scanned(path):
+            with self._scan_lock:
+                # Another thread may have scanned the directory while this one waited.
+                if not self._is_scanned(path):
+                    self._scan(fs, path)
 
+        with self._lock:
+            return [Metadata(*row) for row in self._connect().execute(query, params)]
 
-def get_fs_metadata(fs):
-    if fs.id_ not in _metadata_by_fs:
-        _metadata_by_fs[fs.id_] = FsMetadata()
-    return _metadata_by_fs[fs.id_]
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
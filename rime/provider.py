@@ -6,12 +6,17 @@ from abc import ABC, abstractmethod
 
 from .media import MediaData
 from .filesystem.base import File
+from .resultcache import ResultCache
 
 
 class Provider(ABC):
     NAME = None
     FRIENDLY_NAME = None  # for displaying to users
 
+    # Data the provider reads once and keeps between searches, keyed by provider instance. Set by find_providers()
+    # to a cache owned by the Rime, whose memory budget is shared by all of its devices.
+    caches: ResultCache = None
+
     PII_FIELDS = NotImplemented
 
     @classmethod
@@ -40,9 +45,42 @@ class Provider(ABC):
     def search_events(self, device, filter_):
         """
         Search for events matching ``filter_``, which is an EventFilter.
+
+        Events are returned in timestamp order. Providers should restrict their queries as far as they can using the
+        filter (e.g. its timestamp range and ``participant_local_ids()``); the caller applies ``filter_.matches()`` to
+        the result, so returning some non-matching events is allowed.
         """
         return []
 
+    def count_events(self, device, filter_, group_by):
+        """
+        Return a Counter of the events matching ``filter_``, grouped and keyed as described in rime.eventstats, or
+        None if the provider can't count them more efficiently than by searching for them.
+
+        The counts must match the events search_events() returns after ``filter_.matches()`` is applied.
+        """
+        return None
+
+    def warm_cache(self, device):
+        """
+        Fill any caches the provider keeps for ``device``. Called in the background when the device is registered and
+        again each time the devices are rescanned.
+        """
+        pass
+
+    def release_caches(self):
+        """
+        Discard any cached data. Called when the provider's device is removed or its providers are reloaded.
+        """
+        pass
+
+    def source_fingerprint(self) -> str | None:
+        """
+        Return a string which changes when the data the provider reads does, or None if there is no such string.
+        Data derived from the provider and kept between runs, such as its text index, is rebuilt when this changes.
+        """
+        return None
+
     @abstractmethod
     def search_contacts(self, filter_):
         """
@@ -50,15 +88,22 @@ class Provider(ABC):
         """
 
     @abstractmethod
-    def get_media(self, local_id) -> MediaData:
+    def get_media(self, device, local_id) -> MediaData:
+        """
+        return a MediaData object supplying the picture, video, sound, etc identified by 'local_id' on ``device``.
         """
-        return a MediaData object supplying the picture, video, sound, etc identified by 'local_id'.
+
+    def media_version(self, device, local_id) -> str | None:
         """
+        Return a string, such as its size and modification time, which changes when the media identified by
+        'local_id' does, without opening the media. Return None if there is no such string.
+        """
+        return None
 
 
-def find_providers(fs) -> dict[str, Provider]:
+def find_providers(fs, caches: ResultCache) -> dict[str, Provider]:
     """
-    Return a list of providers that recognise data on this filesystem.
+    Return a list of providers that recognise data on this filesystem, which keep their cached data in 'caches'.
     """
     from . import providers  # noqa: F401
 
@@ -72,6 +117,7 @@ def find_providers(fs) -> dict[str, Provider]:
 
         # ... and store them.
         if instance:
+            instance.caches = caches
             providers_dict[provider.NAME] = instance
 
     return providers_dict
@@ -22,7 +22,7 @@ from dataclasses import dataclass
 
 from ..provider import Provider
 from ..event import Event
-from ..sql import Table, Query, get_field_indices
+from ..sql import Table, Query, get_field_indices, regex_match_criterion
 from ..contact import Contact, Name
 from ..anonymise import anonymise_phone, anonymise_email, anonymise_name
 
@@ -46,14 +46,6 @@ MIMETYPES = {
 }
 
 
-def filter_contacts(filter, contacts_iterable):
-    if not filter:
-        return contacts_iterable
-
-    return [contact for contact in contacts_iterable
-            if filter.name_regex.match(contact.name.display)]
-
-
 class AndroidContacts(Provider):
     NAME = ANDROID_CONTACTS
     FRIENDLY_NAME = ANDROID_CONTACTS_FRIENDLY
@@ -91,6 +83,9 @@ class AndroidContacts(Provider):
             .select(contact_table._id, contact_table.name_raw_contact_id, data_table.mimetype_id, data_table.data1)\
             .where(data_table.mimetype_id.isin(list(mime_type_id_to_name.keys())))
 
+        if contacts_filter:
+            query = self._filter_query(query, raw_contact_table, contacts_filter, mime_type_id_to_name)
+
         fields = get_field_indices(query)
         contacts = {}  # Indexed by contact ID
 
@@ -114,9 +109,31 @@ class AndroidContacts(Provider):
             contacts[contact_id].provider_data.raw_contact_row_ids.add(raw_contact_id)
 
             contact_field_name = MIMETYPES[mime_type_id_to_name[mime_type_id]]
-            setattr(contacts[contact_id], contact_field_name, data)
+            contacts[contact_id].set_field(contact_field_name, data)
+
+        return list(contacts.values())
+
+    def _filter_query(self, query, raw_contact_table, contacts_filter, mime_type_id_to_name):
+        """
+        Restrict 'query' to raw contacts with data rows which may match the regexes of 'contacts_filter'. The data
+        table is indexed by MIME type and value, so regexes with a literal prefix are answered from the index.
+        """
+        for field, regex in contacts_filter.regexes().items():
+            mime_type_ids = [
+                mime_type_id
+                for mime_type_id, mime_type in mime_type_id_to_name.items()
+                if MIMETYPES[mime_type].split('.')[0] == field
+            ]
+
+            matching_data_table = Table('data').as_('matching_data')
+            matching_raw_contact_ids = Query.from_(matching_data_table)\
+                .select(matching_data_table.raw_contact_id)\
+                .where(matching_data_table.mimetype_id.isin(mime_type_ids))\
+                .where(regex_match_criterion(matching_data_table.data1, regex))
+
+            query = query.where(raw_contact_table._id.isin(matching_raw_contact_ids))
 
-        return list(filter_contacts(contacts_filter, contacts.values()))
+        return query
 
     PII_FIELDS = {
         'sqlite3': {
@@ -187,7 +204,7 @@ class AndroidContacts(Provider):
 
         return None
 
-    def get_media(self, local_id):
+    def get_media(self, device, local_id):
         """
         Return the pathname, relative to the filesystem, of media identified by 'local_id'.
         """
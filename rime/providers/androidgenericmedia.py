@@ -9,14 +9,13 @@ from datetime import datetime
 from dataclasses import dataclass
 
 from ..provider import Provider
+from ..filter import TheAlwaysMatchesPattern
 from ..event import MediaEvent, GenericEventInfo
 from ..media import MediaData
 
 from . import providernames
 from .providernames import ANDROID_GENERIC_MEDIA, ANDROID_GENERIC_MEDIA_FRIENDLY
 
-from ..metadata import get_fs_metadata
-
 
 @dataclass
 class DirentryProviderInfo:
@@ -24,6 +23,10 @@ class DirentryProviderInfo:
     is_user_content: bool
 
 
+MEDIA_ROOT = '/sdcard'
+
+MEDIA_MIME_TYPE_PREFIXES = ('image/', 'video/')
+
 _DIRENTRY_TO_PROVIDER_PREFIXES = {
     '/sdcard/Android/data/com.hmdglobal.camera2/': DirentryProviderInfo(providernames.ANDROID_CAMERA2_HMDGLOBAL, False),
     '/sdcard/DCIM/Camera/': DirentryProviderInfo(providernames.ANDROID_CAMERA, True),
@@ -67,43 +70,50 @@ class AndroidGenericMedia(Provider):
         """
         Search for events matching ``filter_``, which is an EventFilter.
         """
-        fs_metadata = get_fs_metadata(self.fs)
-
-        for direntry in self.fs.walk('/sdcard'):
-            metadata = fs_metadata.get(self.fs, direntry)
-            if not metadata or not metadata.filetype:
-                continue
-
-            mime = metadata.filetype.mime
-
-            if mime.startswith('image/') or mime.startswith('video/'):
-                category = self.fs.dirname(direntry.path)
-
-                # Attempt to label the provider. We either label it as definitively coming from a
-                # specific provider, or, if it's user or unknown content, we default to the
-                # unknown contact.
-                direntry_provider_info = _guess_provider_for_entity(category)
-                if direntry_provider_info and not direntry_provider_info.is_user_content:
-                    sender = device.provider_contact(direntry_provider_info.provider_name)
-                    is_user_generated = False
-                else:
-                    sender = device.unknown_contact
-                    is_user_generated = True
-
-                generic_event_info = GenericEventInfo(
-                    category=category,
-                    is_user_generated=is_user_generated,
-                )
-
-                yield MediaEvent(
-                    mime_type=mime,
-                    local_id=direntry.path,
-                    id_=direntry.path,
-                    timestamp=datetime.fromtimestamp(direntry.stat().st_ctime),
-                    generic_event_info=generic_event_info,
-                    provider=self,
-                    sender=sender,
-                )
+        if filter_ and not filter_.accepts_type('MediaEvent'):
+            return
+
+        # The event category is the file's directory, so category criteria are directory criteria.
+        files = device.metadata.files_under(
+            self.fs, MEDIA_ROOT, MEDIA_MIME_TYPE_PREFIXES,
+            timestamp_start=filter_.timestamp_start if filter_ else None,
+            timestamp_end=filter_.timestamp_end if filter_ else None,
+            directory_regex=filter_.generic_event_category_regex
+            if filter_ and filter_.generic_event_category_regex is not TheAlwaysMatchesPattern else None,
+        )
+
+        # The metadata cache returns files in ctime order, which is the event timestamp order.
+        for metadata in files:
+            category = self.fs.dirname(metadata.path)
+
+            # Attempt to label the provider. We either label it as definitively coming from a
+            # specific provider, or, if it's user or unknown content, we default to the
+            # unknown contact.
+            direntry_provider_info = _guess_provider_for_entity(category)
+            if direntry_provider_info and not direntry_provider_info.is_user_content:
+                sender = device.provider_contact(direntry_provider_info.provider_name)
+                is_user_generated = False
+            else:
+                sender = device.unknown_contact
+                is_user_generated = True
+
+            generic_event_info = GenericEventInfo(
+                category=category,
+                is_user_generated=is_user_generated,
+            )
+
+            yield MediaEvent(
+                mime_type=metadata.mime_type,
+                local_id=metadata.path,
+                id_=metadata.path,
+                timestamp=datetime.fromtimestamp(metadata.ctime),
+                generic_event_info=generic_event_info,
+                provider=self,
+                sender=sender,
+            )
+
+    def warm_cache(self, device):
+        device.metadata.scan(self.fs, MEDIA_ROOT)
 
     def search_contacts(self, filter_):
         """
@@ -111,16 +121,19 @@ class AndroidGenericMedia(Provider):
         """
         return []
 
-    def get_media(self, local_id) -> MediaData:
+    def get_media(self, device, local_id) -> MediaData:
         """
         return a MediaData object supplying the picture, video, sound, etc identified by 'local_id'.
         """
-        fs_metadata = get_fs_metadata(self.fs)
-        direntry = self.fs.path_to_direntry(local_id)
-        metadata = fs_metadata.get(self.fs, direntry)
+        # The MIME type is sniffed from the file's first bytes, so use the cached result.
+        metadata = device.metadata.get(self.fs, self.fs.path_to_direntry(local_id))
 
         return MediaData(
-            mime_type=metadata.filetype.mime,
-            handle=self.fs.open(direntry.path),
-            length=direntry.stat().st_size,
+            mime_type=metadata.mime_type,
+            handle=self.fs.open(metadata.path),
+            length=metadata.size,
         )
+
+    def media_version(self, device, local_id):
+        media_stat = self.fs.path_to_direntry(local_id).stat()
+        return f'{media_stat.st_size}:{media_stat.st_mtime}'
@@ -7,24 +7,49 @@ SMS / MMS for Android
 """
 import datetime
 from dataclasses import dataclass
+import heapq
 import os.path
+import threading
 
 from ..provider import Provider
 from .providerutils import LazyContactProvider, LazyContactProviderContacts
-from ..event import MessageEvent, MessageSession
-from ..sql import Table, Query, get_field_indices
+from ..event import MessageEvent, MessageSession, Media
+from ..media import MediaData
+from ..sql import Table, Query, Parameter, get_field_indices, ThreadLocalConnection, TempKeyTables, open_blob, \
+                  regex_sql_pattern
 from ..contact import Contact, Name
 from ..anonymise import anonymise_phone, anonymise_name
+from ..resultcache import approximate_size
 from .providernames import ANDROID_TELEPHONY, ANDROID_TELEPHONY_FRIENDLY
 
-TYPE_TO_ME = 1
-TYPE_FROM_ME = 2
+# For the sms.type and pdu.msg_box columns
+TYPE_TO_ME = 1  # received
+TYPE_FROM_ME = 2  # sent
+
+# For the pdu.m_type column: the MMS PDUs which carry message content.
+MMS_MESSAGE_TYPES = (
+    128,  # m-send-req
+    132,  # m-retrieve-conf
+)
+
+# For the addr.type column
+MMS_ADDR_FROM = 137
+
+MMS_EVENT_ID_PREFIX = 'mms-'
+
+# For the part.ct column: parts which describe the message layout rather than its content.
+MMS_SMIL_CONTENT_TYPE = 'application/smil'
+MMS_TEXT_CONTENT_TYPE = 'text/plain'
+
+# MMS are read in pages of this many messages, and the parts of each page are read together.
+MMS_PAGE_ROWS = 256
 
 
 @dataclass
 class AtMessage:
     threads_table_id: str
-    address_table_id: str
+    address_table_id: str | None  # the sender's canonical_addresses._id, if it isn't the device operator
+    pdu_table_id: int | None = None  # for MMS messages
 
 
 class AndroidTelephony(Provider, LazyContactProvider):
@@ -32,41 +57,209 @@ class AndroidTelephony(Provider, LazyContactProvider):
     FRIENDLY_NAME = ANDROID_TELEPHONY_FRIENDLY
 
     MMSSMS_DB = os.path.join('data', 'data', 'com.android.providers.telephony', 'databases', 'mmssms.db')
+    # MMS part files. part._data holds their path on the device, which may be under /data/user/0 rather than /data/data.
+    APP_PARTS_DIR = os.path.join('data', 'data', 'com.android.providers.telephony', 'app_parts')
 
     def __init__(self, fs):
         self.fs = fs
-        self.db = fs.sqlite3_connect(self.MMSSMS_DB, read_only=True)
+        self.db = ThreadLocalConnection(lambda: fs.sqlite3_connect(self.MMSSMS_DB, read_only=True))
         self.contacts = LazyContactProviderContacts(self)
-        self.sessions = {}
+        self._cache_lock = threading.Lock()
 
-    def search_events(self, device, filter_):
+    def _cache(self) -> dict[int, MessageSession]:
         """
-        Search for events matching filter_, which is an EventFilter.
+        Return the cached mapping of thread ID to MessageSession, reading it if it isn't cached.
+        """
+        with self._cache_lock:
+            return self.caches.get_or_compute(
+                self, self._read_sessions, lambda sessions: approximate_size(list(sessions.values())))
+
+    def source_fingerprint(self):
+        return self.fs.fingerprint(self.MMSSMS_DB)
+
+    def release_caches(self):
+        self.caches.discard(self)
+
+    def _read_sessions(self):
+        """
+        Read every thread and return a mapping of thread ID to MessageSession.
         """
-        sms_table = Table('sms')
         threads_table = Table('threads')
-        address_table = Table('canonical_addresses')
+        query = Query.from_(threads_table).select(threads_table._id, threads_table.recipient_ids)
+
+        fields = get_field_indices(query)
+
+        sessions = {}
+        for row in self.db.execute(query.get_sql()):
+            # recipient_ids is a space-separated list of canonical_addresses IDs, with more than one for group threads.
+            participants = tuple(
+                self.contacts[address_id]
+                for address_id in (row[fields['recipient_ids']] or '').split()
+                if address_id in self.contacts
+            )
+
+            sessions[row[fields['_id']]] = MessageSession(
+                local_id=row[fields['_id']],
+                provider=self,
+                name='',
+                participants=participants,
+            )
+
+        return sessions
+
+    def _get_session(self, sessions, thread_id):
+        session = sessions.get(thread_id)
+        if session is None:
+            session = MessageSession(local_id=thread_id, provider=self, name='', participants=())
+
+        return session
+
+    def _construct_query(self, device, filter_, temp_keys):
+        sms_table = Table('sms')
         query = Query\
             .from_(sms_table)\
-            .left_join(threads_table).on(sms_table.thread_id == threads_table._id)\
-            .left_join(address_table).on(threads_table.recipient_ids == address_table._id)\
-            .select(sms_table._id.as_('sms_id'), address_table._id.as_('address_id'), sms_table.thread_id,
-                    sms_table.type, sms_table.address, sms_table.date, sms_table.body)
+            .select(sms_table._id.as_('sms_id'), sms_table.thread_id, sms_table.type, sms_table.address,
+                    sms_table.date, sms_table.body)\
+            .orderby(sms_table.date, sms_table._id)
+
+        if filter_:
+            if filter_.timestamp_start:
+                query = query.where(sms_table.date >= self._datetime_to_timestamp(filter_.timestamp_start))
+            if filter_.timestamp_end:
+                query = query.where(sms_table.date < self._datetime_to_timestamp(filter_.timestamp_end))
+
+            participant_local_ids = filter_.participant_local_ids(device.id_, self.NAME)
+            if participant_local_ids is not None:
+                query = query.where(sms_table.thread_id.isin(self._thread_ids_for_participants(participant_local_ids)))
+
+            event_local_ids = filter_.event_local_ids(device.id_, self.NAME)
+            if event_local_ids is not None:
+                query = query.where(temp_keys.isin(
+                    sms_table._id, [int(event_id) for event_id in event_local_ids if event_id.isdigit()]))
+            elif filter_.text_regex is not None:
+                query = query.where(sms_table.body.regexp(regex_sql_pattern(filter_.text_regex)))
+
+        return query
+
+    def _thread_ids_for_participants(self, participant_local_ids):
+        # Every message in a thread involves all of the thread's recipients, so select threads by recipient.
+        return [
+            thread_id
+            for thread_id, session in self._cache().items()
+            if any(contact.local_id in participant_local_ids for contact in session.participants)
+        ]
+
+    def _construct_mms_query(self, device, filter_, temp_keys):
+        pdu_table = Table('pdu')
+        addr_table = Table('addr')
+        query = Query\
+            .from_(pdu_table)\
+            .left_join(addr_table).on((addr_table.msg_id == pdu_table._id) & (addr_table.type == MMS_ADDR_FROM))\
+            .select(pdu_table._id.as_('pdu_id'), pdu_table.thread_id, pdu_table.msg_box, pdu_table.date,
+                    addr_table.address)\
+            .where(pdu_table.m_type.isin(MMS_MESSAGE_TYPES))\
+            .orderby(pdu_table.date, pdu_table._id)
+
+        if filter_:
+            if filter_.timestamp_start:
+                query = query.where(pdu_table.date >= self._datetime_to_mms_timestamp(filter_.timestamp_start))
+            if filter_.timestamp_end:
+                query = query.where(pdu_table.date < self._datetime_to_mms_timestamp(filter_.timestamp_end))
+
+            participant_local_ids = filter_.participant_local_ids(device.id_, self.NAME)
+            if participant_local_ids is not None:
+                query = query.where(pdu_table.thread_id.isin(self._thread_ids_for_participants(participant_local_ids)))
+
+            event_local_ids = filter_.event_local_ids(device.id_, self.NAME)
+            if event_local_ids is not None:
+                query = query.where(temp_keys.isin(pdu_table._id, [
+                    int(event_id[len(MMS_EVENT_ID_PREFIX):])
+                    for event_id in event_local_ids
+                    if event_id.startswith(MMS_EVENT_ID_PREFIX) and event_id[len(MMS_EVENT_ID_PREFIX):].isdigit()
+                ]))
+
+        return query
+
+    def _read_mms_parts(self, conn, pdu_ids):
+        """
+        Return a mapping of pdu ID to the (text, Media) of each MMS in 'pdu_ids', read on 'conn'. Part data is not
+        read.
+        """
+        part_table = Table('part')
+        query = Query\
+            .from_(part_table)\
+            .select(part_table._id, part_table.mid, part_table.ct, part_table.text)\
+            .where(part_table.mid.isin([Parameter('?')] * len(pdu_ids)))\
+            .orderby(part_table.mid, part_table.seq, part_table._id)
 
         fields = get_field_indices(query)
 
-        for row in self.db.execute(query.get_sql()):
-            session = self._find_session(row[fields['thread_id']], row[fields['address_id']])
+        texts = {}
+        media = {}
+        for row in conn.execute(query.get_sql(), pdu_ids):
+            pdu_id = row[fields['mid']]
+            content_type = row[fields['ct']]
+            if content_type == MMS_TEXT_CONTENT_TYPE:
+                if row[fields['text']]:
+                    texts.setdefault(pdu_id, []).append(row[fields['text']])
+            elif content_type != MMS_SMIL_CONTENT_TYPE and pdu_id not in media:
+                # MessageEvents have a single Media, so use the first attachment.
+                media[pdu_id] = Media(mime_type=content_type, local_id=str(row[fields['_id']]))
+
+        return {
+            pdu_id: ('\n'.join(texts[pdu_id]) if pdu_id in texts else None, media.get(pdu_id))
+            for pdu_id in texts.keys() | media.keys()
+        }
+
+    def _message_sender(self, device, message_type, address, session):
+        if message_type == TYPE_FROM_ME:
+            return device.device_operator_contact
+
+        if len(session.participants) == 1:
+            return session.participants[0]
+
+        # In a group thread, the sender is the recipient whose address the message came from.
+        for contact in session.participants:
+            if contact.phone == address:
+                return contact
+
+        return device.unknown_contact
+
+    def search_events(self, device, filter_):
+        """
+        Search for events matching filter_, which is an EventFilter.
+        """
+        if filter_ and not filter_.accepts_type('MessageEvent'):
+            # We only support MessageEvents
+            return []
+
+        sessions = self._cache()
+
+        # SMS and MMS are stored in separate tables, each read in timestamp order, so merge them. Both queries run on
+        # one connection, which holds their temporary tables.
+        conn = self.db.connection()
+        with TempKeyTables(conn) as temp_keys:
+            yield from heapq.merge(
+                self._search_sms(device, filter_, sessions, conn, temp_keys),
+                self._search_mms(device, filter_, sessions, conn, temp_keys),
+                key=lambda event: event.timestamp
+            )
+
+    def _search_sms(self, device, filter_, sessions, conn, temp_keys):
+        query = self._construct_query(device, filter_, temp_keys)
+
+        fields = get_field_indices(query)
+
+        for row in conn.execute(query.get_sql()):
+            session = self._get_session(sessions, row[fields['thread_id']])
+
+            sender = self._message_sender(device, row[fields['type']], row[fields['address']], session)
 
             provider_data = AtMessage(
                 threads_table_id=row[fields['thread_id']],
-                address_table_id=row[fields['address_id']],
+                address_table_id=sender.local_id if sender.providerName == self.NAME else None,
             )
 
-            sender = device.device_operator_contact \
-                if row[fields['type']] == TYPE_TO_ME \
-                else self.contacts[row[fields['address_id']]]
-
             yield MessageEvent(
                 id_=row[fields['sms_id']],
                 session_id=session.local_id,
@@ -79,21 +272,56 @@ class AndroidTelephony(Provider, LazyContactProvider):
                 sender=sender,
             )
 
+    def _search_mms(self, device, filter_, sessions, conn, temp_keys):
+        query = self._construct_mms_query(device, filter_, temp_keys)
+
+        fields = get_field_indices(query)
+
+        # Parts are read for a page of messages at a time, so that they are never all held in memory.
+        cursor = conn.execute(query.get_sql())
+        while rows := cursor.fetchmany(MMS_PAGE_ROWS):
+            parts = self._read_mms_parts(conn, [row[fields['pdu_id']] for row in rows])
+
+            for row in rows:
+                pdu_id = row[fields['pdu_id']]
+                session = self._get_session(sessions, row[fields['thread_id']])
+
+                sender = self._message_sender(device, row[fields['msg_box']], row[fields['address']], session)
+
+                provider_data = AtMessage(
+                    threads_table_id=row[fields['thread_id']],
+                    address_table_id=sender.local_id if sender.providerName == self.NAME else None,
+                    pdu_table_id=pdu_id,
+                )
+
+                text, media = parts.get(pdu_id, (None, None))
+
+                yield MessageEvent(
+                    id_=f'{MMS_EVENT_ID_PREFIX}{pdu_id}',
+                    session_id=session.local_id,
+                    session=session,
+                    from_me=row[fields['msg_box']] == TYPE_FROM_ME,
+                    timestamp=self._mms_timestamp_to_datetime(row[fields['date']]),
+                    provider=self,
+                    provider_data=provider_data,
+                    text=text,
+                    sender=sender,
+                    media=media,
+                )
+
     def _timestamp_to_datetime(self, timestamp):
         # Milliseconds since the epoch
         return datetime.datetime.fromtimestamp(timestamp / 1000)
 
-    def _find_session(self, thread_id, sender_address_id):
-        # TODO: group chats
-        if thread_id not in self.sessions:
-            self.sessions[thread_id] = MessageSession(
-                local_id=thread_id,
-                provider=self,
-                name='',
-                participants=(self.contacts[sender_address_id],),
-            )
+    def _datetime_to_timestamp(self, dt):
+        return int(dt.timestamp() * 1000)
+
+    def _mms_timestamp_to_datetime(self, timestamp):
+        # Seconds since the epoch
+        return datetime.datetime.fromtimestamp(timestamp)
 
-        return self.sessions[thread_id]
+    def _datetime_to_mms_timestamp(self, dt):
+        return int(dt.timestamp())
 
     def search_contacts(self, filter_):
         return self.contacts.values()
@@ -112,6 +340,15 @@ class AndroidTelephony(Provider, LazyContactProvider):
                 'threads': {
                     'snippet': {anonymise_phone, anonymise_name},
                 },
+                'pdu': {
+                    'sub': {anonymise_phone, anonymise_name},
+                },
+                'part': {
+                    'text': {anonymise_phone, anonymise_name},
+                },
+                'addr': {
+                    'address': anonymise_phone,
+                },
             }
         }
     }
@@ -128,10 +365,41 @@ class AndroidTelephony(Provider, LazyContactProvider):
             rows_address.update(
                 contact.local_id for contact in contacts if contact.providerName == self.NAME
             )
-            rows_threads.update(
-                event.provider_data.threads_table_id for event in events if event.provider.NAME == self.NAME
+            # Threads refer to all of their recipients.
+            rows_address.update(
+                contact.local_id
+                for event in events if event.provider.NAME == self.NAME and event.session
+                for contact in event.session.participants
             )
-            rows_sms.update(event.id_ for event in events if event.provider.NAME == self.NAME)
+            rows_pdu = subset_db.row_subset('pdu', '_id')
+            rows_part = subset_db.row_subset('part', 'mid')
+            rows_addr = subset_db.row_subset('addr', 'msg_id')
+
+            for event in events:
+                if event.provider.NAME != self.NAME:
+                    continue
+
+                rows_threads.add(event.provider_data.threads_table_id)
+                if event.provider_data.pdu_table_id is None:
+                    rows_sms.add(event.id_)
+                else:
+                    rows_pdu.add(event.provider_data.pdu_table_id)
+                    rows_part.add(event.provider_data.pdu_table_id)
+                    rows_addr.add(event.provider_data.pdu_table_id)
+
+            # Copy the files of MMS parts. Parts stored as BLOBs are copied with their rows.
+            conn = self.db.connection()
+            with TempKeyTables(conn) as temp_keys:
+                part_table = Table('part')
+                query = Query.from_(part_table) \
+                    .select('_data') \
+                    .where(temp_keys.isin(part_table.mid, rows_part.rows))
+
+                for row in conn.execute(query.get_sql()).fetchall():
+                    if isinstance(row[0], str):
+                        pathname = self._part_path(row[0])
+                        if self.fs.exists(pathname):
+                            subsetter.copy_file(self.fs.open(pathname), pathname)
 
     def all_files(self):
         # TODO
@@ -169,8 +437,53 @@ class AndroidTelephony(Provider, LazyContactProvider):
     def contact_unknown(self, local_id):
         return None
 
-    def get_media(self, local_id):
+    def _part_path(self, data_path):
+        return os.path.join(self.APP_PARTS_DIR, os.path.basename(data_path))
+
+    def get_media(self, device, local_id) -> MediaData:
         """
-        Return the pathname, relative to the filesystem, of media identified by 'local_id'.
+        Return a MediaData object supplying the MMS part identified by 'local_id'.
+
+        The part's data is read as the handle is consumed, whether it is in a file or in a BLOB in the database.
         """
-        raise NotImplementedError()
+        # Select the BLOB's type and length rather than the BLOB itself.
+        row = self.db.execute("""
+            SELECT ct, typeof(_data), length(_data), CASE typeof(_data) WHEN 'text' THEN _data END
+            FROM part WHERE _id = ?
+        """, (int(local_id),)).fetchone()
+        if not row:
+            raise ValueError(f'No media found for local id {local_id}')
+
+        mime_type, data_type, length, data_path = row
+
+        if data_type == 'blob':
+            return MediaData(
+                mime_type=mime_type,
+                handle=open_blob(self.db, 'part', '_data', int(local_id)),
+                length=length,
+            )
+
+        if data_type != 'text':
+            raise ValueError(f'No data for media with local id {local_id}')
+
+        pathname = self._part_path(data_path)
+
+        return MediaData(
+            mime_type=mime_type,
+            handle=self.fs.open(pathname),
+            length=self.fs.getsize(pathname),
+        )
+
+    def media_version(self, device, local_id):
+        row = self.db.execute("""
+            SELECT typeof(_data), length(_data), CASE typeof(_data) WHEN 'text' THEN _data END FROM part WHERE _id = ?
+        """, (int(local_id),)).fetchone()
+        if not row:
+            return None
+
+        data_type, length, data_path = row
+        if data_type != 'text':
+            return f'{data_type}:{length}'
+
+        part_stat = self.fs.path_to_direntry(self._part_path(data_path)).stat()
+        return f'{part_stat.st_size}:{part_stat.st_mtime}'
@@ -4,15 +4,21 @@
 
 import os.path
 import datetime
+import sys
+import threading
+from collections import Counter
 from typing import Iterable
 from dataclasses import dataclass
 
 from ..provider import Provider
 from ..event import Event, MessageEvent, Media, MessageSession
+from ..eventstats import make_key, BUCKET_SECONDS, GROUP_BY_TIME, SENDER, SESSION
 from ..contact import Contact, Name
-from ..sql import Table, Query, get_field_indices
+from ..sql import Table, Query, get_field_indices, ThreadLocalConnection, TempKeyTables, functions as fn, SqlTypes, \
+                  regex_sql_pattern
 from ..anonymise import anonymise_phone, anonymise_name
 from ..media import MediaData
+from ..resultcache import approximate_size
 from .providernames import ANDROID_WHATSAPP, ANDROID_WHATSAPP_FRIENDLY
 
 # for the message_type column in msgstore.db
@@ -85,14 +91,28 @@ class WhatsappMessageSession:
     group_jid_row_id: str | None
 
 
-CONTACTS_BY_JID_ROW_ID = {}  # Maps FS ID to {jid_row_id: Contact}
-CONTACTS_BY_ID = {}  # Maps FS ID to {Contact.id_: Contact}
-
-# Group users, by filesystem ID
-GROUP_USERS = {}  # Maps FS ID to {group jid: list of user jids}
+@dataclass
+class WhatsappCache:
+    """
+    Contacts, groups and sessions read from the WhatsApp databases of one device.
 
-# group_participant_user table indices, by filesystem ID
-GROUP_PARTICIPANT_USER_IDS = {}  # Maps FS ID to {group jid: list of group participant user _id fields}
+    These are held in the provider's caches, which may discard them at any time, so they must be looked up once per
+    operation and passed around rather than stored.
+    """
+    contacts_by_jid_row_id: dict[int, Contact]
+    contacts_by_id: dict[str, Contact]  # Contact.local_id to Contact, for contacts in wa.db
+    group_users: dict[int, list[int]]  # group jid row ID to list of user jid row IDs
+    group_participant_user_ids: dict[int, list[int]]  # group jid row ID to list of group_participant_user._id
+    sessions_by_chat_id: dict[int, MessageSession]
+
+    def approximate_size(self):
+        contacts = list({id(contact): contact for contact in self.contacts_by_jid_row_id.values()}.values())
+        return approximate_size(contacts) \
+            + approximate_size(list(self.sessions_by_chat_id.values())) \
+            + sum(sys.getsizeof(users) for users in self.group_users.values()) \
+            + sum(sys.getsizeof(user_ids) for user_ids in self.group_participant_user_ids.values()) \
+            + sys.getsizeof(self.contacts_by_jid_row_id) + sys.getsizeof(self.contacts_by_id) \
+            + sys.getsizeof(self.sessions_by_chat_id)
 
 
 # Extra information for message events, for recreation during subsetting.
@@ -112,22 +132,56 @@ class AndroidWhatsApp(Provider):
 
     def __init__(self, fs):
         self.fs = fs
-        self.msgdb = fs.sqlite3_connect(self.MESSAGE_DB, read_only=True)
-        self.wadb = fs.sqlite3_connect(self.WA_DB, read_only=True)
+        self.msgdb = ThreadLocalConnection(lambda: fs.sqlite3_connect(self.MESSAGE_DB, read_only=True))
+        self.wadb = ThreadLocalConnection(lambda: fs.sqlite3_connect(self.WA_DB, read_only=True))
+        self._cache_lock = threading.Lock()
 
     def __del__(self):
         self.msgdb.close()
         self.wadb.close()
 
-    def _load_contacts(self):
+    def _cache(self) -> WhatsappCache:
         """
-        Read and cache all WhatsApp contacts.
+        Return the cached contacts, groups and sessions, reading them if they aren't cached.
         """
-        global CONTACTS_BY_JID_ROW_ID, CONTACTS_BY_ID
+        # The lock stops concurrent searches from reading the databases more than once.
+        with self._cache_lock:
+            return self.caches.get_or_compute(self, self._read_cache, WhatsappCache.approximate_size)
+
+    def source_fingerprint(self):
+        return self.fs.fingerprint(self.MESSAGE_DB)
+
+    def release_caches(self):
+        self.caches.discard(self)
+
+    def _read_cache(self):
+        contacts_by_jid_row_id, contacts_by_id = self._read_contacts()
+        group_users, group_participant_user_ids = self._read_group_users()
+
+        cache = WhatsappCache(
+            contacts_by_jid_row_id=contacts_by_jid_row_id,
+            contacts_by_id=contacts_by_id,
+            group_users=group_users,
+            group_participant_user_ids=group_participant_user_ids,
+            sessions_by_chat_id={},
+        )
+
+        chat_table = Table('chat')
+        query = Query.from_(chat_table) \
+            .select('_id', 'jid_row_id', 'subject')
+
+        fields = get_field_indices(query)
+
+        for row in self.msgdb.execute(str(query)):
+            cache.sessions_by_chat_id[row[fields['_id']]] = self._create_wa_session(
+                cache, row[fields['_id']], row[fields['jid_row_id']], row[fields['subject']])
 
-        if self.fs.id_ in CONTACTS_BY_JID_ROW_ID:
-            return
+        return cache
 
+    def _read_contacts(self):
+        """
+        Read all WhatsApp contacts. Return a mapping of jid row ID to Contact and of Contact.local_id to Contact.
+        """
         # First read contact information from the wa.db database.
         contacts_table = Table("wa_contacts")
         query = Query.from_(contacts_table) \
@@ -136,7 +190,7 @@ class AndroidWhatsApp(Provider):
         fields = get_field_indices(query)
 
         contacts_by_jid = {}
-        CONTACTS_BY_ID[self.fs.id_] = {}
+        contacts_by_id = {}
 
         for row in self.wadb.execute(str(query)):
             jid = row[fields['jid']]
@@ -166,9 +220,9 @@ class AndroidWhatsApp(Provider):
             new_contact.phone = number
 
             contacts_by_jid[jid] = new_contact
-            CONTACTS_BY_ID[self.fs.id_][new_contact.local_id] = new_contact
+            contacts_by_id[new_contact.local_id] = new_contact
 
-        CONTACTS_BY_JID_ROW_ID[self.fs.id_] = {}
+        contacts_by_jid_row_id = {}
 
         jid_table = Table("jid")
         query = Query.from_(jid_table) \
@@ -201,13 +255,15 @@ class AndroidWhatsApp(Provider):
 
             contact.provider_data.jid_contacts.append(wa_jid)
 
-            CONTACTS_BY_JID_ROW_ID[self.fs.id_][row[fields['_id']]] = contact
+            contacts_by_jid_row_id[row[fields['_id']]] = contact
+
+        return contacts_by_jid_row_id, contacts_by_id
 
     def _media_path(self, local_id):
         # TODO media is stored on the SD card, which isn't fixed.
         return f'/sdcard/WhatsApp/{local_id}'
 
-    def get_media(self, local_id):
+    def get_media(self, device, local_id):
         # Find the content type based on the local id.
         media_table = Table('message_media')
         query = Query.from_(media_table) \
@@ -228,74 +284,58 @@ class AndroidWhatsApp(Provider):
             length=self.fs.getsize(media_path),
         )
 
-    def _get_group_contacts(self, group_jid):
-        """
-        Return the other users in this group.
+    def media_version(self, device, local_id):
+        media_stat = self.fs.path_to_direntry(self._media_path(local_id)).stat()
+        return f'{media_stat.st_size}:{media_stat.st_mtime}'
 
-        Excludes all non-user contacts, including JID_TYPE_ME.
+    def _read_group_users(self):
         """
-        self._load_contacts()
-
-        if self.fs.id_ not in GROUP_USERS:
-            GROUP_USERS[self.fs.id_] = {}
-
-        if self.fs.id_ not in GROUP_PARTICIPANT_USER_IDS:
-            GROUP_PARTICIPANT_USER_IDS[self.fs.id_] = {}
+        Read the users of every group. Return mappings of group jid row ID to the user jid row IDs and to the
+        group_participant_user row IDs.
+        """
+        group_participant_user_table = Table('group_participant_user')
+        query = Query.from_(group_participant_user_table) \
+            .select('_id', 'group_jid_row_id', 'user_jid_row_id') \
+            .orderby(group_participant_user_table._id)
 
-        if group_jid not in GROUP_USERS[self.fs.id_]:
-            group_participant_user_table = Table('group_participant_user')
-            query = Query.from_(group_participant_user_table) \
-                .select('_id', 'user_jid_row_id') \
-                .where(group_participant_user_table.group_jid_row_id == group_jid)
+        fields = get_field_indices(query)
 
-            fields = get_field_indices(query)
+        group_users = {}
+        group_participant_user_ids = {}
+        for row in self.msgdb.execute(str(query)):
+            group_jid = row[fields['group_jid_row_id']]
+            group_participant_user_ids.setdefault(group_jid, []).append(row[fields['_id']])
+            group_users.setdefault(group_jid, []).append(row[fields['user_jid_row_id']])
 
-            GROUP_USERS[self.fs.id_][group_jid] = []
-            GROUP_PARTICIPANT_USER_IDS[self.fs.id_][group_jid] = []
+        return group_users, group_participant_user_ids
 
-            for row in self.msgdb.execute(str(query)):
-                GROUP_PARTICIPANT_USER_IDS[self.fs.id_][group_jid].append(row[fields['_id']])
-                GROUP_USERS[self.fs.id_][group_jid].append(row[fields['user_jid_row_id']])
+    def _get_group_contacts(self, cache, group_jid):
+        """
+        Return the other users in this group.
 
+        Excludes all non-user contacts, including JID_TYPE_ME.
+        """
         contacts = []
-        all_contacts = CONTACTS_BY_JID_ROW_ID[self.fs.id_]
+        all_contacts = cache.contacts_by_jid_row_id
 
-        for jid_row_id in GROUP_USERS[self.fs.id_][group_jid]:
+        for jid_row_id in cache.group_users.get(group_jid, []):
             if jid_row_id in all_contacts and all_contacts[jid_row_id].provider_data.typ_contains(JID_TYPE_USER):
-                contacts.append(CONTACTS_BY_JID_ROW_ID[self.fs.id_][jid_row_id])
+                contacts.append(all_contacts[jid_row_id])
 
         return contacts
 
-    def _get_contact(self, jid_row_id):
-        self._load_contacts()
-        return CONTACTS_BY_JID_ROW_ID[self.fs.id_].get(jid_row_id)
-
     def _is_group_contact(self, contact):
         return contact.provider_data.typ_contains(JID_TYPE_GROUP)
 
-    def _create_wa_session(self, chat_id):
-        chat_table = Table('chat')
-        query = Query.from_(chat_table) \
-            .select('jid_row_id', 'subject') \
-            .where(chat_table._id == chat_id)
-
-        fields = get_field_indices(query)
-
-        row = self.msgdb.execute(str(query)).fetchone()
-        if not row:
-            return None
-
-        jid_row_id = row[fields['jid_row_id']]
-        subject = row[fields['subject']]
-
-        contact = self._get_contact(jid_row_id)
+    def _create_wa_session(self, cache, chat_id, jid_row_id, subject):
+        contact = cache.contacts_by_jid_row_id.get(jid_row_id)
         group_participant_user_ids = []
         group_user_id = None
         group_jid_row_id = None
         if contact:
             if self._is_group_contact(contact):
-                contacts = self._get_group_contacts(jid_row_id)
-                group_participant_user_ids = GROUP_PARTICIPANT_USER_IDS[self.fs.id_][jid_row_id]
+                contacts = self._get_group_contacts(cache, jid_row_id)
+                group_participant_user_ids = cache.group_participant_user_ids.get(jid_row_id, [])
 
                 # Also add the user ID of the group itself as a participant so that subsetting includes it.
                 group_user_id = contact.provider_data.id_
@@ -319,7 +359,30 @@ class AndroidWhatsApp(Provider):
             provider_data=provider_data
         )
 
-    def _construct_query(self, filter_):
+    def _participants_criterion(self, local_ids, message_table, chat_table, message_details_table):
+        """
+        Return a criterion selecting messages which may involve any of the contacts with the given local IDs.
+
+        A message involves a contact if the contact sent it or is a participant in its chat. The criterion may also
+        select some other messages; EventsFilter.matches() makes the final decision.
+        """
+        jid_row_ids = [
+            jid_row_id
+            for jid_row_id, contact in self._cache().contacts_by_jid_row_id.items()
+            if contact.local_id in local_ids
+        ]
+
+        group_participant_user_table = Table('group_participant_user')
+        group_jid_row_ids = Query.from_(group_participant_user_table) \
+            .select(group_participant_user_table.group_jid_row_id) \
+            .where(group_participant_user_table.user_jid_row_id.isin(jid_row_ids))
+
+        return message_table.sender_jid_row_id.isin(jid_row_ids) \
+            | message_details_table.author_device_jid.isin(jid_row_ids) \
+            | chat_table.jid_row_id.isin(jid_row_ids) \
+            | chat_table.jid_row_id.isin(group_jid_row_ids)
+
+    def _construct_query(self, device, filter_, temp_keys, ordered=True):
         # Whatsapp messages are stored in the message table:
         message_table = Table('message')
         media_table = Table('message_media')
@@ -345,78 +408,133 @@ class AndroidWhatsApp(Provider):
             if filter_.timestamp_end:
                 query = query.where(message_table.timestamp < _datetime_to_timestamp(filter_.timestamp_end))
 
+            participant_local_ids = filter_.participant_local_ids(device.id_, self.NAME)
+            if participant_local_ids is not None:
+                query = query.where(self._participants_criterion(participant_local_ids, message_table, chat_table,
+                                                                 message_details_table))
+
+            event_local_ids = filter_.event_local_ids(device.id_, self.NAME)
+            if event_local_ids is not None:
+                query = query.where(temp_keys.isin(message_table._id, [int(event_id) for event_id in event_local_ids]))
+            elif filter_.text_regex is not None:
+                query = query.where(message_table.text_data.regexp(regex_sql_pattern(filter_.text_regex)))
+
+        if ordered:
+            # Results are merged with those of other providers in timestamp order.
+            query = query.orderby(message_table.timestamp, message_table._id)
+
         return query
 
-    def search_events(self, device, filter_):
-        wa_sessions = {}  # chat ID to MessageSession
+    def _message_sender(self, cache, device, from_me, sender_jid_row_id, author_device_jid):
+        # WhatsApp's contact storage method looks like it's changed over time. The following is guesswork:
+        # - If message.sender_jid_row_id is 0, its a group chat message. You can find the
+        #   sender by looking at message_details.author_device_jid.
+        # - If message.sender_jid_row_id is NOT 0, it's a private chat message and the sender
+        #   is as indicated by sender_jid_row_id.
+        if from_me:
+            sender = device.device_operator_contact
+        elif sender_jid_row_id == 0:
+            # Group chat.
+            if author_device_jid:
+                sender = cache.contacts_by_jid_row_id.get(author_device_jid)  # may be None
+            else:
+                sender = None
+        else:
+            # Private chat.
+            sender = cache.contacts_by_jid_row_id.get(sender_jid_row_id)  # may be None
+
+        if sender is None:
+            sender = device.unknown_contact
 
+        return sender
+
+    def search_events(self, device, filter_):
         if filter_ and not filter_.accepts_type('MessageEvent'):
             # We only support MessageEvents
             return []
 
-        query = self._construct_query(filter_)
-        fields = get_field_indices(query)
+        cache = self._cache()
+        conn = self.msgdb.connection()
+        with TempKeyTables(conn) as temp_keys:
+            query = self._construct_query(device, filter_, temp_keys)
+            fields = get_field_indices(query)
 
-        for row in self.msgdb.execute(str(query)):
-            # WhatsApp's contact storage method looks like it's changed over time. The following is guesswork:
-            # - If message.sender_jid_row_id is 0, its a group chat message. You can find the
-            #   sender by looking at message_details.author_device_jid.
-            # - If message.sender_jid_row_id is NOT 0, it's a private chat message and the sender
-            #   is as indicated by sender_jid_row_id.
-
-            # Find the sender.
-            if row[fields['from_me']]:
-                sender = device.device_operator_contact
-            elif row[fields['sender_jid_row_id']] == 0:
-                # Group chat.
-                author_device_jid = row[fields['author_device_jid']]
-                if author_device_jid:
-                    sender = self._get_contact(author_device_jid)  # may be None
+            for row in conn.execute(str(query)):
+                sender = self._message_sender(cache, device, row[fields['from_me']], row[fields['sender_jid_row_id']],
+                                              row[fields['author_device_jid']])
+
+                # Store DB-specific information to re-create the database rows later if we're subsetting.
+                wa_message_event = WhatsappMessageEvent(
+                    message_row_id=row[fields['_id']],
+                    chat_row_id=row[fields['chat_row_id']],
+                )
+
+                if row[fields['message_type']] in MEDIA_MESSAGE_TYPES:
+                    # Media message.
+                    media = Media(
+                        mime_type=row[fields['mime_type']],
+                        local_id=row[fields['file_path']])
                 else:
-                    sender = None
-            else:
-                # Private chat.
-                sender = self._get_contact(row[fields['sender_jid_row_id']])  # may be None
+                    # Text message.
+                    media = None
+
+                yield MessageEvent(
+                    id_=row[fields['_id']],
+                    session_id=str(row[fields['chat_row_id']]),
+                    session=cache.sessions_by_chat_id.get(row[fields['chat_row_id']]),
+                    timestamp=_timestamp_to_datetime(row[fields['timestamp']]),
+                    provider=self,
+                    provider_data=wa_message_event,
+                    text=row[fields['text_data']],
+                    from_me=bool(row[fields['from_me']]),
+                    sender=sender,
+                    media=media,
+                )
 
-            if sender is None:
-                sender = device.unknown_contact
+    def count_events(self, device, filter_, group_by):
+        if filter_.participant_ids:
+            # The participants criterion selects more messages than match, so the events must be checked one by one.
+            return None
 
-            # Store session info.
-            if row[fields['chat_row_id']] not in wa_sessions:
-                wa_sessions[row[fields['chat_row_id']]] = self._create_wa_session(row[fields['chat_row_id']])
+        if not filter_.accepts_type('MessageEvent'):
+            return Counter()
 
-            # Store DB-specific information to re-create the database rows later if we're subsetting.
-            wa_message_event = WhatsappMessageEvent(
-                message_row_id=row[fields['_id']],
-                chat_row_id=row[fields['chat_row_id']],
-            )
+        conn = self.msgdb.connection()
+        with TempKeyTables(conn) as temp_keys:
+            messages = self._construct_query(device, filter_, temp_keys, ordered=False)
 
-            if row[fields['message_type']] in MEDIA_MESSAGE_TYPES:
-                # Media message.
-                media = Media(
-                    mime_type=row[fields['mime_type']],
-                    local_id=row[fields['file_path']])
-            else:
-                # Text message.
-                media = None
+            columns = []
+            if GROUP_BY_TIME.intersection(group_by):
+                columns.append(fn.Cast(messages.timestamp / (BUCKET_SECONDS * 1000), SqlTypes.INTEGER).as_('bucket'))
+            if SENDER in group_by:
+                columns.extend([messages.from_me, messages.sender_jid_row_id, messages.author_device_jid])
+            if SESSION in group_by:
+                columns.append(messages.chat_row_id)
 
-            yield MessageEvent(
-                id_=row[fields['_id']],
-                session_id=str(row[fields['chat_row_id']]),
-                session=wa_sessions[row[fields['chat_row_id']]],
-                timestamp=_timestamp_to_datetime(row[fields['timestamp']]),
-                provider=self,
-                provider_data=wa_message_event,
-                text=row[fields['text_data']],
-                from_me=bool(row[fields['from_me']]),
-                sender=sender,
-                media=media,
-            )
+            query = Query.from_(messages).select(*columns, fn.Count('*').as_('count'))
+            if columns:
+                query = query.groupby(*columns)
 
-    def search_contacts(self, filter_):
-        self._load_contacts()
+            fields = get_field_indices(query)
 
-        return [contact for contact in CONTACTS_BY_ID[self.fs.id_].values()
+            cache = self._cache()
+            counts = Counter()
+            for row in conn.execute(str(query)):
+                key = make_key(
+                    group_by, device, self,
+                    timestamp=_timestamp_to_datetime(row[fields['bucket']] * BUCKET_SECONDS * 1000)
+                    if 'bucket' in fields else None,
+                    sender=self._message_sender(cache, device, row[fields['from_me']], row[fields['sender_jid_row_id']],
+                                                row[fields['author_device_jid']])
+                    if SENDER in group_by else None,
+                    session_local_id=row[fields['chat_row_id']] if SESSION in group_by else None,
+                )
+                counts[key] += row[fields['count']]
+
+        return counts
+
+    def search_contacts(self, filter_):
+        return [contact for contact in self._cache().contacts_by_id.values()
             if contact.provider_data.typ_contains(JID_TYPE_USER)]
 
     PII_FIELDS = {
@@ -490,14 +608,16 @@ class AndroidWhatsApp(Provider):
                 rows_message_media.add(wa_message.message_row_id)
 
             # copy media by copying each named file.
-            media_table = Table('message_media')
-            query = Query.from_(media_table) \
-                .select('file_path') \
-                .where(media_table.message_row_id.isin(rows_message_media.rows))
-
-            for row in self.msgdb.execute(query.get_sql()):
-                pathname = self._media_path(row[0])
-                subsetter.copy_file(self.fs.open(pathname), pathname)
+            conn = self.msgdb.connection()
+            with TempKeyTables(conn) as temp_keys:
+                media_table = Table('message_media')
+                query = Query.from_(media_table) \
+                    .select('file_path') \
+                    .where(temp_keys.isin(media_table.message_row_id, rows_message_media.rows))
+
+                for row in conn.execute(query.get_sql()).fetchall():
+                    pathname = self._media_path(row[0])
+                    subsetter.copy_file(self.fs.open(pathname), pathname)
 
     def all_files(self):
         # TODO
@@ -5,15 +5,20 @@
 Provides Apple 'Messages'
 """
 import datetime
+import threading
+from collections import Counter, defaultdict
 from dataclasses import dataclass
 from typing import Iterable
 
 from ..provider import Provider
 from .providerutils import LazyContactProvider, LazyContactProviderContacts
 from ..event import Event, MessageEvent, MessageSession
+from ..eventstats import make_key, BUCKET_SECONDS, GROUP_BY_TIME, SENDER, SESSION
 from ..contact import Contact, Name
-from ..sql import Table, Query, get_field_indices
+from ..sql import Table, Query, get_field_indices, ThreadLocalConnection, TempKeyTables, functions as fn, SqlTypes, \
+                  regex_sql_pattern
 from ..anonymise import anonymise_phone, anonymise_name
+from ..resultcache import approximate_size
 from .providernames import IOS_IMESSAGE, IOS_IMESSAGE_FRIENDLY
 
 
@@ -42,8 +47,9 @@ class IMessage(Provider, LazyContactProvider):
 
     def __init__(self, fs):
         self.fs = fs
-        self.conn = fs.sqlite3_connect(self.MESSAGE_DB, read_only=True)
+        self.conn = ThreadLocalConnection(lambda: fs.sqlite3_connect(self.MESSAGE_DB, read_only=True))
         self.contacts = LazyContactProviderContacts(self)
+        self._cache_lock = threading.Lock()
 
     def __del__(self):
         self.conn.close()
@@ -56,24 +62,46 @@ class IMessage(Provider, LazyContactProvider):
     def _datetime_to_timestamp(cls, dt):
         return int((dt.timestamp() - cls.EPOCH_TS) * 1_000_000_000)
 
-    def _create_session(self, chat_id):
-        # Retrieve contacts
+    def _cache(self) -> dict[int, MessageSession]:
+        """
+        Return the cached mapping of chat ID to MessageSession, reading it if it isn't cached.
+        """
+        with self._cache_lock:
+            return self.caches.get_or_compute(
+                self, self._read_sessions, lambda sessions: approximate_size(list(sessions.values())))
+
+    def source_fingerprint(self):
+        return self.fs.fingerprint(self.MESSAGE_DB)
+
+    def release_caches(self):
+        self.caches.discard(self)
+
+    def _read_sessions(self):
+        """
+        Read the handles of every chat and return a mapping of chat ID to MessageSession.
+        """
         chat_table = Table('chat')
         chat_handle_join_table = Table('chat_handle_join')
         handle_table = Table('handle')
 
-        query = Query.from_(handle_table) \
-            .join(chat_handle_join_table).on(chat_handle_join_table.handle_id == handle_table.rowid) \
+        query = Query.from_(chat_handle_join_table) \
+            .join(handle_table).on(handle_table.rowid == chat_handle_join_table.handle_id) \
             .join(chat_table).on(chat_table.rowid == chat_handle_join_table.chat_id) \
-            .where(chat_table.rowid == chat_id) \
-            .select('ROWID', )
+            .select(chat_handle_join_table.chat_id, chat_handle_join_table.handle_id) \
+            .orderby(chat_handle_join_table.chat_id, chat_handle_join_table.handle_id)
 
         fields = get_field_indices(query)
 
-        contacts = []
+        contacts_by_chat_id = defaultdict(list)
         for row in self.conn.execute(str(query)):
-            contacts.append(self.contacts[row[fields['ROWID']]])
+            contacts_by_chat_id[row[fields['chat_id']]].append(self.contacts[row[fields['handle_id']]])
 
+        return {
+            chat_id: self._create_session(chat_id, contacts)
+            for chat_id, contacts in contacts_by_chat_id.items()
+        }
+
+    def _create_session(self, chat_id, contacts):
         return MessageSession(
             local_id=chat_id,
             provider=self,
@@ -81,18 +109,16 @@ class IMessage(Provider, LazyContactProvider):
             participants=tuple(contacts)
         )
 
-    def search_events(self, device, filter_):
-        if filter_ and not filter_.accepts_type('MessageEvent'):
-            # We only support MessageEvents
-            return []
-
-        sessions = {}  # handle ID to session
+    def _get_session(self, sessions, chat_id):
+        # Chats without handles have no participants.
+        return sessions.get(chat_id) or self._create_session(chat_id, [])
 
+    def _construct_query(self, device, filter_, temp_keys, ordered=True):
         message_table = Table('message')
         chat_message_join_table = Table('chat_message_join')
         query = Query.from_(message_table) \
             .join(chat_message_join_table).on(chat_message_join_table.message_id == message_table.rowid) \
-            .select('ROWID', 'guid', 'text', 'date', 'handle_id', 'is_from_me', chat_message_join_table.chat_id) \
+            .select('ROWID', 'guid', 'text', 'date', 'handle_id', 'is_from_me', chat_message_join_table.chat_id)
 
         if filter_:
             if filter_.timestamp_start:
@@ -100,29 +126,115 @@ class IMessage(Provider, LazyContactProvider):
             if filter_.timestamp_end:
                 query = query.where(message_table.date < self._datetime_to_timestamp(filter_.timestamp_end))
 
-        fields = get_field_indices(query)
+            # Every message in a chat involves all of the chat's handles, so select chats by handle.
+            participant_local_ids = filter_.participant_local_ids(device.id_, self.NAME)
+            if participant_local_ids is not None:
+                chat_handle_join_table = Table('chat_handle_join')
+                chat_ids = Query.from_(chat_handle_join_table) \
+                    .select(chat_handle_join_table.chat_id) \
+                    .where(chat_handle_join_table.handle_id.isin(
+                        [int(local_id) for local_id in participant_local_ids if local_id.isdigit()]))
 
-        for row in self.conn.execute(str(query)):
-            chat_id = row[fields['chat_id']]
-            if chat_id not in sessions:
-                sessions[chat_id] = self._create_session(chat_id)
-
-            sender = device.device_operator_contact if row[fields['is_from_me']] else sessions[chat_id].participants[0]
-
-            yield MessageEvent(
-                id_=row[fields['guid']],
-                session_id=chat_id,
-                session=sessions[chat_id],
-                from_me=bool(row[fields['is_from_me']]),
-                timestamp=self._timestamp_to_datetime(row[fields['date']]),
-                provider=self,
-                sender=sender,
-                provider_data=ImessageMessage(
-                    message_row_id=row[fields['ROWID']],
-                    chat_row_id=row[fields['chat_id']],
-                ),
-                text=row[fields['text']],
-            )
+                query = query.where(chat_message_join_table.chat_id.isin(chat_ids))
+
+            event_local_ids = filter_.event_local_ids(device.id_, self.NAME)
+            if event_local_ids is not None:
+                query = query.where(temp_keys.isin(message_table.guid, event_local_ids))
+            elif filter_.text_regex is not None:
+                query = query.where(message_table.text.regexp(regex_sql_pattern(filter_.text_regex)))
+
+        if ordered:
+            query = query.orderby(message_table.date, message_table.ROWID)
+
+        return query
+
+    def _message_sender(self, device, is_from_me, session):
+        if is_from_me:
+            return device.device_operator_contact
+        elif session.participants:
+            return session.participants[0]
+        else:
+            return device.unknown_contact
+
+    def search_events(self, device, filter_):
+        if filter_ and not filter_.accepts_type('MessageEvent'):
+            # We only support MessageEvents
+            return []
+
+        sessions = self._cache()
+
+        conn = self.conn.connection()
+        with TempKeyTables(conn) as temp_keys:
+            query = self._construct_query(device, filter_, temp_keys)
+
+            fields = get_field_indices(query)
+
+            for row in conn.execute(str(query)):
+                chat_id = row[fields['chat_id']]
+                session = self._get_session(sessions, chat_id)
+
+                sender = self._message_sender(device, row[fields['is_from_me']], session)
+
+                yield MessageEvent(
+                    id_=row[fields['guid']],
+                    session_id=chat_id,
+                    session=session,
+                    from_me=bool(row[fields['is_from_me']]),
+                    timestamp=self._timestamp_to_datetime(row[fields['date']]),
+                    provider=self,
+                    sender=sender,
+                    provider_data=ImessageMessage(
+                        message_row_id=row[fields['ROWID']],
+                        chat_row_id=row[fields['chat_id']],
+                    ),
+                    text=row[fields['text']],
+                )
+
+    def count_events(self, device, filter_, group_by):
+        if filter_.participant_ids:
+            # The participants criterion selects more messages than match, so the events must be checked one by one.
+            return None
+
+        if not filter_.accepts_type('MessageEvent'):
+            return Counter()
+
+        conn = self.conn.connection()
+        with TempKeyTables(conn) as temp_keys:
+            messages = self._construct_query(device, filter_, temp_keys, ordered=False)
+
+            columns = []
+            if GROUP_BY_TIME.intersection(group_by):
+                columns.append(
+                    fn.Cast(messages.date / (BUCKET_SECONDS * 1_000_000_000), SqlTypes.INTEGER).as_('bucket'))
+            if SENDER in group_by:
+                columns.append(messages.is_from_me)
+            if SENDER in group_by or SESSION in group_by:
+                columns.append(messages.chat_id)
+
+            query = Query.from_(messages).select(*columns, fn.Count('*').as_('count'))
+            if columns:
+                query = query.groupby(*columns)
+
+            fields = get_field_indices(query)
+
+            sessions = self._cache()
+            counts = Counter()
+            for row in conn.execute(str(query)):
+                sender = None
+                if SENDER in group_by:
+                    session = self._get_session(sessions, row[fields['chat_id']])
+                    sender = self._message_sender(device, row[fields['is_from_me']], session)
+
+                key = make_key(
+                    group_by, device, self,
+                    timestamp=self._timestamp_to_datetime(row[fields['bucket']] * BUCKET_SECONDS * 1_000_000_000)
+                    if 'bucket' in fields else None,
+                    sender=sender,
+                    session_local_id=row[fields['chat_id']] if SESSION in group_by else None,
+                )
+                counts[key] += row[fields['count']]
+
+        return counts
 
     def search_contacts(self, filter_):
         return self.contacts.values()
@@ -205,7 +317,7 @@ class IMessage(Provider, LazyContactProvider):
     def contact_unknown(self, local_id):
         return None
 
-    def get_media(self, local_id):
+    def get_media(self, device, local_id):
         """
         Return the pathname, relative to the filesystem, of media identified by 'local_id'.
         """
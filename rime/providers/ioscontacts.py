@@ -5,15 +5,23 @@
 """
 Provides ios contacts
 """
+import threading
 from typing import Iterable
 
 from ..provider import Provider
 from ..contact import Contact, Name
-from ..sql import Table, Query, get_field_indices
+from ..sql import Table, Query, Case, get_field_indices, regex_match_criterion, functions as fn
 from ..event import Event
 from ..anonymise import anonymise_phone, anonymise_email, anonymise_name
+from ..resultcache import approximate_size
 from .providernames import IOS_CONTACTS, IOS_CONTACTS_FRIENDLY
 
+# ABMultiValue.property for each Contact field
+MULTIVALUE_PROPERTIES = {
+    'phone': 3,
+    'email': 4,
+}
+
 
 class IOSContacts(Provider):
     NAME = IOS_CONTACTS
@@ -24,6 +32,7 @@ class IOSContacts(Provider):
     def __init__(self, fs):
         self.fs = fs
         self.conn = fs.sqlite3_connect(self.DB_PATH, read_only=True)
+        self._cache_lock = threading.Lock()
 
     def __del__(self):
         self.conn.close()
@@ -34,57 +43,100 @@ class IOSContacts(Provider):
     def search_events(self, device, filter_):
         return []
 
-    # This could probably be tidier!
-    # Filter does nothing for now
-    def search_contacts(self, filter_):
-        person_table = Table('ABPerson')
+    def _filter_query(self, query, person_table, filter_):
+        """
+        Restrict 'query' to people who may match the regexes of 'filter_'.
+        """
+        for field, regex in filter_.regexes().items():
+            if field == 'name':
+                # As Name.full_name()
+                full_name = Case() \
+                    .when((person_table.First != '') & (person_table.Last != ''),
+                          fn.Function('printf', '%s %s', person_table.First, person_table.Last)) \
+                    .when(person_table.First != '', person_table.First) \
+                    .else_(person_table.Last)
+                query = query.where(regex_match_criterion(full_name, regex))
+            else:
+                matching_mvtable = Table('ABMultiValue').as_('matching_mv')
+                matching_person_ids = Query.from_(matching_mvtable) \
+                    .select(matching_mvtable.record_id) \
+                    .where(matching_mvtable.property == MULTIVALUE_PROPERTIES[field]) \
+                    .where(regex_match_criterion(matching_mvtable.value, regex))
+                query = query.where(person_table.ROWID.isin(matching_person_ids))
+
+        return query
+
+    def _cache(self) -> dict[int, Contact]:
+        """
+        Return the cached mapping of ABPerson ROWID to Contact, reading it if it isn't cached.
+        """
+        with self._cache_lock:
+            return self.caches.get_or_compute(
+                self, self._read_contacts, lambda contacts: approximate_size(list(contacts.values())))
+
+    def release_caches(self):
+        self.caches.discard(self)
+
+    def _read_multivalues(self):
+        """
+        Return a mapping of ABPerson ROWID to a mapping of property to that person's values of it, in UID order.
+        """
+        # The values are grouped here rather than with group_concat(), which doesn't guarantee their order.
         mvtable = Table('ABMultiValue')
-        # This will return several records per person.
-        # Phone numbers will have property=3, emails will have property=4
-        # Some may have neither.
-        query = Query.from_(person_table).left_join(mvtable).on(person_table.ROWID == mvtable.record_id).select(
-            person_table.ROWID, person_table.First, person_table.Last,
-            mvtable.property, mvtable.label, mvtable.value
-        ).orderby(person_table.ROWID)
+        query = Query.from_(mvtable) \
+            .select(mvtable.record_id, mvtable.property, mvtable.value) \
+            .where(mvtable.property.isin(list(MULTIVALUE_PROPERTIES.values()))) \
+            .where(mvtable.value.notnull()) \
+            .orderby(mvtable.record_id, mvtable.UID)
+
+        multivalues = {}
+        for record_id, property_, value in self.conn.execute(str(query)):
+            multivalues.setdefault(record_id, {}).setdefault(property_, []).append(value)
+
+        return multivalues
+
+    def _read_contacts(self):
+        multivalues = self._read_multivalues()
+
+        person_table = Table('ABPerson')
+        query = Query.from_(person_table) \
+            .select(person_table.ROWID, person_table.First, person_table.Last) \
+            .orderby(person_table.ROWID)
+
         fields = get_field_indices(query)
-        prev_id = None
-        email = phone = first = last = ""
 
-        # We'll get several rows per contact.
-        # These will be ordered by ROWID, so we should get all the values for one contact together.
+        contacts = {}
         for row in self.conn.execute(str(query)):
-            rowid = row[fields['ROWID']]
-            if rowid != prev_id and prev_id is not None:
-                # Moving on to new contact; return the last one
-                # with whatever we've found
-                yield Contact(
-                    local_id=prev_id,
-                    device_id=self.fs.id_,
-                    providerName=self.NAME,
-                    providerFriendlyName=self.FRIENDLY_NAME,
-                    name=Name(first=first, last=last),
-                    phone=phone,
-                    email=email
-                )
-                email = phone = first = last = ""
-            first, last = row[fields['First']], row[fields['Last']]
-            prev_id = rowid
-            if row[fields['property']] == 3:
-                phone = row[fields['value']]
-            if row[fields['property']] == 4:
-                email = row[fields['value']]
-        # And when we get to the end of the query, we need to return the last one.
-        if prev_id is not None:
-            yield Contact(
-                local_id=prev_id,
+            person_values = multivalues.get(row[fields['ROWID']], {})
+            phone_list = tuple(person_values.get(MULTIVALUE_PROPERTIES['phone'], ()))
+            email_list = tuple(person_values.get(MULTIVALUE_PROPERTIES['email'], ()))
+
+            contacts[row[fields['ROWID']]] = Contact(
+                local_id=row[fields['ROWID']],
                 device_id=self.fs.id_,
                 providerName=self.NAME,
                 providerFriendlyName=self.FRIENDLY_NAME,
-                name=Name(first=first, last=last),
-                phone=phone,
-                email=email
+                name=Name(first=row[fields['First']], last=row[fields['Last']]),
+                phone=phone_list[0] if phone_list else '',
+                email=email_list[0] if email_list else '',
+                phones=phone_list,
+                emails=email_list,
             )
 
+        return contacts
+
+    def search_contacts(self, filter_):
+        contacts = self._cache()
+
+        if not filter_ or not filter_.regexes():
+            return list(contacts.values())
+
+        person_table = Table('ABPerson')
+        query = Query.from_(person_table).select(person_table.ROWID).orderby(person_table.ROWID)
+        query = self._filter_query(query, person_table, filter_)
+
+        return [contacts[row[0]] for row in self.conn.execute(str(query)) if row[0] in contacts]
+
     PII_FIELDS = {
         'sqlite3': {
             DB_PATH: {
@@ -118,7 +170,7 @@ class IOSContacts(Provider):
 
         return None
 
-    def get_media(self, local_id):
+    def get_media(self, device, local_id):
         """
         Return the pathname, relative to the filesystem, of media identified by 'local_id'.
         """
@@ -2,14 +2,20 @@
 # See LICENSE.txt for full details.
 # Copyright 2023 Telemarq Ltd
 
+from collections import Counter, defaultdict
 from dataclasses import dataclass
 import datetime
+import sys
+import threading
 
 from ..provider import Provider
-from ..sql import Table, Query, get_field_indices
+from ..sql import Table, Query, get_field_indices, ThreadLocalConnection, TempKeyTables, functions as fn, SqlTypes, \
+                  regex_sql_pattern
 from ..event import MessageEvent, MessageSession
+from ..eventstats import make_key, BUCKET_SECONDS, GROUP_BY_TIME, SENDER, SESSION
 from ..contact import Contact, Name
 from ..anonymise import anonymise_phone, anonymise_name
+from ..resultcache import approximate_size
 from .providernames import IOS_WHATSAPP, IOS_WHATSAPP_FRIENDLY
 
 # For the ZMESSAGETYPE column in ZWAMESSAGE
@@ -40,6 +46,23 @@ class IosWhatsappContact:
     push_name: str | None
 
 
+@dataclass
+class IosWhatsappCache:
+    """
+    Contacts and sessions read from ChatStorage.sqlite.
+
+    This is held in the provider's caches, which may discard it at any time, so it must be looked up once per
+    operation and passed around rather than stored.
+    """
+    contacts: dict[str, Contact]  # by JID
+    sessions_by_id: dict[int, MessageSession]  # by ZWACHATSESSION.Z_PK
+
+    def approximate_size(self):
+        return approximate_size(list(self.contacts.values())) \
+            + approximate_size(list(self.sessions_by_id.values())) \
+            + sys.getsizeof(self.contacts) + sys.getsizeof(self.sessions_by_id)
+
+
 class IOSWhatsApp(Provider):
     NAME = IOS_WHATSAPP
     FRIENDLY_NAME = IOS_WHATSAPP_FRIENDLY
@@ -48,9 +71,8 @@ class IOSWhatsApp(Provider):
 
     def __init__(self, fs):
         self.fs = fs
-        self.msgdb = fs.sqlite3_connect(self.CHATSTORAGE_DB, read_only=True)
-        self.contacts = {}  # {jid: Contact}
-        self._contacts_loaded = False
+        self.msgdb = ThreadLocalConnection(lambda: fs.sqlite3_connect(self.CHATSTORAGE_DB, read_only=True))
+        self._cache_lock = threading.Lock()
 
     @classmethod
     def from_filesystem(cls, fs):
@@ -59,16 +81,7 @@ class IOSWhatsApp(Provider):
         """
         return cls(fs) if fs.exists(cls.CHATSTORAGE_DB) else None
 
-    def search_events(self, device, filter_):
-        """
-        Search for events matching filter_, which is an EventFilter.
-        """
-        if filter_ and not filter_.accepts_type('MessageEvent'):
-            # We only support MessageEvents
-            return []
-
-        self._load_contacts()
-
+    def _construct_query(self, device, filter_, temp_keys, ordered=True):
         message_table = Table('ZWAMESSAGE')
         group_member_table = Table('ZWAGROUPMEMBER')
 
@@ -79,53 +92,126 @@ class IOSWhatsApp(Provider):
                 message_table.ZGROUPMEMBER, group_member_table.ZMEMBERJID) \
             .where(message_table.ZMESSAGETYPE == MESSAGE_TYPE_TEXT)
 
-        fields = get_field_indices(query)
+        if filter_:
+            if filter_.timestamp_start:
+                query = query.where(message_table.ZMESSAGEDATE >= self._datetime_to_timestamp(filter_.timestamp_start))
+            if filter_.timestamp_end:
+                query = query.where(message_table.ZMESSAGEDATE < self._datetime_to_timestamp(filter_.timestamp_end))
 
-        wa_sessions = {}
+            participant_local_ids = filter_.participant_local_ids(device.id_, self.NAME)
+            if participant_local_ids is not None:
+                query = query.where(self._participants_criterion(participant_local_ids, message_table,
+                                                                 group_member_table))
 
-        for row in self.msgdb.execute(str(query)):
-            session_id = row[fields['ZCHATSESSION']]
+            event_local_ids = filter_.event_local_ids(device.id_, self.NAME)
+            if event_local_ids is not None:
+                query = query.where(temp_keys.isin(message_table.Z_PK, [int(event_id) for event_id in event_local_ids]))
+            elif filter_.text_regex is not None:
+                query = query.where(message_table.ZTEXT.regexp(regex_sql_pattern(filter_.text_regex)))
 
-            if session_id not in wa_sessions:
-                wa_sessions[session_id] = self._create_session(session_id)
+        if ordered:
+            query = query.orderby(message_table.ZMESSAGEDATE, message_table.Z_PK)
 
-            if row[fields['ZISFROMME']] == 1:
-                sender_jid = None
-            elif row[fields['ZGROUPMEMBER']] is not None:
-                # In group chats, ZFROMJID is the group JID, and the sender is found in the
-                # ZWAGROUPMEMBER table.
-                sender_jid = row[fields['ZMEMBERJID']]
-            else:
-                # In private chats, ZFROMJID is the sender's JID.
-                sender_jid = row[fields['ZFROMJID']]
+        return query
 
-            provider_data = IosWhatsappMessageEvent(
-                group_member=row[fields['ZGROUPMEMBER']],
-                chat_session_id=session_id
-            )
+    def _message_sender(self, cache, device, is_from_me, group_member, member_jid, from_jid):
+        if is_from_me:
+            return device.device_operator_contact
 
-            if bool(row[fields['ZISFROMME']]):
-                sender = device.device_operator_contact
-            elif sender_jid:
-                sender = self._jid_to_contact(sender_jid)
-            else:
-                sender = device.unknown_contact
+        if group_member is not None:
+            # In group chats, ZFROMJID is the group JID, and the sender is found in the
+            # ZWAGROUPMEMBER table.
+            sender_jid = member_jid
+        else:
+            # In private chats, ZFROMJID is the sender's JID.
+            sender_jid = from_jid
 
-            yield MessageEvent(
-                id_=row[fields['Z_PK']],
-                session_id=session_id,
-                session=wa_sessions[session_id],
-                timestamp=self._timestamp_to_datetime(row[fields['ZMESSAGEDATE']]),
-                provider=self,
-                provider_data=provider_data,
-                text=row[fields['ZTEXT']],
-                from_me=bool(row[fields['ZISFROMME']]),
-                sender=sender,
-            )
+        return self._jid_to_contact(cache.contacts, sender_jid) if sender_jid else device.unknown_contact
+
+    def search_events(self, device, filter_):
+        """
+        Search for events matching filter_, which is an EventFilter.
+        """
+        if filter_ and not filter_.accepts_type('MessageEvent'):
+            # We only support MessageEvents
+            return []
+
+        cache = self._cache()
+
+        conn = self.msgdb.connection()
+        with TempKeyTables(conn) as temp_keys:
+            query = self._construct_query(device, filter_, temp_keys)
+
+            fields = get_field_indices(query)
+
+            for row in conn.execute(str(query)):
+                session_id = row[fields['ZCHATSESSION']]
+
+                provider_data = IosWhatsappMessageEvent(
+                    group_member=row[fields['ZGROUPMEMBER']],
+                    chat_session_id=session_id
+                )
+
+                sender = self._message_sender(cache, device, row[fields['ZISFROMME']], row[fields['ZGROUPMEMBER']],
+                                              row[fields['ZMEMBERJID']], row[fields['ZFROMJID']])
+
+                yield MessageEvent(
+                    id_=row[fields['Z_PK']],
+                    session_id=session_id,
+                    session=self._get_session(cache, session_id),
+                    timestamp=self._timestamp_to_datetime(row[fields['ZMESSAGEDATE']]),
+                    provider=self,
+                    provider_data=provider_data,
+                    text=row[fields['ZTEXT']],
+                    from_me=bool(row[fields['ZISFROMME']]),
+                    sender=sender,
+                )
+
+    def count_events(self, device, filter_, group_by):
+        if filter_.participant_ids:
+            # The participants criterion selects more messages than match, so the events must be checked one by one.
+            return None
+
+        if not filter_.accepts_type('MessageEvent'):
+            return Counter()
+
+        cache = self._cache()
+
+        conn = self.msgdb.connection()
+        with TempKeyTables(conn) as temp_keys:
+            messages = self._construct_query(device, filter_, temp_keys, ordered=False)
+
+            columns = []
+            if GROUP_BY_TIME.intersection(group_by):
+                columns.append(fn.Cast(messages.ZMESSAGEDATE / BUCKET_SECONDS, SqlTypes.INTEGER).as_('bucket'))
+            if SENDER in group_by:
+                columns.extend([messages.ZISFROMME, messages.ZGROUPMEMBER, messages.ZMEMBERJID, messages.ZFROMJID])
+            if SESSION in group_by:
+                columns.append(messages.ZCHATSESSION)
+
+            query = Query.from_(messages).select(*columns, fn.Count('*').as_('count'))
+            if columns:
+                query = query.groupby(*columns)
+
+            fields = get_field_indices(query)
+
+            counts = Counter()
+            for row in conn.execute(str(query)):
+                key = make_key(
+                    group_by, device, self,
+                    timestamp=self._timestamp_to_datetime(row[fields['bucket']] * BUCKET_SECONDS)
+                    if 'bucket' in fields else None,
+                    sender=self._message_sender(cache, device, row[fields['ZISFROMME']], row[fields['ZGROUPMEMBER']],
+                                                row[fields['ZMEMBERJID']], row[fields['ZFROMJID']])
+                    if SENDER in group_by else None,
+                    session_local_id=row[fields['ZCHATSESSION']] if SESSION in group_by else None,
+                )
+                counts[key] += row[fields['count']]
+
+        return counts
 
     def search_contacts(self, filter_):
-        self._load_contacts()
-        return self.contacts.values()
+        return list(self._cache().contacts.values())
 
     PII_FIELDS = {
         'sqlite3': {
@@ -186,56 +272,118 @@ class IOSWhatsApp(Provider):
         # TODO
         return []
 
-    def _create_session(self, session_id):
-        chat_table = Table('ZWACHATSESSION')
+    def _read_sessions(self, contacts):
+        """
+        Read every chat session and its group members. Return a mapping of session ID to MessageSession.
+        """
+        group_member_table = Table('ZWAGROUPMEMBER')
+        query = Query.from_(group_member_table) \
+            .select(group_member_table.ZCHATSESSION, group_member_table.ZMEMBERJID) \
+            .orderby(group_member_table.ZCHATSESSION, group_member_table.Z_PK)
 
+        field_names = get_field_indices(query)
+
+        members_by_session_id = defaultdict(list)
+        for row in self.msgdb.execute(str(query)):
+            members_by_session_id[row[field_names['ZCHATSESSION']]].append(row[field_names['ZMEMBERJID']])
+
+        chat_table = Table('ZWACHATSESSION')
         query = Query.from_(chat_table)\
-            .select(chat_table.ZCONTACTJID, chat_table.ZPARTNERNAME, chat_table.ZGROUPINFO) \
-            .where(chat_table.Z_PK == session_id)
+            .select(chat_table.Z_PK, chat_table.ZCONTACTJID, chat_table.ZPARTNERNAME, chat_table.ZGROUPINFO)
 
         field_names = get_field_indices(query)
 
-        chat = self.msgdb.execute(str(query)).fetchone()
-        if not chat:
-            return MessageSession(local_id=session_id, provider=self,
-                                  name="Unknown wa-ios session", participants=tuple())
+        sessions_by_id = {}
+        for chat in self.msgdb.execute(str(query)):
+            session_id = chat[field_names['Z_PK']]
 
-        if chat[field_names['ZGROUPINFO']] is not None:
-            # Group chat
-            group_member_table = Table('ZWAGROUPMEMBER')
-            query = Query.from_(group_member_table)\
-                .select(group_member_table.ZMEMBERJID) \
-                .where(group_member_table.ZCHATSESSION == session_id)
+            # Every chat is read here, not only those searched, so skip any without a JID rather than failing.
+            if chat[field_names['ZGROUPINFO']] is not None:
+                # Group chat
+                member_jids = members_by_session_id[session_id]
+            else:
+                # Private chat
+                member_jids = [chat[field_names['ZCONTACTJID']]]
 
-            participants = [self._jid_to_contact(member[0]) for member in self.msgdb.execute(str(query))]
-        else:
-            # Private chat
-            participants = [self._jid_to_contact(chat[field_names['ZCONTACTJID']])]
+            participants = [self._jid_to_contact(contacts, jid) for jid in member_jids if jid is not None]
+
+            sessions_by_id[session_id] = MessageSession(
+                local_id=session_id,
+                provider=self,
+                name=chat[field_names['ZPARTNERNAME']],
+                participants=tuple(participants))
 
-        return MessageSession(
-            local_id=session_id,
-            provider=self,
-            name=chat[field_names['ZPARTNERNAME']],
-            participants=tuple(participants))
+        return sessions_by_id
 
-    def _jid_to_contact(self, jid):
-        # Contacts should have been loaded already. If for some reason we encounter an unexpected JID,
-        # just make something up:
-        self._make_or_update_contact(jid)
+    def _get_session(self, cache, session_id):
+        session = cache.sessions_by_id.get(session_id)
+        if session is None:
+            session = MessageSession(local_id=session_id, provider=self,
+                                     name="Unknown wa-ios session", participants=tuple())
 
-        return self.contacts[jid]
+        return session
+
+    def _participants_criterion(self, jids, message_table, group_member_table):
+        """
+        Return a criterion selecting messages which may involve any of the contacts with the given JIDs.
+
+        A message involves a contact if the contact sent it or is a participant in its chat session. The criterion
+        may also select some other messages; EventsFilter.matches() makes the final decision.
+        """
+        jids = list(jids)
+        chat_table = Table('ZWACHATSESSION')
+        member_table = Table('ZWAGROUPMEMBER')
+
+        private_session_ids = Query.from_(chat_table) \
+            .select(chat_table.Z_PK) \
+            .where(chat_table.ZCONTACTJID.isin(jids))
+        group_session_ids = Query.from_(member_table) \
+            .select(member_table.ZCHATSESSION) \
+            .where(member_table.ZMEMBERJID.isin(jids))
+
+        return message_table.ZFROMJID.isin(jids) \
+            | group_member_table.ZMEMBERJID.isin(jids) \
+            | message_table.ZCHATSESSION.isin(private_session_ids) \
+            | message_table.ZCHATSESSION.isin(group_session_ids)
+
+    def _jid_to_contact(self, contacts, jid):
+        contact = contacts.get(jid)
+        if contact is None:
+            # Contacts should have been loaded already. If for some reason we encounter an unexpected JID,
+            # just make something up:
+            contact = self._make_or_update_contact(contacts, jid)
+
+        return contact
 
     def _timestamp_to_datetime(self, timestamp):
         return datetime.datetime.fromtimestamp(WA_IOS_TS_OFFSET + float(timestamp))
 
-    def _load_contacts(self):
+    def _datetime_to_timestamp(self, dt):
+        return dt.timestamp() - WA_IOS_TS_OFFSET
+
+    def _cache(self) -> IosWhatsappCache:
+        """
+        Return the cached contacts and sessions, reading them if they aren't cached.
+        """
+        # The lock stops concurrent searches from reading the database more than once.
+        with self._cache_lock:
+            return self.caches.get_or_compute(self, self._read_cache, IosWhatsappCache.approximate_size)
+
+    def source_fingerprint(self):
+        return self.fs.fingerprint(self.CHATSTORAGE_DB)
+
+    def release_caches(self):
+        self.caches.discard(self)
+
+    def _read_cache(self):
+        contacts = self._read_contacts()
+        return IosWhatsappCache(contacts=contacts, sessions_by_id=self._read_sessions(contacts))
+
+    def _read_contacts(self):
         # iOS WhatsApp contacts have even less information than Android ones. We basically get the JID and
         # maybe a name.
         # Contact information is also split between ZWACHATSESSION and ZWAGROUPMEMBER. If the contact only
         # appears in group chats, it will only be in ZWAGROUPMEMBER.
-        if self._contacts_loaded:
-            return
-
         chat_table = Table('ZWACHATSESSION')
         push_name_table = Table('ZWAPROFILEPUSHNAME')
 
@@ -248,12 +396,13 @@ class IOSWhatsApp(Provider):
 
         field_names = get_field_indices(query)
 
-        self.contacts = {}
+        contacts = {}
 
         for row in self.msgdb.execute(str(query)):
             jid = row[field_names['ZCONTACTJID']]
-            if jid not in self.contacts:
+            if jid not in contacts:
                 self._make_or_update_contact(
+                    contacts,
                     jid,
                     partner_name=row[field_names['ZPARTNERNAME']],
                     push_name=row[field_names['ZPUSHNAME']],
@@ -274,18 +423,19 @@ class IOSWhatsApp(Provider):
         for row in self.msgdb.execute(str(query)):
             jid = row[field_names['ZMEMBERJID']]
             self._make_or_update_contact(
+                contacts,
                 jid,
                 push_name=row[field_names['ZPUSHNAME']],
                 group_member_pk=row[field_names['Z_PK']],
                 profile_push_name_id=row[field_names['PUSH_PK']])
 
-        self._contacts_loaded = True
+        return contacts
 
-    def _make_or_update_contact(self, jid, partner_name=None, push_name=None, chat_session_id=None,
+    def _make_or_update_contact(self, contacts, jid, partner_name=None, push_name=None, chat_session_id=None,
             profile_push_name_id=None, group_member_pk=None):
         assert jid is not None
 
-        if jid not in self.contacts:
+        if jid not in contacts:
             provider_data = IosWhatsappContact(
                 chat_session_ids=[],
                 profile_push_name_id=profile_push_name_id,
@@ -306,9 +456,9 @@ class IOSWhatsApp(Provider):
 
             contact.name.display = partner_name or push_name or jid
 
-            self.contacts[jid] = contact
+            contacts[jid] = contact
         else:
-            contact = self.contacts[jid]
+            contact = contacts[jid]
 
         if chat_session_id is not None:
             contact.provider_data.chat_session_ids.append(chat_session_id)
@@ -316,7 +466,9 @@ class IOSWhatsApp(Provider):
         if group_member_pk is not None:
             contact.provider_data.group_member_pks.append(group_member_pk)
 
-    def get_media(self, local_id):
+        return contact
+
+    def get_media(self, device, local_id):
         """
         Return the pathname, relative to the filesystem, of media identified by 'local_id'.
         """
@@ -3,6 +3,7 @@
 # Copyright 2023 Telemarq Ltd
 
 from abc import ABC, abstractmethod
+import threading
 
 
 class LazyContactProvider(ABC):
@@ -36,14 +37,18 @@ class LazyContactProviderContacts(dict):
     def __init__(self, provider: LazyContactProvider):
         super().__init__()
         self._loaded = False
+        self._load_lock = threading.Lock()
         self.provider = provider
 
     def _load(self):
         if not self._loaded:
-            for kwargs in self.provider.contact_load_all():
-                obj = self.provider.contact_create(**kwargs)
-                super().__setitem__(obj.local_id, obj)
-            self._loaded = True
+            # Providers may be searched from several threads at once; load the contacts only once.
+            with self._load_lock:
+                if not self._loaded:
+                    for kwargs in self.provider.contact_load_all():
+                        obj = self.provider.contact_create(**kwargs)
+                        super().__setitem__(obj.local_id, obj)
+                    self._loaded = True
 
     def __getitem__(self, key):
         key = str(key)
@@ -0,0 +1,104 @@
+# This software is released under the terms of the GNU GENERAL PUBLIC LICENSE.
+# See LICENSE.txt for full details.
+# Copyright 2023 Telemarq Ltd
+
+"""
+A least-recently-used cache of query results with a memory budget.
+"""
+from collections import OrderedDict
+import dataclasses
+import sys
+import threading
+
+
+def approximate_size(objects):
+    """
+    Return a rough estimate, in bytes, of the memory used by a list of dataclass instances and their string fields.
+
+    Objects referred to by more than one instance, such as contacts and sessions, are not counted.
+    """
+    size = sys.getsizeof(objects)
+    for obj in objects:
+        size += sys.getsizeof(obj)
+        for field in dataclasses.fields(obj):
+            value = getattr(obj, field.name)
+            if isinstance(value, str):
+                size += sys.getsizeof(value)
+
+    return size
+
+
+class ResultCache:
+    """
+    Maps keys to query results, discarding the least recently used results when their total size exceeds max_bytes.
+
+    clear() discards everything. Results computed while the cache was being cleared are not stored, as they may
+    predate the change which caused the clear.
+
+    A result larger than max_bytes is not stored, unless 'keep_oversized' is true. Then the most recent such result is
+    kept outside the budget, replacing any earlier one, so that it doesn't evict the smaller results.
+    """
+    def __init__(self, max_bytes, keep_oversized=False):
+        self.max_bytes = max_bytes
+        self.keep_oversized = keep_oversized
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._size = 0  # of every entry but the oversized one
+        self._oversized_key = None
+        self._generation = 0
+
+    def get_or_compute(self, key, compute_fn, size_fn):
+        """
+        Return the cached value for 'key', or call compute_fn() to produce it and cache it with size size_fn(value).
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+
+            generation = self._generation
+
+        value = compute_fn()
+        size = size_fn(value)
+
+        with self._lock:
+            if generation == self._generation and key not in self._entries:
+                self._store(key, value, size)
+
+        return value
+
+    def _store(self, key, value, size):
+        if size <= self.max_bytes:
+            self._entries[key] = (value, size)
+            self._size += size
+
+            # The newest result fits in the budget, so is never evicted.
+            while self._size > self.max_bytes:
+                evicted_key = next(k for k in self._entries if k != self._oversized_key)
+                _value, evicted_size = self._entries.pop(evicted_key)
+                self._size -= evicted_size
+        elif self.keep_oversized:
+            if self._oversized_key is not None:
+                del self._entries[self._oversized_key]
+
+            self._entries[key] = (value, size)
+            self._oversized_key = key
+
+    def discard(self, key):
+        with self._lock:
+            if key == self._oversized_key:
+                del self._entries[key]
+                self._oversized_key = None
+            elif key in self._entries:
+                _value, size = self._entries.pop(key)
+                self._size -= size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self._oversized_key = None
+            self._generation += 1
+
+    def __len__(self):
+        return len(self._entries)
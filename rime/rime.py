@@ -4,6 +4,7 @@
 
 import asyncio
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 import os
 import threading
@@ -16,6 +17,8 @@ from .config import Config
 from .plugins import load_plugin
 from .device import Device
 from .errors import NotEncryptedDeviceType, DeviceNotFound
+from .resultcache import ResultCache
+from .thumbnails import Thumbnailer, ORIGINAL, SIZES as THUMBNAIL_SIZES
 
 
 FILESYSTEM_REGISTRY = threading.local()
@@ -45,6 +48,30 @@ class Rime:
         self._event_listeners = defaultdict(set[AsyncEventListener])  # event_name -> {listener, ...}
         self._events_queue = asyncio.Queue()
 
+        # Providers are searched in parallel on this pool. Each provider thread uses its own database connection.
+        search_config = constants.get('search') or {}
+        self.search_executor = ThreadPoolExecutor(max_workers=search_config.get('threads'),
+                                                  thread_name_prefix='rime-search')
+        self.search_batch_size = search_config.get('batch_size', 256)
+
+        # Caches for newly-registered devices are filled one device at a time, in the background.
+        self.cache_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='rime-cache')
+
+        # Results of recent queries. Cleared whenever devices are added, removed or changed.
+        result_cache_config = constants.get('result_cache') or {}
+        self.result_cache = ResultCache(max_bytes=result_cache_config.get('max_megabytes', 256) * 1024 * 1024)
+
+        # Data read by providers, such as contacts and sessions. This budget is shared by all devices. The most recent
+        # item larger than the whole budget is kept as well, outside it, as it would otherwise be read again for every
+        # search.
+        provider_cache_config = constants.get('provider_cache') or {}
+        self.provider_caches = ResultCache(max_bytes=provider_cache_config.get('max_megabytes', 512) * 1024 * 1024,
+                                           keep_oversized=True)
+
+        # Scaled versions of media are produced on this pool and kept in each device's cache directory.
+        thumbnails_config = constants.get('thumbnails') or {}
+        self.thumbnailer = Thumbnailer(threads=thumbnails_config.get('threads'))
+
         self.rescan_devices()
 
         self.media_prefix = media_prefix
@@ -62,6 +89,7 @@ class Rime:
     def rescan_devices(self):
         registry = FILESYSTEM_REGISTRY.registry
         registry.rescan()
+        self.result_cache.clear()
 
         if not hasattr(DEVICE_CACHE, 'devices'):
             DEVICE_CACHE.devices = []
@@ -69,13 +97,22 @@ class Rime:
         new_devices = []
         old_devices = {}
         for device in DEVICE_CACHE.devices:
-            if device.id_ in registry.filesystems:
+            # Devices whose filesystem the registry has replaced are recreated.
+            if registry.filesystems.get(device.id_) is device.fs:
                 old_devices[device.id_] = device
+            else:
+                device.release_caches()
 
         for device_id, fs in registry.filesystems.items():
             if device_id not in old_devices:
-                device = Device(device_id, fs, self.session)
+                device = Device(device_id, fs, self.session, self.provider_caches, registry.cache_path_for(device_id))
                 new_devices.append(device)
+                self.cache_executor.submit(device.warm_caches)
+
+        # Devices which remain are warmed again, so that data read ahead of searches, such as file metadata, catches
+        # up with any changes to them.
+        for device in old_devices.values():
+            self.cache_executor.submit(device.warm_caches)
 
         DEVICE_CACHE.devices = new_devices + list(old_devices.values())
 
@@ -116,13 +153,18 @@ class Rime:
             raise ValueError(f"Device ID {new_device_id} already exists")
 
         new_fs = self.filesystem_registry.create_empty_subset_of(device.fs, new_device_id, locked=locked)
-        new_device = Device(new_device_id, new_fs, self.session)
+        new_device = Device(new_device_id, new_fs, self.session, self.provider_caches,
+                            self.filesystem_registry.cache_path_for(new_device_id))
         self.devices.append(new_device)
 
         return new_device
 
     def delete_device(self, device_id: str) -> bool:
+        if device := self._device_for_id.get(device_id):
+            device.release_caches()
+
         self.filesystem_registry.delete(device_id)
+        self.result_cache.clear()
 
         self.publish_event('device_list_updated')
 
@@ -148,6 +190,8 @@ class Rime:
         # state to GraphQL subscribed clients
         try:
             target_device.decrypt(passphrase)
+            self.cache_executor.submit(target_device.warm_caches)
+            self.result_cache.clear()
             self.publish_event('device_list_updated')
             return True
         except NotEncryptedDeviceType:
@@ -191,20 +235,30 @@ class Rime:
                     raise ValueError(f"Unknown event listener type {type(listener)}")
 
     def publish_event(self, event_name, *args):
+        if event_name == 'device_list_updated':
+            self.result_cache.clear()
+
         self._events_queue.put_nowait((event_name, args))
 
-    def get_media(self, media_path):
+    def get_media(self, media_path, size=ORIGINAL):
         """
-        Return (handle, content-type)
+        Return the MediaData of the media identified by 'media_path'.
 
-        where 'handle' is a file-like object representing the media, and 'content-type' is a string
+        'size' is ORIGINAL, or one of the names in THUMBNAIL_SIZES for a scaled JPEG version where one can be made.
         """
+        if size != ORIGINAL and size not in THUMBNAIL_SIZES:
+            raise ValueError(f"Unknown media size: {size}")
+
         device_id, provider_name, local_id = media_path.split(':', 2)
 
         device = self.device_for_id(device_id)
         provider = device.providers[provider_name]
 
-        return provider.get_media(local_id)
+        return self.thumbnailer.get_media(
+            device, media_path, size,
+            lambda: provider.get_media(device, local_id),
+            media_version_fn=lambda: provider.media_version(device, local_id),
+        )
 
     def get_constant(self, path: list[str], default):
         if not isinstance(path, list):
@@ -227,7 +281,9 @@ class Rime:
         if not hasattr(FILESYSTEM_REGISTRY, 'registry'):
             FILESYSTEM_REGISTRY.registry = FilesystemRegistry(
                 base_path=config.get_pathname('filesystem.base_path'),
-                passphrases=config.get('filesystem').get('passphrases')
+                passphrases=config.get('filesystem').get('passphrases'),
+                cache_path=config.get_pathname('filesystem.cache_path')
+                if config.get('filesystem').get('cache_path') else None
             )
 
         session = Session(config.get_pathname('session.database'))
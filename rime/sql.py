@@ -5,20 +5,30 @@
 """
 Thin wrapper around pypika with methods to perform subsetting and helpers in sqlite databases.
 """
+import io
+import itertools
 import re
 import sys
+import threading
+import weakref
 
 import pypika
+import pypika.enums
+import pypika.functions
 import sqlite3
 
 Table = pypika.Table
 Query = pypika.Query
 Column = pypika.Column
 Parameter = pypika.Parameter
+functions = pypika.functions
+Case = pypika.Case
+SqlTypes = pypika.enums.SqlTypes
 
 
 def _sqlite3_regexp_search(pattern, input):
-    return bool(re.search(pattern, input))
+    # NULL never matches.
+    return input is not None and bool(re.search(pattern, str(input)))
 
 
 _threadsafety = None
@@ -75,5 +85,202 @@ def sqlite3_connect_filename(path, read_only=True):
     return sqlite3_connect(f"file://{path}{params}", uri=True)
 
 
+class ThreadLocalConnection:
+    """
+    An sqlite3 connection which is opened separately in each thread that uses it.
+
+    Providers may be searched from several threads at once; giving each thread its own connection lets their queries
+    run concurrently rather than queueing on a single connection. 'connect_fn' is called with no arguments to open a
+    new connection. The connection for the creating thread is opened immediately so that errors are raised early.
+    A thread's connection is forgotten when the thread ends, and closed once nothing else is using it.
+
+    Connections should be read-only. connect_fn() is called once per thread, and filesystems may give each writable
+    connection a private copy of the database (see DeviceFilesystem.sqlite3_connect()), so writes made in one thread
+    would not be seen by the others. Use a single connection for writing.
+    """
+    def __init__(self, connect_fn):
+        self._connect_fn = connect_fn
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = weakref.WeakKeyDictionary()  # thread -> its connection
+        self._get()
+
+    def _get(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect_fn()
+            with self._lock:
+                self._connections[threading.current_thread()] = conn
+
+        return conn
+
+    def connection(self) -> sqlite3.Connection:
+        """
+        Return the connection for the calling thread, for use by statements which must share a connection.
+        """
+        return self._get()
+
+    def execute(self, *args):
+        return self._get().execute(*args)
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+    def close(self):
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+
+        for conn in connections:
+            conn.close()
+
+
+_temp_key_table_ids = itertools.count()
+
+
+class TempKeyTables:
+    """
+    Temporary tables of keys on the connection 'conn', for criteria selecting rows by more keys than should be listed
+    in the text of a query. The tables are dropped when the context exits.
+
+    Queries using the criteria must be run on 'conn': use ThreadLocalConnection.connection() to pin a thread's
+    connection for the life of the context.
+    """
+    def __init__(self, conn):
+        self._conn = conn
+        self._names = []
+
+    def isin(self, term, keys):
+        """
+        Return a criterion for rows where 'term' is one of 'keys'.
+        """
+        name = f'keys_{next(_temp_key_table_ids)}'
+        with self._conn:
+            self._conn.execute(f'CREATE TEMP TABLE {name} (key)')
+            self._names.append(name)
+            self._conn.executemany(f'INSERT INTO temp.{name} (key) VALUES (?)', ((key,) for key in keys))
+
+        return term.isin(Query.from_(Table(name, schema='temp')).select('key'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        for name in self._names:
+            try:
+                self._conn.execute(f'DROP TABLE temp.{name}')
+            except sqlite3.OperationalError:
+                # A table can't be dropped while another statement is running on the connection, so just empty it.
+                with self._conn:
+                    self._conn.execute(f'DELETE FROM temp.{name}')
+
+        self._names = []
+
+
+class _SubstrBlobReader(io.RawIOBase):
+    """
+    Reads a BLOB in chunks with substr(), for Python versions without incremental BLOB I/O.
+    """
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, conn, table, column, rowid):
+        super().__init__()
+        self._conn = conn
+        self._sql = f'SELECT substr("{column}", ?, ?) FROM "{table}" WHERE rowid = ?'
+        self._rowid = rowid
+        self._offset = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.CHUNK_SIZE)
+        row = self._conn.execute(self._sql, (self._offset + 1, size, self._rowid)).fetchone()
+        data = row[0] if row and row[0] else b''
+        buffer[:len(data)] = data
+        self._offset += len(data)
+        return len(data)
+
+
+def open_blob(conn, table, column, rowid):
+    """
+    Return a read-only file-like object for the BLOB in 'column' of row 'rowid' of 'table', which reads the BLOB
+    as it is consumed rather than loading it into memory.
+    """
+    if hasattr(conn, 'blobopen'):
+        # Python >= 3.11
+        return conn.blobopen(table, column, rowid, readonly=True)
+
+    return io.BufferedReader(_SubstrBlobReader(conn, table, column, rowid), _SubstrBlobReader.CHUNK_SIZE)
+
+
+_REGEX_SPECIAL_CHARACTERS = frozenset('.^$*+?{}[]\\|()')
+_REGEX_OPTIONAL_QUANTIFIERS = frozenset('*?{')
+_REGEX_INLINE_FLAGS = ((re.ASCII, 'a'), (re.IGNORECASE, 'i'), (re.MULTILINE, 'm'), (re.DOTALL, 's'), (re.VERBOSE, 'x'))
+
+
+def regex_sql_pattern(regex):
+    """
+    Return the pattern of the compiled 'regex' for the REGEXP function. REGEXP is only given the pattern, so the
+    regex's flags are written into it inline.
+    """
+    flags = ''.join(letter for flag, letter in _REGEX_INLINE_FLAGS if regex.flags & flag)
+    return f'(?{flags}){regex.pattern}' if flags else regex.pattern
+
+
+def _regex_literal_prefix(regex):
+    """
+    Return (prefix, rest) where 'prefix' is literal text with which every string matched by regex.match() begins,
+    and 'rest' is the remainder of the pattern. 'prefix' is empty if there is no such text.
+    """
+    pattern = regex.pattern
+    if regex.flags & (re.IGNORECASE | re.VERBOSE) or '|' in pattern:
+        return '', pattern
+
+    if pattern.startswith('^'):
+        pattern = pattern[1:]
+
+    prefix = []
+    end = 0
+    while end < len(pattern):
+        if pattern[end] == '\\' and end + 1 < len(pattern) and not pattern[end + 1].isalnum():
+            # An escaped punctuation character, such as '\+', is literal.
+            literal, length = pattern[end + 1], 2
+        elif pattern[end] in _REGEX_SPECIAL_CHARACTERS:
+            break
+        else:
+            literal, length = pattern[end], 1
+
+        # A quantifier which permits zero repetitions makes the character before it optional.
+        if end + length < len(pattern) and pattern[end + length] in _REGEX_OPTIONAL_QUANTIFIERS:
+            break
+
+        prefix.append(literal)
+        end += length
+
+    return ''.join(prefix), pattern[end:]
+
+
+def regex_match_criterion(term, regex):
+    """
+    Return a criterion for rows where 'term' may match the compiled 'regex' as regex.match() does.
+
+    A literal prefix of the pattern becomes a range predicate, which SQLite can answer from an index on 'term', and
+    the REGEXP function is only called if the rest of the pattern needs it. As REGEXP searches rather than matches,
+    the criterion can select more rows than match; callers should check the results with regex.match().
+    """
+    prefix, rest = _regex_literal_prefix(regex)
+
+    criterion = None
+    if prefix:
+        criterion = (term >= prefix) & (term < prefix[:-1] + chr(ord(prefix[-1]) + 1))
+
+    if rest in ('', '.*'):
+        return criterion if criterion is not None else term.notnull()
+
+    regexp = term.regexp(regex_sql_pattern(regex))
+    return criterion & regexp if criterion is not None else regexp
+
+
 def get_field_indices(query):
     return {select.alias or select.name: idx for idx, select in enumerate(query._selects)}
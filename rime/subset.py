@@ -10,8 +10,9 @@ from enum import Enum
 import re
 import shutil
 from contextlib import contextmanager
+from urllib.parse import quote
 
-from .sql import Table, Query, Parameter
+from .sql import Table, Query, TempKeyTables, ThreadLocalConnection
 
 MATCH_COLLATE = re.compile(r'COLLATE \w+', re.IGNORECASE)
 
@@ -21,26 +22,74 @@ def _sanitise_create_table_sql(sql):
     return MATCH_COLLATE.sub('', sql)
 
 
-def _copy_table(src_conn, dst_conn, table_name, add_where_clause_fn):
+def _main_db_path(conn):
+    """
+    Return the pathname of the main database of 'conn', or None if it is not stored in a file.
+    """
+    for _seq, name, path in conn.execute('PRAGMA database_list'):
+        if name == 'main':
+            return path or None
+
+    return None
+
+
+@contextmanager
+def _attached(src_conn, dst_conn):
+    """
+    Attach the source database to 'dst_conn' as 'src' for the duration of the context, so that rows can be copied
+    with INSERT ... SELECT. Yields False, and attaches nothing, if the source database is not stored in a file.
+    """
+    src_path = _main_db_path(src_conn)
+    if src_path is None:
+        yield False
+        return
+
+    dst_conn.execute('ATTACH DATABASE ? AS src', (f'file:{quote(src_path)}?mode=ro&immutable=1',))
+    try:
+        yield True
+        dst_conn.commit()
+    finally:
+        if dst_conn.in_transaction:
+            dst_conn.rollback()
+        dst_conn.execute('DETACH DATABASE src')
+
+
+def _copy_table(src_conn, dst_conn, is_attached, table_name, primary_key=None, keys=None):
+    """
+    Create 'table_name' in 'dst_conn' and copy rows into it from 'src_conn': those whose 'primary_key' is in 'keys'
+    or, if 'primary_key' is None, all of them.
+    """
     sql = src_conn.execute('select sql from sqlite_master where name = ?', (table_name,)).fetchone()[0]
     sql = _sanitise_create_table_sql(sql)
 
     dst_conn.execute(sql)
 
-    table = Table(table_name)
-    select_query = Query.from_(table) \
-        .select('*')
+    if is_attached:
+        # Copy the rows within SQLite, selecting them by joining against a temporary table of keys.
+        select_sql = f'SELECT * FROM src."{table_name}"'
+        if primary_key is not None:
+            dst_conn.execute('CREATE TEMP TABLE subset_keys (key)')
+            dst_conn.executemany('INSERT INTO temp.subset_keys (key) VALUES (?)', ((key,) for key in keys))
+            select_sql += f' WHERE "{primary_key}" IN (SELECT key FROM temp.subset_keys)'
+
+        dst_conn.execute(f'INSERT INTO main."{table_name}" {select_sql}')
+
+        if primary_key is not None:
+            dst_conn.execute('DROP TABLE temp.subset_keys')
+    else:
+        # Select the rows by joining against a temporary table of keys on the source connection instead.
+        if isinstance(src_conn, ThreadLocalConnection):
+            src_conn = src_conn.connection()
 
-    if add_where_clause_fn is not None:
-        select_query = add_where_clause_fn(select_query, table)
+        with TempKeyTables(src_conn) as temp_keys:
+            table = Table(table_name)
+            select_query = Query.from_(table).select('*')
+            if primary_key is not None:
+                select_query = select_query.where(temp_keys.isin(table[primary_key], keys))
 
-    # Recreate each row.
-    parameters = None
-    for row in src_conn.execute(select_query.get_sql()):
-        if parameters is None:
-            parameters = [Parameter('?') for _ in row]
-        insert_query = Query.into(table_name).insert(*parameters)
-        dst_conn.execute(insert_query.get_sql(), row)
+            cursor = src_conn.execute(select_query.get_sql())
+            placeholders = ', '.join('?' for _ in cursor.description)
+            dst_conn.executemany(f'INSERT INTO "{table_name}" VALUES ({placeholders})', cursor)
 
 
 SubsetFillOption = Enum('SubsetFillOption', ('MINIMAL', 'UNUSED_TABLES', 'UNUSED_DBS_AND_TABLES'))
@@ -84,20 +133,16 @@ class _RowSubset:
     def update(self, pks):
         self.rows.update(pks)
 
-    def copy(self, src_conn, dst_conn):
-        _copy_table(
-            src_conn,
-            dst_conn,
-            self.table_name,
-            lambda query, table: query.where(table[self.primary_key].isin(self.rows)))
+    def copy(self, src_conn, dst_conn, is_attached):
+        _copy_table(src_conn, dst_conn, is_attached, self.table_name, self.primary_key, self.rows)
 
 
 class _CompleteTable:
     def __init__(self, table_name):
         self.table_name = table_name
 
-    def copy(self, src_conn, dst_conn):
-        _copy_table(src_conn, dst_conn, self.table_name, None)
+    def copy(self, src_conn, dst_conn, is_attached):
+        _copy_table(src_conn, dst_conn, is_attached, self.table_name)
 
 
 class _DbSubset:
@@ -124,9 +169,10 @@ class ProviderSubsetter:
     def db_subset(self, *, src_conn, new_db_pathname):
         db_subset = _DbSubset()
         yield db_subset
-        with self._device_subsetter.sqlite3_create(new_db_pathname) as dst_conn:
+        with self._device_subsetter.sqlite3_create(new_db_pathname) as dst_conn, \
+                _attached(src_conn, dst_conn) as is_attached:
             for row_subset in db_subset.subsets:
-                row_subset.copy(src_conn, dst_conn)
+                row_subset.copy(src_conn, dst_conn, is_attached)
 
     def copy_file(self, handle, dst_path):
         with self._device_subsetter.create_file(dst_path) as dest_handle:
@@ -0,0 +1,198 @@
+# This software is released under the terms of the GNU GENERAL PUBLIC LICENSE.
+# See LICENSE.txt for full details.
+# Copyright 2023 Telemarq Ltd
+
+"""
+Full-text search over the text of message events.
+"""
+import itertools
+import re
+import threading
+
+from .event import MessageEvent
+from .filter import EventsFilter
+from .filesystem.ensuredir import ensuredir
+from .sql import sqlite3_connect
+
+
+_MESSAGES_FILTER = EventsFilter(type_names={'MessageEvent'})
+
+# Rows are added to the index in batches, so that searches need not wait for a whole provider to be indexed.
+INDEX_BATCH_ROWS = 10_000
+
+# Increment when the index's tables change. Indexes from other versions are discarded and rebuilt.
+TEXT_INDEX_VERSION = 2
+
+
+def fts_query(text_query):
+    """
+    Convert a user-supplied search string to an FTS5 query matching events which contain all of its words.
+
+    Words are matched literally, except that a trailing '*' matches the word as a prefix.
+    """
+    terms = []
+    for word in text_query.split():
+        prefix = word.endswith('*')
+        word = word.rstrip('*')
+        if word:
+            terms.append('"' + word.replace('"', '""') + '"' + ('*' if prefix else ''))
+
+    return ' '.join(terms)
+
+
+def text_regex(text_query):
+    """
+    Convert a user-supplied search string to a regex which, like fts_query(), searches for text containing all of
+    its words, ignoring case.
+
+    The regex is used for providers which have not been indexed yet. It approximates the index's tokenizer by
+    matching words at word boundaries.
+    """
+    lookaheads = []
+    for word in text_query.split():
+        prefix = word.endswith('*')
+        word = word.rstrip('*')
+        if word:
+            lookaheads.append(rf'(?=.*\b{re.escape(word)}' + ('' if prefix else r'\b') + ')')
+
+    # Like an empty FTS query, a query without words matches nothing.
+    return re.compile('(?is)^' + ''.join(lookaheads) if lookaheads else '(?!)')
+
+
+class TextIndex:
+    """
+    A per-device SQLite FTS5 index of message text, keyed by provider name, event ID and timestamp.
+
+    Providers are indexed by warm(), which is run in the background when the device is added. search() only answers
+    for providers whose index is complete and was built from the data the provider reads now, as identified by its
+    source_fingerprint(). The index is stored in 'db_path', or in memory if that is None, in which case it is rebuilt
+    every time RIME starts.
+    """
+    def __init__(self, db_path=None):
+        self.db_path = db_path
+        self._conn = None
+        self._fingerprints = {}  # provider name -> source fingerprint, for providers whose index is complete
+        self._lock = threading.Lock()
+        self._warm_lock = threading.Lock()  # held while providers are indexed, so each is indexed once
+
+    def _connect(self):
+        if self._conn is None:
+            if self.db_path:
+                ensuredir(self.db_path)
+                conn = sqlite3_connect(self.db_path)
+            else:
+                conn = sqlite3_connect(':memory:')
+
+            with conn:
+                if conn.execute("PRAGMA user_version").fetchone()[0] != TEXT_INDEX_VERSION:
+                    conn.execute("DROP TABLE IF EXISTS message_text")
+                    conn.execute("DROP TABLE IF EXISTS indexed_providers")
+                    conn.execute(f"PRAGMA user_version = {TEXT_INDEX_VERSION}")
+
+                conn.execute("""
+                    CREATE VIRTUAL TABLE IF NOT EXISTS message_text
+                    USING fts5(text, provider UNINDEXED, event_id UNINDEXED, timestamp UNINDEXED)
+                """)
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS indexed_providers (provider TEXT PRIMARY KEY, fingerprint TEXT)")
+
+            self._fingerprints = dict(conn.execute("SELECT provider, fingerprint FROM indexed_providers"))
+            self._conn = conn
+
+        return self._conn
+
+    def _is_indexed(self, provider_name, fingerprint):
+        return provider_name in self._fingerprints and self._fingerprints[provider_name] == fingerprint
+
+    def _index_provider(self, device, provider, fingerprint):
+        rows = (
+            (event.text, provider.NAME, str(event.id_), event.timestamp.timestamp())
+            for event in provider.search_events(device, _MESSAGES_FILTER)
+            if isinstance(event, MessageEvent) and event.text
+        )
+
+        with self._lock:
+            conn = self._connect()
+            # Discard the rows of an earlier attempt which didn't complete, or of an index of other data.
+            with conn:
+                conn.execute("DELETE FROM indexed_providers WHERE provider = ?", (provider.NAME,))
+                conn.execute("DELETE FROM message_text WHERE provider = ?", (provider.NAME,))
+                self._fingerprints.pop(provider.NAME, None)
+
+        # Events are read without holding the lock, which is only taken to add each batch.
+        while batch := list(itertools.islice(rows, INDEX_BATCH_ROWS)):
+            with self._lock, conn:
+                conn.executemany("INSERT INTO message_text (text, provider, event_id, timestamp) VALUES (?, ?, ?, ?)",
+                                 batch)
+
+        with self._lock, conn:
+            conn.execute("INSERT INTO indexed_providers (provider, fingerprint) VALUES (?, ?)",
+                         (provider.NAME, fingerprint))
+            self._fingerprints[provider.NAME] = fingerprint
+
+    def warm(self, device):
+        """
+        Index every provider of 'device' which isn't indexed yet, or whose data has changed since it was indexed.
+        """
+        with self._warm_lock:
+            with self._lock:
+                self._connect()
+
+            for provider in list(device.providers.values()):
+                # The fingerprint is taken before the events are read, so that changes made while they are read
+                # cause the provider to be indexed again.
+                fingerprint = provider.source_fingerprint()
+                if not self._is_indexed(provider.NAME, fingerprint):
+                    self._index_provider(device, provider, fingerprint)
+
+    def indexed_providers(self, device, provider_names=None) -> set[str]:
+        """
+        Return the names of the providers of 'device' whose index is complete and up to date. Only providers named in
+        'provider_names' are considered, unless it is None.
+        """
+        fingerprints = {
+            provider.NAME: provider.source_fingerprint() for provider in device.providers.values()
+            if provider_names is None or provider.NAME in provider_names
+        }
+
+        with self._lock:
+            self._connect()
+            return {name for name, fingerprint in fingerprints.items() if self._is_indexed(name, fingerprint)}
+
+    def search(self, device, text_query, provider_names=None) -> dict[str, set[str] | None]:
+        """
+        Return a mapping of provider name to the IDs (as strings) of the message events on 'device' whose text
+        matches 'text_query'. The IDs are None for providers which haven't been indexed yet; their events must be
+        matched against text_regex(text_query) instead.
+
+        Only providers named in 'provider_names' are searched, unless it is None.
+        """
+        query = fts_query(text_query)
+
+        providers = [
+            provider for provider in device.providers.values()
+            if provider_names is None or provider.NAME in provider_names
+        ]
+        fingerprints = {provider.NAME: provider.source_fingerprint() for provider in providers}
+
+        with self._lock:
+            conn = self._connect()
+
+            event_ids = {
+                provider.NAME: set() if self._is_indexed(provider.NAME, fingerprints[provider.NAME]) else None
+                for provider in providers
+            }
+
+            if query:
+                for provider_name, event_id in conn.execute(
+                        "SELECT provider, event_id FROM message_text WHERE message_text MATCH ?", (query,)):
+                    if event_ids.get(provider_name) is not None:
+                        event_ids[provider_name].add(event_id)
+
+        return event_ids
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,187 @@
+# This software is released under the terms of the GNU GENERAL PUBLIC LICENSE.
+# See LICENSE.txt for full details.
+# Copyright 2023 Telemarq Ltd
+
+"""
+Downscaled versions of media, for showing many images or videos at once.
+
+Images are scaled with Pillow and videos are represented by a frame extracted with ffmpeg. Both are optional: media
+which cannot be scaled is served at its original size. Scaled media is stored as JPEG files in a directory per device,
+named by a hash of the media's identity, version and the requested size.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import io
+from logging import getLogger
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+
+from .filesystem.ensuredir import ensuredir
+from .media import MediaData
+
+log = getLogger(__name__)
+
+
+ORIGINAL = 'original'
+
+# Size name -> the maximum width and height of the scaled media, in pixels.
+SIZES = {
+    'thumb': 256,
+    'preview': 1024,
+}
+
+JPEG_QUALITY = 80
+
+# Time allowed for ffmpeg to extract a frame from a video.
+FFMPEG_TIMEOUT_SECONDS = 30
+
+# Media which could not be scaled is served at its original size for this long before scaling is tried again.
+UNSCALABLE_RETRY_SECONDS = 10 * 60
+
+
+def _scale_image(handle, max_side, output_path):
+    with Image.open(handle) as image:
+        # Let JPEG decoding skip detail that would be lost when scaling.
+        image.draft('RGB', (max_side, max_side))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_side, max_side))
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+
+        image.save(output_path, 'JPEG', quality=JPEG_QUALITY)
+
+
+def _scale_video(ffmpeg, handle, max_side, output_path):
+    # ffmpeg needs to seek within the video, so it is given a copy on disk rather than a pipe.
+    with tempfile.NamedTemporaryFile() as video_file:
+        shutil.copyfileobj(handle, video_file)
+        video_file.flush()
+
+        subprocess.run([
+            ffmpeg, '-loglevel', 'error', '-y',
+            '-i', video_file.name,
+            '-frames:v', '1',
+            '-vf', f'scale={max_side}:{max_side}:force_original_aspect_ratio=decrease',
+            '-q:v', '4',
+            '-f', 'image2', output_path,
+        ], check=True, stdin=subprocess.DEVNULL, timeout=FFMPEG_TIMEOUT_SECONDS)
+
+
+class Thumbnailer:
+    """
+    Produces and caches scaled versions of media on a pool of 'threads' threads.
+
+    Each version is produced once, however many requests for it arrive while it is being produced.
+    """
+    def __init__(self, threads=None):
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='rime-thumbnails')
+        self._ffmpeg = shutil.which('ffmpeg')
+        self._lock = threading.Lock()
+        self._pending = {}  # output path -> Future
+        self._unscalable = {}  # output path of media which could not be scaled -> time.monotonic() of the failure
+
+    def can_scale(self, mime_type):
+        if mime_type.startswith('image/'):
+            return Image is not None
+        elif mime_type.startswith('video/'):
+            return self._ffmpeg is not None
+
+        return False
+
+    def get_media(self, device, media_path, size, load_media_fn, media_version_fn=lambda: None) -> MediaData:
+        """
+        Return the media identified by 'media_path' scaled to 'size', or at its original size if it can't be scaled.
+
+        load_media_fn() returns the original media. media_version_fn() returns a string which changes when the media
+        does, so that scaled media can be found without loading the original; if it returns None, the original is
+        loaded and its length used instead.
+        """
+        if size == ORIGINAL or not device.cache_path:
+            return load_media_fn()
+
+        media = None
+        media_version = media_version_fn()
+        if media_version is None:
+            media = load_media_fn()
+            media_version = media.length
+
+        key = hashlib.sha256(f'{media_path}\0{media_version}\0{size}'.encode('utf-8')).hexdigest()
+        output_path = os.path.join(device.cache_path, 'thumbnails', key[:2], key + '.jpg')
+
+        if not os.path.exists(output_path):
+            if media is None:
+                media = load_media_fn()
+
+            if not self.can_scale(media.mime_type):
+                return media
+
+            with self._lock:
+                unscalable = self._is_unscalable(output_path)
+                future = None if unscalable else self._pending.get(output_path)
+                if future is None and not unscalable:
+                    future = self._executor.submit(self._scale, media, SIZES[size], output_path)
+                    self._pending[output_path] = future
+                    # The media is now owned by the pool.
+                    media = None
+
+            if unscalable or not future.result():
+                return media or load_media_fn()
+
+        if media:
+            media.handle.close()
+
+        return MediaData(mime_type='image/jpeg', handle=open(output_path, 'rb'), length=os.path.getsize(output_path))
+
+    def _is_unscalable(self, output_path):
+        """
+        Return whether scaling to 'output_path' failed recently. Call with the lock held.
+        """
+        failed_at = self._unscalable.get(output_path)
+        if failed_at is None:
+            return False
+
+        if time.monotonic() - failed_at >= UNSCALABLE_RETRY_SECONDS:
+            del self._unscalable[output_path]
+            return False
+
+        return True
+
+    def _scale(self, media, max_side, output_path):
+        """
+        Write 'media' scaled to fit in 'max_side' pixels to 'output_path', returning whether that was possible.
+        """
+        ensuredir(output_path)
+        # Write to a temporary file so that partially-written output is never served.
+        temp_path = f'{output_path}.{threading.get_ident()}.tmp'
+
+        try:
+            with media.handle:
+                if media.mime_type.startswith('image/'):
+                    # Pillow may seek, which not every handle supports efficiently.
+                    _scale_image(io.BytesIO(media.handle.read()), max_side, temp_path)
+                else:
+                    _scale_video(self._ffmpeg, media.handle, max_side, temp_path)
+
+            os.replace(temp_path, output_path)
+            return True
+        except Exception as e:
+            log.warning(f"Could not scale {media.mime_type} media to {output_path}: {e}")
+            with self._lock:
+                self._unscalable[output_path] = time.monotonic()
+
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+            return False
+        finally:
+            with self._lock:
+                del self._pending[output_path]
@@ -0,0 +1,13 @@
+import os
+import sys
+
+import pytest
+
+# Unit tests import RIME directly rather than talking to a server.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)))
+
+
+@pytest.fixture(scope="session", autouse=True)
+def rime_server():
+    " Unit tests don't use a RIME server, so don't start one. "
+    yield
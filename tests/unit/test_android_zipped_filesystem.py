@@ -0,0 +1,75 @@
+import gc
+import sqlite3
+import stat
+import zipfile
+
+import pytest
+
+from rime.filesystem.android import AndroidZippedDeviceFilesystem
+
+DB_PATH = 'data/data/com.example/databases/example.db'
+
+
+@pytest.fixture
+def archive_path(tmp_path):
+    db_path = tmp_path / 'example.db'
+    conn = sqlite3.connect(db_path)
+    conn.execute('CREATE TABLE t (x)')
+    conn.execute('INSERT INTO t VALUES (1)')
+    conn.commit()
+    conn.close()
+
+    path = tmp_path / 'android.zip'
+    with zipfile.ZipFile(path, 'w') as zf:
+        zf.writestr('android/data/data/android/', b'')
+        zf.write(db_path, f'android/{DB_PATH}')
+        zf.writestr('android/sdcard/DCIM/photo.jpg', b'jpeg data')
+    return str(path)
+
+
+@pytest.fixture
+def filesystem(archive_path):
+    return AndroidZippedDeviceFilesystem('android', archive_path)
+
+
+def test_is_device_filesystem(archive_path, tmp_path):
+    assert AndroidZippedDeviceFilesystem.is_device_filesystem(archive_path)
+    assert not AndroidZippedDeviceFilesystem.is_device_filesystem(str(tmp_path))
+
+
+def test_scandir(filesystem):
+    entries = {entry.name: entry for entry in filesystem.scandir('sdcard/DCIM')}
+
+    assert list(entries) == ['photo.jpg']
+    assert entries['photo.jpg'].path == 'sdcard/DCIM/photo.jpg'
+    assert entries['photo.jpg'].is_file()
+    assert stat.S_ISDIR(filesystem.path_to_direntry('sdcard').stat().st_mode)
+
+
+def test_files(filesystem):
+    assert filesystem.exists('/sdcard/DCIM/photo.jpg')
+    assert not filesystem.exists('sdcard/DCIM/missing.jpg')
+    assert filesystem.getsize('sdcard/DCIM/photo.jpg') == len(b'jpeg data')
+
+    with filesystem.open('sdcard/DCIM/photo.jpg') as f:
+        assert f.read() == b'jpeg data'
+
+
+def test_read_only_connections_share_a_copy(filesystem):
+    conn = filesystem.sqlite3_connect(DB_PATH)
+
+    assert conn.execute('SELECT x FROM t').fetchall() == [(1,)]
+    with pytest.raises(sqlite3.OperationalError):
+        conn.execute('INSERT INTO t VALUES (2)')
+
+
+def test_writable_connections_keep_their_private_copy(filesystem):
+    conn = filesystem.sqlite3_connect(DB_PATH, read_only=False)
+    gc.collect()
+
+    conn.execute('INSERT INTO t VALUES (2)')
+    conn.commit()
+    assert conn.execute('SELECT x FROM t ORDER BY x').fetchall() == [(1,), (2,)]
+
+    # The archive's copy is unchanged.
+    assert filesystem.sqlite3_connect(DB_PATH).execute('SELECT x FROM t').fetchall() == [(1,)]
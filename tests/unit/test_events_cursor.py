@@ -0,0 +1,88 @@
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+from rime.filter import EventsFilter
+from rime.graphql import EventsCursor
+
+
+def _event(timestamp, name=None):
+    return SimpleNamespace(timestamp=timestamp, device_id='device', name=name)
+
+
+T0 = datetime(2023, 3, 1, 12, 0, 0)
+T1 = datetime(2023, 3, 1, 12, 0, 1)
+T2 = datetime(2023, 3, 1, 12, 0, 2)
+
+
+def test_encode_decode_round_trip():
+    cursor = EventsCursor(time=T0.timestamp() + 0.123456, offset=3)
+
+    assert EventsCursor.decode(cursor.encode()) == cursor
+
+
+@pytest.mark.parametrize('cursor_str', ['', 'not base64!', 'MTIz', 'YWJjfGRlZg=='])
+def test_decode_rejects_invalid_cursors(cursor_str):
+    with pytest.raises(ValueError):
+        EventsCursor.decode(cursor_str)
+
+
+def test_after_page_counts_events_at_the_last_time():
+    page = [_event(T0), _event(T1), _event(T1)]
+
+    assert EventsCursor.after_page(page) == EventsCursor(time=T1.timestamp(), offset=2)
+
+
+def test_after_page_includes_previous_offset_when_the_whole_page_has_one_time():
+    previous = EventsCursor(time=T1.timestamp(), offset=2)
+
+    assert EventsCursor.after_page([_event(T1), _event(T1)], previous) == EventsCursor(time=T1.timestamp(), offset=4)
+
+
+def test_after_page_ignores_previous_offset_at_a_different_time():
+    previous = EventsCursor(time=T0.timestamp(), offset=5)
+
+    assert EventsCursor.after_page([_event(T1)], previous) == EventsCursor(time=T1.timestamp(), offset=1)
+
+
+def test_skip_resumes_after_the_cursor():
+    events = [_event(T0, 'a'), _event(T1, 'b'), _event(T1, 'c'), _event(T1, 'd'), _event(T2, 'e')]
+    cursor = EventsCursor.after_page(events[:3])
+
+    assert [event.name for event in cursor.skip(events)] == ['d', 'e']
+
+
+def test_pages_cover_every_event_once():
+    events = [_event(time, str(i)) for i, time in enumerate([T0, T1, T1, T1, T1, T2, T2])]
+
+    seen = []
+    cursor = None
+    while True:
+        remaining = list(cursor.skip(events)) if cursor else events
+        page = remaining[:2]
+        if not page:
+            break
+
+        seen.extend(event.name for event in page)
+        cursor = EventsCursor.after_page(page, cursor)
+
+    assert seen == [event.name for event in events]
+
+
+def test_narrow_sets_a_start_before_the_cursor():
+    narrowed = EventsCursor(time=T1.timestamp(), offset=1).narrow(EventsFilter())
+
+    assert narrowed.timestamp_start == T1 - EventsCursor.QUERY_SLACK
+
+
+def test_narrow_keeps_a_later_start():
+    filter_obj = EventsFilter(timestamp_start=T2)
+
+    assert EventsCursor(time=T0.timestamp(), offset=1).narrow(filter_obj) is filter_obj
+
+
+def test_narrow_replaces_an_earlier_start():
+    narrowed = EventsCursor(time=T2.timestamp(), offset=1).narrow(EventsFilter(timestamp_start=T0))
+
+    assert narrowed.timestamp_start == T2 - EventsCursor.QUERY_SLACK
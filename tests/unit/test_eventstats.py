@@ -0,0 +1,73 @@
+from datetime import datetime, timedelta
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from rime import eventstats
+from rime.contact import Contact
+from rime.event import Event, MessageEvent, MessageSession
+
+DEVICE = SimpleNamespace(id_='phone')
+PROVIDER = SimpleNamespace(NAME='test-provider')
+ALICE = Contact(local_id='1', device_id='phone', providerName='test-provider')
+
+
+def test_make_key_follows_the_grouping_order():
+    timestamp = datetime(2023, 3, 1, 14, 35)
+
+    key = eventstats.make_key([eventstats.HOUR, eventstats.PROVIDER, eventstats.DAY], DEVICE, PROVIDER,
+                              timestamp=timestamp)
+
+    assert key == ('2023-03-01T14', 'test-provider', '2023-03-01')
+
+
+def test_make_key_for_senders_and_sessions():
+    key = eventstats.make_key([eventstats.SENDER, eventstats.SESSION], DEVICE, PROVIDER, sender=ALICE,
+                              session_local_id=7)
+
+    assert key == ('phone:test-provider:1', 'phone:test-provider:7')
+    assert eventstats.make_key([eventstats.SENDER, eventstats.SESSION], DEVICE, PROVIDER) == (None, None)
+
+
+def test_make_key_rejects_unknown_groupings():
+    with pytest.raises(ValueError):
+        eventstats.make_key(['WEEK'], DEVICE, PROVIDER, timestamp=datetime(2023, 3, 1))
+
+
+def test_count_events():
+    session = MessageSession(local_id='7', provider=PROVIDER, name='', participants=(ALICE,))
+    events = [
+        MessageEvent(id_='1', timestamp=datetime(2023, 3, 1, 9), provider=PROVIDER, sender=ALICE, session_id='7',
+                     text='', session=session),
+        MessageEvent(id_='2', timestamp=datetime(2023, 3, 1, 17), provider=PROVIDER, sender=ALICE, session_id='7',
+                     text='', session=session),
+        Event(id_='3', timestamp=datetime(2023, 3, 2, 9), provider=PROVIDER, sender=None),
+    ]
+
+    counts = eventstats.count_events([eventstats.DAY, eventstats.SESSION], DEVICE, PROVIDER, events)
+
+    assert counts == {('2023-03-01', 'phone:test-provider:7'): 2, ('2023-03-02', None): 1}
+
+
+@pytest.fixture(params=['UTC', 'Europe/London', 'America/St_Johns', 'Asia/Kolkata', 'Asia/Kathmandu'])
+def time_zone(request, monkeypatch):
+    monkeypatch.setenv('TZ', request.param)
+    time.tzset()
+    yield request.param
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_buckets_never_span_a_local_hour(time_zone):
+    # Providers counting in SQL key every event in a bucket by the local time of the bucket's start.
+    start = datetime(2023, 3, 25).timestamp()
+    for seconds in range(0, int(timedelta(days=2).total_seconds()), 7 * 60 + 13):
+        posix_time = start + seconds
+        bucket_start = posix_time // eventstats.BUCKET_SECONDS * eventstats.BUCKET_SECONDS
+
+        hour_key = eventstats.make_key([eventstats.HOUR], DEVICE, PROVIDER,
+                                       timestamp=datetime.fromtimestamp(posix_time))
+        bucket_key = eventstats.make_key([eventstats.HOUR], DEVICE, PROVIDER,
+                                         timestamp=datetime.fromtimestamp(bucket_start))
+        assert hour_key == bucket_key, datetime.fromtimestamp(posix_time)
@@ -0,0 +1,127 @@
+import os
+
+import pytest
+
+from rime.filesystem.registry import FilesystemRegistry
+
+
+def _make_android(base_path, key):
+    os.makedirs(os.path.join(base_path, key, 'data', 'data', 'android'))
+
+
+@pytest.fixture
+def paths(tmp_path):
+    base_path = tmp_path / 'devices'
+    cache_path = tmp_path / 'cache'
+    base_path.mkdir()
+    _make_android(base_path, 'phone1')
+    _make_android(base_path, 'phone2')
+    (base_path / 'notes.txt').write_text('not a device')
+    return str(base_path), str(cache_path)
+
+
+@pytest.fixture
+def registry(paths):
+    base_path, cache_path = paths
+    return FilesystemRegistry(base_path, passphrases={}, cache_path=cache_path)
+
+
+@pytest.fixture
+def probes(registry, monkeypatch):
+    probed = []
+    probe = registry._probe
+
+    def counting_probe(filename, path):
+        probed.append(filename)
+        return probe(filename, path)
+
+    monkeypatch.setattr(registry, '_probe', counting_probe)
+    return probed
+
+
+def test_filesystems_are_found(registry, paths):
+    _base_path, cache_path = paths
+
+    assert sorted(registry.filesystems) == ['phone1', 'phone2']
+    assert registry['phone1'].cache_path == os.path.join(cache_path, 'phone1')
+
+
+def test_rescan_keeps_unchanged_filesystems(registry, probes):
+    filesystems = dict(registry.filesystems)
+
+    registry.rescan()
+
+    assert probes == []
+    assert all(registry[key] is fs for key, fs in filesystems.items())
+
+
+def test_rescan_keeps_filesystems_whose_contents_were_written(registry, paths, probes):
+    base_path, _cache_path = paths
+    phone1 = registry['phone1']
+    with open(os.path.join(base_path, 'phone1', 'new-file'), 'w') as f:
+        f.write('x')
+
+    registry.rescan()
+
+    assert probes == []
+    assert registry['phone1'] is phone1
+
+
+def test_rescan_probes_new_entries(registry, paths, probes):
+    base_path, _cache_path = paths
+    _make_android(base_path, 'phone3')
+    os.makedirs(os.path.join(base_path, 'not-a-device'))
+
+    registry.rescan()
+
+    assert sorted(probes) == ['not-a-device', 'phone3']
+    assert sorted(registry.filesystems) == ['phone1', 'phone2', 'phone3']
+
+    # Entries which aren't filesystems aren't probed again until they change.
+    registry.rescan()
+    assert sorted(probes) == ['not-a-device', 'phone3']
+
+
+def test_rescan_forgets_removed_filesystems_and_their_caches(registry, paths):
+    base_path, cache_path = paths
+    os.makedirs(registry.cache_path_for('phone2'))
+    os.rename(os.path.join(base_path, 'phone2'), os.path.join(os.path.dirname(base_path), 'phone2'))
+
+    registry.rescan()
+
+    assert sorted(registry.filesystems) == ['phone1']
+    assert not os.path.exists(os.path.join(cache_path, 'phone2'))
+
+
+def test_rescan_probes_changed_files(registry, paths, probes):
+    base_path, _cache_path = paths
+    notes_path = os.path.join(base_path, 'notes.txt')
+    with open(notes_path, 'a') as f:
+        f.write(', still not a device')
+
+    registry.rescan()
+
+    assert probes == ['notes.txt']
+
+
+def test_rescan_resets_the_caches_of_changed_filesystems(registry, paths):
+    base_path, _cache_path = paths
+    old_fs = registry['phone1']
+    stale_path = os.path.join(registry.cache_path_for('phone1'), 'text_index.db')
+    os.makedirs(os.path.dirname(stale_path))
+    with open(stale_path, 'w') as f:
+        f.write('derived from the old phone1')
+    kept_path = os.path.join(registry.cache_path_for('phone2'), 'text_index.db')
+    os.makedirs(os.path.dirname(kept_path))
+    with open(kept_path, 'w') as f:
+        f.write('derived from phone2')
+
+    # Replace phone1 with a different device under the same name.
+    os.rename(os.path.join(base_path, 'phone1'), os.path.join(os.path.dirname(base_path), 'old-phone1'))
+    _make_android(base_path, 'phone1')
+
+    registry.rescan()
+
+    assert registry['phone1'] is not old_fs
+    assert not os.path.exists(stale_path)
+    assert os.path.exists(kept_path)
@@ -0,0 +1,78 @@
+import hashlib
+import os
+
+import pytest
+
+from rime.filesystem.ios import _IosManifest
+from rime.sql import sqlite3_connect
+
+
+def _file_id(path):
+    domain, relative_path = path.split('/', 1)
+    return hashlib.sha1(f'{domain}-{relative_path}'.encode()).hexdigest()
+
+
+PATHS = [
+    'HomeDomain/Library/SMS/sms.db',
+    'HomeDomain/Library/SMS/Attachments/a.jpg',
+    'HomeDomain/Library/SMS2/other.db',
+    'HomeDomain/Library/SMS-backup/old.db',
+    'HomeDomain/Library/AddressBook/AddressBook.sqlitedb',
+    'AppDomain-com.example/Documents/notes.txt',
+]
+
+
+@pytest.fixture
+def manifest():
+    conn = sqlite3_connect(':memory:')
+    conn.execute('CREATE TABLE Files (fileID TEXT PRIMARY KEY, domain TEXT, relativePath TEXT, flags INTEGER, '
+                 'file BLOB)')
+    conn.executemany('INSERT INTO Files (fileID, domain, relativePath) VALUES (?, ?, ?)',
+                     [(_file_id(path), *path.split('/', 1)) for path in PATHS])
+    # Some backups have fileIDs which aren't SHA-1 digests.
+    conn.execute("INSERT INTO Files (fileID, domain, relativePath) VALUES ('custom-id', 'MediaDomain', 'a/b.jpg')")
+    yield _IosManifest(conn)
+    conn.close()
+
+
+@pytest.mark.parametrize('path', PATHS)
+def test_get_hashed_pathname(manifest, path):
+    file_id = _file_id(path)
+
+    assert manifest.get_hashed_pathname(path) == os.path.join(file_id[:2], file_id)
+
+
+def test_get_hashed_pathname_of_an_unusual_file_id(manifest):
+    assert manifest.get_hashed_pathname('MediaDomain/a/b.jpg') == os.path.join('cu', 'custom-id')
+
+
+def test_get_hashed_pathname_of_a_missing_path_uses_its_hash(manifest):
+    path = 'HomeDomain/Library/Missing.db'
+    file_id = _file_id(path)
+
+    assert manifest.get_hashed_pathname(path) == os.path.join(file_id[:2], file_id)
+
+
+def test_paths_under_stops_at_the_directory_boundary(manifest):
+    assert manifest.paths_under('HomeDomain/Library/SMS') == [
+        'HomeDomain/Library/SMS/Attachments/a.jpg',
+        'HomeDomain/Library/SMS/sms.db',
+    ]
+
+
+def test_paths_under_accepts_a_trailing_slash(manifest):
+    assert manifest.paths_under('HomeDomain/Library/SMS/') == manifest.paths_under('HomeDomain/Library/SMS')
+
+
+def test_paths_under_a_domain(manifest):
+    assert manifest.paths_under('AppDomain-com.example') == ['AppDomain-com.example/Documents/notes.txt']
+    assert manifest.paths_under('NoSuchDomain') == []
+
+
+def test_added_files_are_found(manifest):
+    path = 'HomeDomain/Library/SMS/new.db'
+    manifest.add_file(path)
+
+    assert path in manifest.paths_under('HomeDomain/Library/SMS')
+    assert manifest.get_hashed_pathname(path).endswith(_file_id(path))
+    assert manifest.paths_under('HomeDomain/Library/SMS') == sorted(manifest.paths_under('HomeDomain/Library/SMS'))
@@ -0,0 +1,90 @@
+from types import SimpleNamespace
+
+import pytest
+
+from rime.contact import Contact, Name
+from rime.mergedcontact import merge_contacts
+
+
+class _Rime:
+    def __init__(self, country_codes):
+        self._devices = {device_id: SimpleNamespace(country_code=code) for device_id, code in country_codes.items()}
+
+    def device_for_id(self, device_id):
+        return self._devices[device_id]
+
+
+@pytest.fixture
+def rime():
+    return _Rime({'uk-phone': 'GB', 'us-phone': 'US'})
+
+
+def _contact(local_id, device_id='uk-phone', phones=(), emails=(), name=None):
+    return Contact(local_id=local_id, device_id=device_id, providerName='test', name=Name(first=name),
+                   phone=phones[0] if phones else None, email=emails[0] if emails else None,
+                   phones=tuple(phones), emails=tuple(emails))
+
+
+def _groups(merged_contacts):
+    return sorted(sorted(contact.local_id for contact in merged.contacts) for merged in merged_contacts)
+
+
+def test_contacts_sharing_a_number_in_different_formats_are_merged(rime):
+    contacts = [
+        _contact('a', phones=['07700 900123']),
+        _contact('b', phones=['+44 7700 900123']),
+        _contact('c', phones=['07700 900999']),
+    ]
+
+    merged = merge_contacts(rime, contacts)
+
+    assert _groups(merged) == [['a', 'b'], ['c']]
+    assert merged[0].phone == '+447700900123'
+
+
+def test_numbers_are_parsed_with_each_device_country_code(rime):
+    contacts = [
+        _contact('a', device_id='uk-phone', phones=['+1 202 555 0142']),
+        _contact('b', device_id='us-phone', phones=['(202) 555-0142']),
+    ]
+
+    assert _groups(merge_contacts(rime, contacts)) == [['a', 'b']]
+
+
+def test_contacts_are_merged_transitively(rime):
+    # 'a' and 'c' share nothing, but both share something with 'b'.
+    contacts = [
+        _contact('a', phones=['07700 900123']),
+        _contact('c', emails=['carol@example.com']),
+        _contact('b', phones=['07700 900123'], emails=['Carol@Example.com']),
+        _contact('d', phones=['07700 900456'], emails=['dave@example.com']),
+    ]
+
+    assert _groups(merge_contacts(rime, contacts)) == [['a', 'b', 'c'], ['d']]
+
+
+def test_merged_contact_takes_the_longest_name_and_every_number(rime):
+    contacts = [
+        _contact('a', phones=['07700 900123'], name='Al'),
+        _contact('b', phones=['+44 7700 900123', '07700 900456'], name='Alexander'),
+    ]
+
+    merged, = merge_contacts(rime, contacts)
+
+    assert merged.name.full_name() == 'Alexander'
+    assert merged.phones == ['+447700900123', '+447700900456']
+
+
+def test_every_contact_is_accounted_for(rime):
+    contacts = [
+        _contact('a', phones=['07700 900123']),
+        _contact('b', phones=['not a number']),
+        _contact('c'),
+        _contact('d', phones=['+44 7700 900123']),
+    ]
+
+    merged = merge_contacts(rime, contacts)
+
+    assert sorted(contact.local_id for m in merged for contact in m.contacts) == ['a', 'b', 'c', 'd']
+    # Contacts without a usable number come last, keeping what they have.
+    assert [m.phones for m in merged[-2:]] == [['not a number'], []]
@@ -0,0 +1,78 @@
+import os
+import threading
+
+from rime.filesystem.android import AndroidDeviceFilesystem
+from rime.metadata import FsMetadata
+
+MEDIA_ROOT = '/sdcard'
+
+
+def _write_file(root, path, data=b'data'):
+    pathname = os.path.join(root, path.lstrip('/'))
+    os.makedirs(os.path.dirname(pathname), exist_ok=True)
+    with open(pathname, 'wb') as f:
+        f.write(data)
+
+
+def _filesystem(tmp_path, paths):
+    root = str(tmp_path / 'phone')
+    os.makedirs(os.path.join(root, 'data', 'data', 'android'))
+    for path in paths:
+        _write_file(root, path)
+
+    return root, AndroidDeviceFilesystem('phone', root)
+
+
+def _paths(metadatas):
+    return {metadata.path for metadata in metadatas}
+
+
+def test_files_under_scans_a_directory_which_has_never_been_scanned(tmp_path):
+    _, fs = _filesystem(tmp_path, ['/sdcard/DCIM/a.jpg', '/sdcard/Download/b.pdf'])
+
+    metadata = FsMetadata()
+    assert _paths(metadata.files_under(fs, MEDIA_ROOT)) == {'/sdcard/DCIM/a.jpg', '/sdcard/Download/b.pdf'}
+
+
+def test_files_under_returns_the_files_as_of_the_last_scan(tmp_path):
+    root, fs = _filesystem(tmp_path, ['/sdcard/DCIM/a.jpg'])
+
+    metadata = FsMetadata()
+    metadata.scan(fs, MEDIA_ROOT)
+
+    _write_file(root, '/sdcard/DCIM/b.jpg')
+    os.remove(os.path.join(root, 'sdcard', 'DCIM', 'a.jpg'))
+    assert _paths(metadata.files_under(fs, MEDIA_ROOT)) == {'/sdcard/DCIM/a.jpg'}
+
+    metadata.scan(fs, MEDIA_ROOT)
+    assert _paths(metadata.files_under(fs, MEDIA_ROOT)) == {'/sdcard/DCIM/b.jpg'}
+
+
+def test_files_under_does_not_wait_for_a_scan(tmp_path):
+    root, fs = _filesystem(tmp_path, ['/sdcard/DCIM/a.jpg'])
+
+    metadata = FsMetadata()
+    metadata.scan(fs, MEDIA_ROOT)
+    _write_file(root, '/sdcard/DCIM/b.jpg')
+
+    scanning = threading.Event()
+    finish_scan = threading.Event()
+    scandir = fs.scandir
+
+    def slow_scandir(path):
+        scanning.set()
+        assert finish_scan.wait(10)
+        return scandir(path)
+
+    fs.scandir = slow_scandir
+    scan_thread = threading.Thread(target=metadata.scan, args=(fs, MEDIA_ROOT))
+    scan_thread.start()
+    try:
+        assert scanning.wait(10)
+        # The scan is part way through, so listing returns what the previous scan found.
+        assert _paths(metadata.files_under(fs, MEDIA_ROOT)) == {'/sdcard/DCIM/a.jpg'}
+    finally:
+        finish_scan.set()
+        scan_thread.join()
+
+    assert _paths(metadata.files_under(fs, MEDIA_ROOT)) == {'/sdcard/DCIM/a.jpg', '/sdcard/DCIM/b.jpg'}
@@ -0,0 +1,61 @@
+from rime.resultcache import ResultCache
+
+
+def _get(cache, key, size, computed=None):
+    def compute():
+        if computed is not None:
+            computed.append(key)
+        return key
+
+    return cache.get_or_compute(key, compute, lambda value: size)
+
+
+def test_least_recently_used_results_are_evicted():
+    cache = ResultCache(max_bytes=100)
+    _get(cache, 'a', 40)
+    _get(cache, 'b', 40)
+    _get(cache, 'a', 40)
+    _get(cache, 'c', 40)
+
+    computed = []
+    for key in ('a', 'c', 'b'):
+        _get(cache, key, 40, computed)
+
+    assert computed == ['b']
+
+
+def test_oversized_results_are_not_stored_by_default():
+    cache = ResultCache(max_bytes=100)
+    _get(cache, 'small', 10)
+    _get(cache, 'large', 500)
+
+    computed = []
+    _get(cache, 'small', 10, computed)
+    _get(cache, 'large', 500, computed)
+    assert computed == ['large']
+
+
+def test_one_oversized_result_is_kept_without_evicting_the_others():
+    cache = ResultCache(max_bytes=100, keep_oversized=True)
+    _get(cache, 'small1', 40)
+    _get(cache, 'small2', 40)
+    _get(cache, 'large1', 500)
+
+    computed = []
+    for key in ('small1', 'small2', 'large1'):
+        _get(cache, key, {'large1': 500}.get(key, 40), computed)
+    assert computed == []
+
+    # A second oversized result replaces the first, and still leaves the others.
+    _get(cache, 'large2', 600)
+    for key in ('small1', 'small2', 'large2', 'large1'):
+        _get(cache, key, {'large1': 500, 'large2': 600}.get(key, 40), computed)
+    assert computed == ['large1']
+    assert len(cache) == 3
+
+
+def test_results_computed_during_a_clear_are_not_stored():
+    cache = ResultCache(max_bytes=100)
+    cache.get_or_compute('a', cache.clear, lambda value: 10)
+
+    assert len(cache) == 0
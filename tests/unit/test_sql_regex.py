@@ -0,0 +1,77 @@
+import re
+
+import pytest
+
+from rime.sql import Query, Table, _regex_literal_prefix, regex_match_criterion, regex_sql_pattern, sqlite3_connect
+
+
+@pytest.mark.parametrize('pattern, prefix, rest', [
+    ('Alice', 'Alice', ''),
+    ('^Alice', 'Alice', ''),
+    ('Al.*', 'Al', '.*'),
+    (r'\+44 ?7', '+44', ' ?7'),
+    ('Alic?e', 'Ali', 'c?e'),
+    ('Al{2}', 'A', 'l{2}'),
+    ('(Al|Bo)b', '', '(Al|Bo)b'),
+    ('Al|Bob', '', 'Al|Bob'),
+    (r'\d+', '', r'\d+'),
+    ('', '', ''),
+])
+def test_regex_literal_prefix(pattern, prefix, rest):
+    assert _regex_literal_prefix(re.compile(pattern)) == (prefix, rest)
+
+
+def test_regex_literal_prefix_ignores_case_insensitive_regexes():
+    assert _regex_literal_prefix(re.compile('Alice', re.IGNORECASE)) == ('', 'Alice')
+
+
+def test_regex_sql_pattern_writes_flags_inline():
+    assert regex_sql_pattern(re.compile('a.b')) == 'a.b'
+    assert regex_sql_pattern(re.compile('a.b', re.IGNORECASE | re.DOTALL)) == '(?is)a.b'
+
+
+@pytest.fixture
+def names():
+    conn = sqlite3_connect(':memory:')
+    conn.execute('CREATE TABLE names (name TEXT)')
+    conn.executemany('INSERT INTO names VALUES (?)',
+                     [('Alice',), ('alice',), ('Alicia',), ('Bob',), ('Malice',), ('+44 7700 900123',), (None,)])
+    yield conn
+    conn.close()
+
+
+def _select(conn, regex):
+    table = Table('names')
+    query = Query.from_(table).select(table.name).where(regex_match_criterion(table.name, regex)).orderby(table.name)
+    return [row[0] for row in conn.execute(str(query))]
+
+
+@pytest.mark.parametrize('pattern, flags', [
+    ('Alice', 0),
+    ('Ali', 0),
+    ('Ali.*a', 0),
+    ('alice', re.IGNORECASE),
+    (r'\+44 ?7', 0),
+    ('.*lice', 0),
+    ('.*', 0),
+    ('Bob|Malice', 0),
+])
+def test_regex_match_criterion_selects_every_match(names, pattern, flags):
+    regex = re.compile(pattern, flags)
+    all_names = [row[0] for row in names.execute('SELECT name FROM names WHERE name IS NOT NULL')]
+
+    selected = _select(names, regex)
+
+    # The criterion may select more rows than match, but never fewer.
+    assert {name for name in all_names if regex.match(name)} <= set(selected)
+
+
+def test_regex_match_criterion_uses_a_range_for_a_literal_prefix(names):
+    table = Table('names')
+
+    assert 'REGEXP' not in str(regex_match_criterion(table.name, re.compile('Ali')))
+    assert _select(names, re.compile('Ali')) == ['Alice', 'Alicia']
+
+
+def test_regex_match_criterion_keeps_flags(names):
+    assert _select(names, re.compile('ALICE', re.IGNORECASE)) == ['Alice', 'Malice', 'alice']
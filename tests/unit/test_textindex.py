@@ -0,0 +1,122 @@
+from datetime import datetime, timedelta
+import os
+from types import SimpleNamespace
+import zipfile
+
+import pytest
+
+from rime.event import MessageEvent
+from rime.filesystem.android import AndroidDeviceFilesystem, AndroidZippedDeviceFilesystem
+from rime.filter import EventsFilter
+from rime.graphql import _result_cache_key, _text_index_state
+from rime.textindex import TextIndex, fts_query, text_regex
+
+MESSAGES_PATH = 'sdcard/messages.txt'
+
+
+class _MessagesProvider:
+    """
+    Reads one message per line of a file on the device.
+    """
+    NAME = 'test-messages'
+
+    def __init__(self, fs):
+        self.fs = fs
+
+    def source_fingerprint(self):
+        return self.fs.fingerprint(MESSAGES_PATH)
+
+    def search_events(self, device, filter_):
+        with self.fs.open(MESSAGES_PATH) as f:
+            lines = f.read().decode('utf-8').splitlines()
+
+        for i, text in enumerate(lines):
+            yield MessageEvent(id_=str(i), timestamp=datetime(2023, 3, 1) + timedelta(minutes=i), provider=self,
+                               sender=None, session_id='1', text=text)
+
+
+def _write_directory(path, messages):
+    os.makedirs(os.path.join(path, 'data', 'data', 'android'), exist_ok=True)
+    os.makedirs(os.path.join(path, 'sdcard'), exist_ok=True)
+    with open(os.path.join(path, MESSAGES_PATH), 'w') as f:
+        f.write('\n'.join(messages))
+
+    return AndroidDeviceFilesystem('phone', path)
+
+
+def _write_zip(path, messages):
+    path += '.zip'
+    with zipfile.ZipFile(path, 'w') as zf:
+        zf.writestr('phone/data/data/android/', b'')
+        zf.writestr(f'phone/{MESSAGES_PATH}', '\n'.join(messages))
+
+    return AndroidZippedDeviceFilesystem('phone', path)
+
+
+def _device(fs):
+    return SimpleNamespace(id_='phone', providers={_MessagesProvider.NAME: _MessagesProvider(fs)})
+
+
+def _search(text_index, device, text_query):
+    return text_index.search(device, text_query)[_MessagesProvider.NAME]
+
+
+@pytest.mark.parametrize('write_fs', [_write_directory, _write_zip])
+def test_search_sees_the_messages_of_a_replaced_device(tmp_path, write_fs):
+    db_path = str(tmp_path / 'cache' / 'text_index.db')
+    device_path = str(tmp_path / 'phone')
+
+    text_index = TextIndex(db_path)
+    device = _device(write_fs(device_path, ['see you at the station', 'lunch tomorrow?']))
+    text_index.warm(device)
+    assert _search(text_index, device, 'station') == {'0'}
+    text_index.close()
+
+    # The device is replaced, with different messages, while RIME isn't running.
+    device = _device(write_fs(device_path, ['the train is late', 'meet at the station instead', 'ok']))
+
+    text_index = TextIndex(db_path)
+    # Until the index is rebuilt the provider is reported as unindexed, so that its text is matched instead.
+    assert _search(text_index, device, 'station') is None
+
+    text_index.warm(device)
+    assert _search(text_index, device, 'station') == {'1'}
+    assert _search(text_index, device, 'train') == {'0'}
+    text_index.close()
+
+
+def test_unchanged_providers_are_not_indexed_again(tmp_path, monkeypatch):
+    db_path = str(tmp_path / 'cache' / 'text_index.db')
+    device = _device(_write_directory(str(tmp_path / 'phone'), ['hello there']))
+
+    text_index = TextIndex(db_path)
+    text_index.warm(device)
+    text_index.close()
+
+    text_index = TextIndex(db_path)
+    monkeypatch.setattr(_MessagesProvider, 'search_events', lambda *args: pytest.fail('indexed again'))
+    text_index.warm(device)
+    assert _search(text_index, device, 'hello') == {'0'}
+    text_index.close()
+
+
+def test_results_cached_before_indexing_are_not_used_after_it(tmp_path):
+    device = _device(_write_directory(str(tmp_path / 'phone'), ['see you at the station']))
+    device.text_index = TextIndex()
+    filter_obj = EventsFilter(text_query='station')
+
+    before = _result_cache_key('events', [device], filter_obj, None, None, _text_index_state([device], filter_obj))
+    assert device.text_index.indexed_providers(device) == set()
+
+    device.text_index.warm(device)
+    after = _result_cache_key('events', [device], filter_obj, None, None, _text_index_state([device], filter_obj))
+    assert device.text_index.indexed_providers(device) == {_MessagesProvider.NAME}
+    assert before != after
+    device.text_index.close()
+
+
+def test_queries_match_whole_words_and_prefixes():
+    assert fts_query('Meet  station*') == '"Meet" "station"*'
+    assert text_regex('meet station*').search('Station nearby? MEET me')
+    assert not text_regex('meet station').search('meeting at the stations')
+    assert not text_regex('').search('anything')
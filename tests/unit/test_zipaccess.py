@@ -0,0 +1,100 @@
+import os
+import stat
+import zipfile
+
+import pytest
+
+from rime.filesystem import zipaccess
+
+
+@pytest.fixture
+def archive_path(tmp_path):
+    path = tmp_path / 'backup.zip'
+    with zipfile.ZipFile(path, 'w') as zf:
+        zf.writestr('backup/Manifest.db', b'manifest', compress_type=zipfile.ZIP_STORED)
+        zf.writestr('backup/ab/abcdef', b'x' * 10_000, compress_type=zipfile.ZIP_DEFLATED)
+        zf.writestr('backup/ab/abcdef-wal', b'journal', compress_type=zipfile.ZIP_STORED)
+        zf.writestr('backup/empty/', b'')
+    return str(path)
+
+
+@pytest.fixture
+def zip_access(archive_path):
+    zip_access = zipaccess.acquire(archive_path)
+    yield zip_access
+    zip_access.release()
+
+
+def test_names_are_relative_to_the_main_directory(zip_access):
+    assert zip_access.main_dir == 'backup'
+    assert zip_access.exists('Manifest.db')
+    assert zip_access.exists('ab')
+    assert zip_access.exists('empty/')
+    assert not zip_access.exists('backup/Manifest.db')
+
+
+def test_listdir(zip_access):
+    assert sorted(zip_access.listdir('')) == ['Manifest.db', 'ab', 'empty']
+    assert sorted(zip_access.listdir('/ab/')) == ['ab/abcdef', 'ab/abcdef-wal']
+    assert zip_access.listdir('empty') == []
+
+    with pytest.raises(FileNotFoundError):
+        zip_access.listdir('missing')
+
+
+def test_stat(zip_access):
+    file_stat = zip_access.stat('ab/abcdef')
+    assert stat.S_ISREG(file_stat.st_mode)
+    assert file_stat.st_size == 10_000
+    assert file_stat.st_mtime > 0
+
+    # 'ab' isn't listed in the archive, but is a directory of its members.
+    assert stat.S_ISDIR(zip_access.stat('ab').st_mode)
+    assert stat.S_ISDIR(zip_access.stat('empty').st_mode)
+
+    with pytest.raises(FileNotFoundError):
+        zip_access.stat('missing')
+
+
+@pytest.mark.parametrize('name, data', [('Manifest.db', b'manifest'), ('ab/abcdef', b'x' * 10_000)])
+def test_open(zip_access, name, data):
+    with zip_access.open(name) as f:
+        assert f.read() == data
+
+
+def test_stored_members_can_seek(zip_access):
+    with zip_access.open('Manifest.db') as f:
+        f.seek(3)
+        assert f.read(3) == b'ife'
+        f.seek(-2, os.SEEK_END)
+        assert f.read() == b'st'
+
+
+def test_extract_copies_members_once_with_their_journals(zip_access):
+    pathname = zip_access.extract('ab/abcdef')
+
+    with open(pathname, 'rb') as f:
+        assert f.read() == b'x' * 10_000
+    with open(pathname + '-wal', 'rb') as f:
+        assert f.read() == b'journal'
+
+    assert zip_access.extract('ab/abcdef') == pathname
+
+
+def test_acquire_shares_archives(archive_path, zip_access):
+    other = zipaccess.acquire(archive_path)
+    try:
+        assert other is zip_access
+    finally:
+        other.release()
+
+    # The archive is still open for the first user.
+    assert zip_access.getsize('Manifest.db') == len(b'manifest')
+
+
+def test_extracted_members_are_removed_when_released(archive_path):
+    zip_access = zipaccess.acquire(archive_path)
+    pathname = zip_access.extract('Manifest.db')
+    zip_access.release()
+
+    assert not os.path.exists(pathname)